@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+from twinning import TwinningCoreset
+
+
+def _data(N=20000, d=3, seed=0):
+	return np.random.default_rng(seed).normal(size=(N, d))
+
+
+def _chunks(data, sizes):
+	bounds = np.cumsum([0] + sizes)
+	return [data[bounds[i]:bounds[i + 1]] for i in range(len(sizes))]
+
+
+def test_weights_add_up_to_the_stream():
+	data = _data()
+	np.random.seed(0)
+	coreset = TwinningCoreset(200).extend(np.array_split(data, 37))
+	points, weights = coreset.coreset()
+
+	assert len(coreset) == data.shape[0]
+	assert points.shape == (200, 3)
+	assert weights.sum() == data.shape[0]
+	assert np.all(weights >= 1)
+
+	# the sample consists of rows of the stream
+	assert np.all((points[:, None, :] == data[None, :, :]).all(axis=2).any(axis=1))
+
+
+def test_sample_represents_the_stream():
+	data = _data()
+	data[:, 0] = np.exp(data[:, 0])
+	np.random.seed(0)
+	points, weights = TwinningCoreset(500).extend(np.array_split(data, 10)).coreset()
+
+	mean = np.average(points, axis=0, weights=weights)
+	assert np.allclose(mean, data.mean(axis=0), atol=[0.1, 0.05, 0.05])
+	for j in range(3):
+		assert np.average(points[:, j] <= np.median(data[:, j]), weights=weights) == pytest.approx(0.5, abs=0.03)
+
+
+def test_memory_is_logarithmic():
+	coreset = TwinningCoreset(50, block_size=100)
+	np.random.seed(0)
+	coreset.extend(np.array_split(_data(), 200))
+
+	# 200 blocks are merged into the binary representation of 200
+	assert len(coreset._levels) == 8
+	assert [level is not None for level in coreset._levels] == [False, False, False, True, False, False, True, True]
+	assert all(level[0].shape[0] == 50 and level[1].sum() == 100 * 2 ** l for l, level in enumerate(coreset._levels) if level is not None)
+	assert coreset._n_buffered == 0
+
+
+def test_chunks_within_blocks_do_not_matter():
+	# the blocks are reduced with the running moments of the rows up to their end, hence only the chunks within blocks may differ
+	data = _data(5000)
+	np.random.seed(0)
+	expected = TwinningCoreset(100).extend(_chunks(data, [400] * 12 + [200])).coreset()
+	np.random.seed(0)
+	points, weights = TwinningCoreset(100).extend(_chunks(data, [1, 399, 100, 300, 350, 50] + [400] * 9 + [199, 1])).coreset()
+	assert np.array_equal(points, expected[0])
+	assert np.array_equal(weights, expected[1])
+
+
+def test_short_stream_is_kept():
+	data = _data(150)
+	points, weights = TwinningCoreset(200).extend(_chunks(data, [100, 0, 50])).coreset()
+	assert np.array_equal(points, data)
+	assert np.array_equal(weights, np.ones(150))
+
+
+def test_invalid_input_is_rejected():
+	for size, block_size in ((0, None), (10, 19), (2.5, None)):
+		with pytest.raises(Exception):
+			TwinningCoreset(size, block_size)
+
+	coreset = TwinningCoreset(10)
+	with pytest.raises(Exception):
+		coreset.coreset()
+
+	coreset.update(_data(5))
+	with pytest.raises(Exception):
+		coreset.update(_data(5, d=2))
@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+from twinning import twin, multiplet, energy, energy_many, energy_test, EnergyTracker, TwinningIndex
+
+
+def _data(N=1500, d=3, seed=0):
+	return np.random.default_rng(seed).normal(size=(N, d))
+
+
+def test_tracker_matches_energy():
+	data = _data()
+	points = data[::10, :]
+	tracker = EnergyTracker(data, points)
+	assert len(tracker) == points.shape[0]
+	assert tracker.energy() == pytest.approx(energy(data, points), rel=1e-10)
+
+
+def test_tracker_add_and_remove():
+	data = _data()
+	tracker = EnergyTracker(data)
+	ids = tracker.add(data[:100, :])
+	more = tracker.add(data[500:550, :])
+	assert tracker.energy() == pytest.approx(energy(data, np.vstack((data[:100, :], data[500:550, :]))), rel=1e-10)
+
+	tracker.remove(ids[10:60])
+	tracker.remove(more[0])
+	expected = np.vstack((data[:10, :], data[60:100, :], data[501:550, :]))
+	assert len(tracker) == expected.shape[0]
+	assert tracker.energy() == pytest.approx(energy(data, expected), rel=1e-10)
+
+
+def test_tracker_reuses_removed_ids():
+	data = _data()
+	tracker = EnergyTracker(data, data[:20, :])
+	ids, _ = tracker.contributions()
+	tracker.remove(ids[[3, 7]])
+
+	reused = tracker.add(data[100:102, :])
+	assert sorted(reused.tolist()) == [3, 7]
+	assert len(tracker) == 20
+
+	points = np.vstack((np.delete(data[:20, :], [3, 7], axis=0), data[100:102, :]))
+	assert tracker.energy() == pytest.approx(energy(data, points), rel=1e-10)
+
+
+def test_tracker_contributions_sum_to_energy():
+	data = _data()
+	tracker = EnergyTracker(data, data[::7, :])
+	ids, contributions = tracker.contributions()
+	assert len(ids) == len(contributions) == len(tracker)
+	assert contributions.sum() == pytest.approx(tracker.energy(), rel=1e-10)
+
+
+def test_tracker_rejects_unknown_ids():
+	tracker = EnergyTracker(_data(), _data()[:5, :])
+	with pytest.raises(Exception):
+		tracker.remove([5])
+
+	tracker.remove([0])
+	with pytest.raises(Exception):
+		tracker.remove([0])
+	assert len(tracker) == 4
+
+
+def test_energy_many_matches_energy():
+	data = _data()
+	sets = [twin(data, 4, u1=0), twin(data, 4, u1=1), np.arange(0, 1500, 3)]
+	energies = energy_many(data, sets)
+	assert energies == pytest.approx([energy(data, data[idx, :]) for idx in sets], rel=1e-10)
+
+
+def test_energy_many_labels():
+	data = _data()
+	np.random.seed(0)
+	labels = multiplet(data, 3)
+	energies = energy_many(data, labels=labels)
+	assert energies == pytest.approx([energy(data, data[labels == j, :]) for j in range(3)], rel=1e-10)
+
+
+def test_energy_many_mixes_unsigned_and_signed_indices():
+	data = _data()
+	twins = twin(data, 4, u1=2)
+	assert twins.dtype == np.uint64
+
+	expected = [energy(data, data[twins, :]), energy(data, data[:10, :])]
+	assert energy_many(data, [twins, np.arange(10)]) == pytest.approx(expected, rel=1e-10)
+	assert TwinningIndex(data).energy([twins, np.arange(10)]) == pytest.approx(expected, rel=1e-10)
+
+
+def test_energy_many_rejects_invalid_sets():
+	data = _data()
+	for sets in ([np.arange(10), np.array([1500])], [np.array([-1, 2])], [np.array([0.0, 1.0])], [np.arange(10), np.array([], dtype=int)]):
+		with pytest.raises(Exception):
+			energy_many(data, sets)
+
+
+def _two_sample_statistic(a, b):
+	pooled = np.vstack((a, b))
+	pooled = (pooled - pooled.mean(axis=0)) / pooled.std(axis=0)
+	distances = np.sqrt(((pooled[:, None, :] - pooled[None, :, :]) ** 2).sum(axis=2))
+	n, m = a.shape[0], b.shape[0]
+	e = 2 * distances[:n, n:].mean() - distances[:n, :n].mean() - distances[n:, n:].mean()
+	return e * n * m / (n + m)
+
+
+def test_energy_test_statistic():
+	a = _data(300, seed=1)
+	b = _data(200, seed=2) + 0.3
+	np.random.seed(0)
+	statistic, p_value = energy_test(a, b, n_permutations=99)
+	assert statistic == pytest.approx(_two_sample_statistic(a, b), rel=1e-10)
+	assert p_value == pytest.approx(0.01)
+
+
+def test_energy_test_same_distribution():
+	a = _data(300, seed=1)
+	b = _data(200, seed=2)
+	np.random.seed(0)
+	_, p_value = energy_test(a, b, n_permutations=99)
+	assert p_value > 0.05
+
+
+def test_energy_test_does_not_depend_on_threads():
+	a = _data(300, seed=1)
+	b = _data(200, seed=2)
+	np.random.seed(0)
+	statistic, p_value = energy_test(a, b, n_permutations=49, n_jobs=1)
+	np.random.seed(0)
+	assert energy_test(a, b, n_permutations=49, n_jobs=3) == pytest.approx((statistic, p_value), rel=1e-10)
+
+
+def test_energy_test_rejects_empty_samples():
+	with pytest.raises(Exception):
+		energy_test(_data()[:0, :], _data())
+
+	with pytest.raises(Exception):
+		energy_test(_data(), _data()[:0, :])
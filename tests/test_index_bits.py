@@ -0,0 +1,94 @@
+import os
+import subprocess
+import sys
+
+# the results of every function that builds a kd-tree, printed in full, and those of the structures that keep one after saving and loading them
+_SCRIPT = """
+import sys
+import numpy as np
+from twinning import twin, twin_batch, compress, pyramid, multiplet, TwinningIndex, TwinningPartition, TwinningWindow, TwinningCoreset
+
+def show(name, *values):
+	print(name, [np.asarray(value).tolist() for value in values])
+
+path = sys.argv[1]
+data = np.random.default_rng(0).normal(size=(3000, 3))
+labels = np.random.default_rng(1).choice(3, size=3000, p=[0.6, 0.3, 0.1])
+show("twin", twin(data, 4, u1=0))
+show("leaf_order", twin(data, 4, u1=0, leaf_order=True, warm_start=True, prefetch=4))
+show("collapsed", twin(np.round(data), 4, u1=0, collapse_duplicates=True))
+show("stratified", twin(data, 4, u1=0, stratify=labels))
+np.random.seed(0)
+show("batch", *twin_batch(data, [0, 1000, 3000], 3))
+show("compress", compress(data, 700, u1=0))
+np.random.seed(0)
+show("pyramid", pyramid(data, 4))
+for strategy, k in ((1, 3), (2, 4), (3, 5)):
+	np.random.seed(0)
+	show("multiplet", multiplet(data, k, strategy=strategy))
+	np.random.seed(0)
+	show("stratified multiplet", multiplet(data, k, strategy=strategy, stratify=labels))
+
+index = TwinningIndex(data)
+np.random.seed(0)
+show("index", index.twin(5, u1=1), index.multiplet(4, strategy=2), index.multiplet(3, strategy=3))
+
+partition = TwinningPartition(data, labels)
+show("partition", partition.assign(np.random.default_rng(2).normal(size=(500, 3))))
+
+window = TwinningWindow(data, 4, u1=0)
+window.insert(np.random.default_rng(3).normal(size=(500, 3)))
+window.remove(np.arange(2000))
+show("window", window.selected)
+
+np.random.seed(0)
+show("coreset", *TwinningCoreset(100).extend(np.array_split(data, 7)).coreset())
+
+if path == "save":
+	index.save("index.twin")
+	partition.save("partition.twin")
+else:
+	loaded = TwinningIndex.load("index.twin", verify=True)
+	np.random.seed(0)
+	show("loaded index", loaded.twin(5, u1=1), loaded.multiplet(4, strategy=2), loaded.multiplet(3, strategy=3))
+	loaded = TwinningPartition.load("partition.twin", verify=True)
+	show("loaded partition", loaded.labels, loaded.assign(np.random.default_rng(4).normal(size=(100, 3))))
+"""
+
+
+def _run(bits, mode, cwd):
+	env = dict(os.environ)
+	if bits is None:
+		env.pop("TWINNING_INDEX_BITS", None)
+	else:
+		env["TWINNING_INDEX_BITS"] = bits
+	env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] + sys.path)
+	return subprocess.run([sys.executable, "-c", _SCRIPT, mode], env=env, cwd=str(cwd), capture_output=True, text=True)
+
+
+def test_index_widths_give_the_same_results(tmp_path):
+	compact = _run(None, "save", tmp_path)
+	assert compact.returncode == 0 and "Warning" not in compact.stderr, compact.stderr
+
+	wide = _run("64", "save", tmp_path)
+	assert wide.returncode == 0 and "Warning" not in wide.stderr, wide.stderr
+	assert wide.stdout == compact.stdout
+
+
+def test_saved_files_do_not_depend_on_the_index_width(tmp_path):
+	# files written with 32-bit indices are loaded with 64-bit ones, and vice versa
+	assert _run("32", "save", tmp_path).returncode == 0
+	wide = _run("64", "load", tmp_path)
+	assert wide.returncode == 0, wide.stderr
+
+	assert _run("64", "save", tmp_path).returncode == 0
+	compact = _run("32", "load", tmp_path)
+	assert compact.returncode == 0, compact.stderr
+	assert compact.stdout == wide.stdout
+
+
+def test_unknown_width_is_ignored_with_a_warning(tmp_path):
+	result = _run("16", "save", tmp_path)
+	assert result.returncode == 0, result.stderr
+	assert "RuntimeWarning" in result.stderr and "TWINNING_INDEX_BITS=16" in result.stderr
+	assert result.stdout == _run(None, "save", tmp_path).stdout
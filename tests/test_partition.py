@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from twinning import twin, TwinningPartition
+
+
+def _data(N=3000, d=3, seed=0):
+	return np.random.default_rng(seed).normal(size=(N, d))
+
+
+def _partition(data, r=4):
+	labels = np.zeros(data.shape[0], dtype=int)
+	labels[twin(data, r, u1=0)] = 1
+	return TwinningPartition(data, labels), labels
+
+
+def test_assign_keeps_proportions():
+	data = _data()
+	partition, labels = _partition(data)
+	assigned = partition.assign(_data(2000, seed=1))
+
+	assert len(partition) == 5000
+	assert np.array_equal(partition.labels[:3000], labels)
+	assert np.array_equal(partition.labels[3000:], assigned)
+	assert abs(np.mean(assigned == 1) - np.mean(labels == 1)) < 0.01
+
+
+def test_drift_of_rows_from_the_same_distribution():
+	partition, _ = _partition(_data())
+	assert partition.drift == 1.0
+
+	partition.assign(_data(2000, seed=1))
+	assert 0.9 < partition.drift < 1.1
+
+	# rows already assigned do not make later rows look closer
+	partition.assign(_data(6000, seed=2))
+	assert 0.9 < partition.drift < 1.1
+
+
+def test_drift_of_shifted_rows():
+	partition, _ = _partition(_data())
+	partition.assign(3.0 * _data(2000, seed=1))
+	assert partition.drift > 1.5
+
+
+def test_duplicated_data_is_rejected():
+	data = np.repeat(_data(100), 2, axis=0)
+	with pytest.raises(Exception):
+		TwinningPartition(data, np.arange(200) % 2)
+
+
+def test_save_load_round_trip(tmp_path):
+	partition, _ = _partition(_data())
+	partition.assign(_data(500, seed=1))
+	path = str(tmp_path / "partition.twin")
+	partition.save(path)
+
+	loaded = TwinningPartition.load(path, verify=True)
+	assert len(loaded) == len(partition)
+	assert np.array_equal(loaded.labels, partition.labels)
+	assert loaded.drift == partition.drift
+
+	rows = _data(500, seed=2)
+	assert np.array_equal(loaded.assign(rows), partition.assign(rows))
+	assert np.array_equal(loaded.labels, partition.labels)
+	assert loaded.drift == pytest.approx(partition.drift, rel=1e-12)
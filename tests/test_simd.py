@@ -0,0 +1,64 @@
+import os
+import subprocess
+import sys
+import pytest
+from twinning import get_simd
+
+_LEVELS = ["scalar", "sse2", "avx2", "avx512f"]
+
+# twins and energy distances of rows of fewer and more than 8 columns, printed with every digit
+_SCRIPT = """
+import numpy as np
+from twinning import twin, multiplet, energy, energy_many, get_simd
+print(get_simd())
+for d in (3, 8, 13):
+	data = np.random.default_rng(d).normal(size=(1500, d))
+	idx = twin(data, 4, u1=0)
+	np.random.seed(0)
+	ids = multiplet(data, 4, strategy=2)
+	print(idx.tolist(), ids.tolist())
+	print(repr(energy(data, data[idx, :])), [repr(e) for e in energy_many(data, labels=ids)])
+"""
+
+
+def _run(level):
+	env = dict(os.environ)
+	if level is None:
+		env.pop("TWINNING_SIMD", None)
+	else:
+		env["TWINNING_SIMD"] = level
+	result = subprocess.run([sys.executable, "-c", _SCRIPT], env=env, capture_output=True, text=True)
+	return result.returncode, result.stdout, result.stderr
+
+
+def test_get_simd():
+	assert get_simd() in _LEVELS
+
+
+def test_levels_give_the_same_results():
+	returncode, expected, stderr = _run("scalar")
+	assert returncode == 0, stderr
+	assert expected.splitlines()[0] == "scalar"
+
+	widest = _LEVELS.index(_run(None)[1].splitlines()[0])
+	for level in _LEVELS[1:widest + 1]:
+		returncode, output, stderr = _run(level)
+		assert returncode == 0 and "Warning" not in stderr, stderr
+		assert output.splitlines()[0] == level
+		assert output.splitlines()[1:] == expected.splitlines()[1:]
+
+
+def test_wider_level_than_the_processor_is_narrowed():
+	if get_simd() == "avx512f":
+		pytest.skip("no instruction set is wider than that of the processor")
+
+	returncode, output, stderr = _run("avx512f")
+	assert returncode == 0, stderr
+	assert output.splitlines()[0] == _run(None)[1].splitlines()[0]
+
+
+def test_unknown_level_is_ignored_with_a_warning():
+	returncode, output, stderr = _run("avx1024")
+	assert returncode == 0, stderr
+	assert "RuntimeWarning" in stderr and "TWINNING_SIMD=avx1024" in stderr
+	assert output == _run(None)[1]
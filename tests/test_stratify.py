@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from twinning import twin, multiplet
+
+
+def _data(N=3000, d=3, seed=0):
+	rng = np.random.default_rng(seed)
+	return rng.normal(size=(N, d)), rng.choice(4, size=N, p=[0.5, 0.3, 0.199, 0.001])
+
+
+def test_single_stratum_matches_twin():
+	data, _ = _data()
+	assert np.array_equal(twin(data, 5, u1=9, stratify=np.zeros(data.shape[0])), twin(data, 5, u1=9))
+
+
+@pytest.mark.parametrize("r", [2, 5])
+def test_stratified_twin_sizes(r):
+	data, labels = _data()
+	idx = twin(data, r, u1=9, stratify=labels)
+
+	assert len(np.unique(idx)) == len(idx)
+	assert 9 in idx
+	for s in range(4):
+		N_s = np.sum(labels == s)
+		assert np.sum(labels[idx] == s) == (1 if N_s <= r else -(-N_s // r))
+
+	# the indices are returned group by group in the sorted order of the labels
+	assert np.all(np.diff(labels[idx]) >= 0)
+
+
+def test_stratified_twin_is_deterministic():
+	data, labels = _data()
+	expected = twin(data, 3, u1=5, stratify=labels, n_jobs=1)
+	assert np.array_equal(twin(data, 3, u1=5, stratify=labels, n_jobs=3), expected)
+	assert np.array_equal(twin(data, 3, u1=5, stratify=labels.astype(str)), expected)
+
+
+def test_stratified_collapsed_twin():
+	data, labels = _data()
+	data = np.round(data)
+	idx = twin(data, 4, u1=0, stratify=labels, collapse_duplicates=True)
+	assert len(np.unique(idx)) == len(idx)
+	for s in range(4):
+		N_s = np.sum(labels == s)
+		assert np.sum(labels[idx] == s) == (1 if N_s <= 4 else -(-N_s // 4))
+
+
+@pytest.mark.parametrize("strategy, k", [(1, 3), (2, 4), (3, 5)])
+def test_stratified_multiplet_balance(strategy, k):
+	data, labels = _data()
+	np.random.seed(1)
+	ids = multiplet(data, k, strategy=strategy, stratify=labels)
+
+	assert ids.shape == (data.shape[0],)
+	assert set(np.unique(ids)) == set(range(k))
+	for s in range(4):
+		counts = np.bincount(ids[labels == s], minlength=k)
+		assert counts.max() - counts.min() <= 1
+
+	counts = np.bincount(ids, minlength=k)
+	assert counts.max() - counts.min() <= 4
@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+from twinning import twin, multiplet, energy, TwinningIndex
+
+
+def _data(N=2000, d=3):
+	return np.random.default_rng(0).normal(size=(N, d))
+
+
+def test_twin_matches_twin():
+	data = _data()
+	index = TwinningIndex(data)
+	for r in (2, 5, 11):
+		assert np.array_equal(index.twin(r, u1=7), twin(data, r, u1=7))
+
+
+@pytest.mark.parametrize("strategy, k", [(1, 2), (1, 3), (1, 5), (2, 2), (2, 4), (2, 8), (3, 2), (3, 5)])
+def test_multiplet_matches_multiplet(strategy, k):
+	data = _data()
+	index = TwinningIndex(data)
+
+	np.random.seed(7)
+	expected = multiplet(data, k, strategy=strategy)
+	np.random.seed(7)
+	assert np.array_equal(index.multiplet(k, strategy=strategy), expected)
+
+
+def test_runs_do_not_affect_each_other():
+	data = _data()
+	index = TwinningIndex(data)
+	first = index.twin(4, u1=3)
+	index.multiplet(4, strategy=2)
+	assert np.array_equal(index.twin(4, u1=3), first)
+
+
+def test_energy_matches_energy():
+	data = _data()
+	index = TwinningIndex(data)
+	idx = twin(data, 5, u1=0)
+	assert index.energy(idx) == pytest.approx(energy(data, data[idx, :]))
+
+
+def _corrupt(path, offset):
+	with open(path, "r+b") as file:
+		file.seek(offset)
+		byte = file.read(1)
+		file.seek(offset)
+		file.write(bytes([byte[0] ^ 0xFF]))
+
+
+def test_save_load_round_trip(tmp_path):
+	data = _data()
+	data[:, 1] = 4.0
+	index = TwinningIndex(data)
+	path = str(tmp_path / "index.twin")
+	index.save(path)
+
+	for verify in (False, True):
+		loaded = TwinningIndex.load(path, verify=verify)
+		assert len(loaded) == len(index)
+		assert isinstance(loaded._data, np.memmap)
+		assert np.array_equal(loaded._data, index._data)
+		assert np.array_equal(loaded.twin(5, u1=11), index.twin(5, u1=11))
+
+		np.random.seed(3)
+		expected = index.multiplet(4, strategy=2)
+		np.random.seed(3)
+		assert np.array_equal(loaded.multiplet(4, strategy=2), expected)
+
+		idx = index.twin(5, u1=0)
+		assert loaded.energy(idx) == index.energy(idx)
+
+
+def test_corrupted_data_is_detected_on_verify(tmp_path):
+	index = TwinningIndex(_data())
+	path = str(tmp_path / "index.twin")
+	index.save(path)
+
+	with open(path, "rb") as file:
+		offset = file.read().find(index._data.tobytes()[:64])
+	assert offset > 0
+	_corrupt(path, offset + 100)
+
+	TwinningIndex.load(path)
+	with pytest.raises(Exception, match="corrupted"):
+		TwinningIndex.load(path, verify=True)
+
+
+@pytest.mark.parametrize("where", ["table", "tree"])
+def test_corrupted_file_is_rejected(tmp_path, where):
+	index = TwinningIndex(_data())
+	path = str(tmp_path / "index.twin")
+	index.save(path)
+
+	with open(path, "rb") as file:
+		size = len(file.read())
+	_corrupt(path, 64 if where == "table" else size - 1)
+
+	with pytest.raises(Exception, match="corrupted"):
+		TwinningIndex.load(path)
+
+
+def test_foreign_and_truncated_files_are_rejected(tmp_path):
+	path = str(tmp_path / "index.twin")
+	with open(path, "wb") as file:
+		file.write(b"not an index")
+
+	with pytest.raises(Exception, match="not a twinning file"):
+		TwinningIndex.load(path)
+
+	TwinningIndex(_data()).save(path)
+	with open(path, "rb") as file:
+		content = file.read()
+	with open(path, "wb") as file:
+		file.write(content[:len(content) // 2])
+
+	with pytest.raises(Exception, match="corrupted"):
+		TwinningIndex.load(path)
+
+
+def test_other_version_is_rejected(tmp_path, monkeypatch):
+	import twinning.twinning
+
+	path = str(tmp_path / "index.twin")
+	monkeypatch.setattr(twinning.twinning, "_FILE_VERSION", twinning.twinning._FILE_VERSION + 1)
+	TwinningIndex(_data()).save(path)
+	monkeypatch.undo()
+
+	with pytest.raises(Exception, match="version"):
+		TwinningIndex.load(path)
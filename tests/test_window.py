@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from twinning import twin, TwinningWindow
+
+
+def _data(N=2000, d=3, seed=0):
+	return np.random.default_rng(seed).normal(size=(N, d))
+
+
+def test_initial_twins_match_twin():
+	data = _data()
+	window = TwinningWindow(data, 4, u1=3)
+	assert len(window) == 2000
+	assert np.array_equal(window.ids, np.arange(2000))
+	assert np.array_equal(window.selected, np.sort(twin(data, 4, u1=3)))
+
+
+def test_insert_assigns_new_ids():
+	window = TwinningWindow(_data(), 4, u1=3)
+	assert np.array_equal(window.insert(_data(500, seed=1)), np.arange(2000, 2500))
+	assert np.array_equal(window.insert(_data(10, seed=2)), np.arange(2500, 2510))
+	assert len(window) == 2510
+	assert abs(len(window.selected) - len(window) / 4) <= 4
+
+
+def test_sliding_keeps_twins_balanced():
+	window = TwinningWindow(_data(), 5, u1=0)
+	for step in range(1, 8):
+		window.insert(_data(400, seed=step))
+		window.remove(window.ids[:400])
+
+		selected = window.selected
+		assert len(window) == 2000
+		assert np.all(np.diff(selected) > 0)
+		assert np.all(np.isin(selected, window.ids))
+		assert abs(len(selected) - len(window) / 5) <= 5
+
+	assert window.ids.min() == 2800
+
+
+def test_compaction_keeps_the_window():
+	window = TwinningWindow(_data(), 4, u1=3)
+	ids = window.insert(_data(500, seed=1))
+	window.remove(np.arange(2300))
+
+	# the removed rows outnumber those left, hence the window has been compacted
+	assert np.array_equal(window.ids, ids[300:])
+	assert abs(len(window.selected) - 50) <= 1
+	assert np.array_equal(window.insert(_data(5, seed=2)), np.arange(2500, 2505))
+
+
+def test_invalid_removals_are_rejected():
+	window = TwinningWindow(_data(100), 4, u1=3)
+	window.remove([0])
+	with pytest.raises(Exception):
+		window.remove([0])
+	with pytest.raises(Exception):
+		window.remove([100])
+	with pytest.raises(Exception):
+		window.remove(window.ids[:95])
+	assert len(window) == 99
@@ -3,14 +3,42 @@ Data Twinning
 =============
 An efficient implementation of the twinning algorithm proposed in Vakayil and Joseph (2022) for partitioning a dataset into statistically similar twin sets. The algorithm is orders of magnitude faster than the ``SPlit`` algorithm proposed in Joseph and Vakayil (2021) for optimally splitting a dataset into training and testing sets, and the ``support points`` algorithm of Mak and Joseph (2018) for subsampling from Big Data.
 
-The module provides functions ``twin()``, ``multiplet()``, and ``energy()``. 
+The module provides functions ``twin()``, ``twin_batch()``, ``compress()``, ``pyramid()``, ``multiplet()``, ``energy()``, ``energy_chunked()``, ``energy_many()``, and ``energy_test()``, and the classes ``EnergyTracker``, ``TwinningIndex``, ``TwinningPartition``, ``TwinningWindow``, and ``TwinningCoreset``. 
 
-- ``twin()`` partitions datasets into statistically similar disjoint sets, termed as *twins*. The twins themselves are statistically similar to the original dataset (Vakayil and Joseph, 2022). Such a partition can be employed for optimal training and testing of statistical and machine learning models (Joseph and Vakayil, 2021). The twins can be of unequal size; for tractable model building on large datasets, the smaller twin can serve as a compression (lossy) of the original dataset. 
+- ``twin()`` partitions datasets into statistically similar disjoint sets, termed as *twins*. The twins themselves are statistically similar to the original dataset (Vakayil and Joseph, 2022). Such a partition can be employed for optimal training and testing of statistical and machine learning models (Joseph and Vakayil, 2021). The twins can be of unequal size; for tractable model building on large datasets, the smaller twin can serve as a compression (lossy) of the original dataset. With ``collapse_duplicates=True``, exact duplicate rows are twinned as weighted unique rows, in time proportional to the number of distinct rows, and with ``stratify``, the groups of rows sharing a label, e.g., a class, are twinned concurrently, preserving the proportions of the labels. With ``output="sorted"`` or ``output="mask"``, the smaller twin is returned as sorted indices in the smallest unsigned integer type that fits, or as a bitmask of one bit per row. 
 
-- ``multiplet()`` is an extension of ``twin()`` to generate multiple disjoint partitions that can be used for *k*-fold cross validation, or with divide-and-conquer procedures. 
+- ``twin_batch()`` twins each of many small datasets, such as the records of every customer, in a single parallel call, taking the datasets as segments of rows of a single matrix.
+
+- ``compress()`` selects a representative subset of exactly ``n`` rows for any ``n``, by twinning with a fractional ratio.
+
+- ``pyramid()`` builds nested representative subsets of halving sizes, *N*/2, *N*/4, and so on, by repeated twinning, and labels each row with the smallest subset that contains it.
+
+- ``multiplet()`` is an extension of ``twin()`` to generate multiple disjoint partitions that can be used for *k*-fold cross validation, or with divide-and-conquer procedures. It takes the same ``stratify`` option as ``twin()``. With ``output="compact"``, the multiplet ids take the smallest unsigned integer type that holds ``k`` - 1, e.g., one byte per row for ``k`` <= 256, and with ``output="sorted"``, the rows are returned grouped by multiplet. 
 
 - ``energy()`` computes the energy distance (Székely and Rizzo, 2013) between a given dataset and a set of points, which is the metric minimized by twinning.
 
+- ``energy_chunked()`` computes the same energy distance as ``energy()`` while streaming the dataset in chunks, for datasets that do not fit in memory.
+
+- ``energy_many()`` computes the energy distances between a dataset and several sets of its rows, such as the multiplets from ``multiplet()``, in a single pass over the dataset.
+
+- ``energy_test()`` performs a two-sample permutation test of whether two datasets, such as a pair of twins, come from the same distribution.
+
+- ``EnergyTracker`` maintains the energy distance between a given dataset and a set of points that changes over time, updating it at a cost linear in the number of rows for every added or removed point.
+
+- ``TwinningIndex`` holds a scaled dataset and a reusable *kd*-tree over it, so that repeated calls of ``twin()``, ``multiplet()``, and ``energy()`` on the same dataset skip the preprocessing and the tree construction. An index can be saved to a file with ``save()``, and memory-mapped by other processes with ``TwinningIndex.load()``.
+
+- ``TwinningPartition`` extends twins or multiplets to rows that arrive later, assigning each new row in amortized logarithmic time based on its nearest rows while keeping the proportions of the parts, and measures the drift of the new rows from the original dataset.
+
+- ``TwinningWindow`` maintains the twins of a sliding window of rows as rows enter and expire, repairing the twins locally instead of twinning the window again.
+
+- ``TwinningCoreset`` compresses a stream of chunks that does not fit in memory into a weighted representative sample of a fixed size, by merging and reducing twinned blocks in memory logarithmic in the length of the stream.
+
+The number of threads used by the parallel functions can be set per call with ``n_jobs``, for the whole process with ``set_num_threads()``, or within a ``with`` block using the ``num_threads()`` context manager.
+
+Distances are computed with the widest vector instructions of the processor among SSE2, AVX2, and AVX-512, detected when the module is imported and reported by ``get_simd()``, with the same results on every processor; the environment variable ``TWINNING_SIMD`` can restrict them to a narrower instruction set, or to ``scalar`` code.
+
+The leaves of every *kd*-tree refer to the rows by 32-bit indices, which halves their memory, as long as the rows fit them, and by 64-bit indices otherwise; the structures that keep a tree, such as ``TwinningPartition``, switch to 64-bit indices once they grow past 2^32 - 1 rows. The results and the saved files do not depend on the width of the indices, and the environment variable ``TWINNING_INDEX_BITS=64`` sets 64-bit indices in every tree.
+
 This work is supported by U.S. National Science Foundation grants **DMREF-1921873** and **CMMI-1921646**.
 
 References
@@ -24,4 +52,5 @@ Mak, S. & Joseph, V. R. (2018). Support Points. Annals of Statistics, 46, 2562-2
 Székely, G. J., & Rizzo, M. L. (2013). Energy statistics: A class of statistics based on distances. Journal of statistical planning and inference, 143(8), 1249-1272.
 """
 
-from .twinning import twin, multiplet, energy
\ No newline at end of file
+from .twinning import twin, twin_batch, compress, pyramid, multiplet, energy, energy_chunked, energy_many, energy_test, EnergyTracker, TwinningIndex, TwinningPartition, TwinningWindow, TwinningCoreset
+from .twinning import set_num_threads, get_num_threads, num_threads, get_simd
\ No newline at end of file
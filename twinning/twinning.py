@@ -1,6 +1,132 @@
-from twinning_cpp import twin_cpp, multiplet_S3_cpp, energy_cpp
+from twinning_cpp import twin_cpp, twin_collapsed_cpp, twin_stratified_cpp, twin_batch_cpp, compress_cpp, pyramid_cpp, multiplet_stratified_cpp, group_labels_cpp, multiplet_S3_cpp, TwinningIndex_cpp, TwinningPartition_cpp, TwinningWindow_cpp, energy_cpp, energy_tree_cpp, energy_sliced_cpp, energy_test_cpp, energy_many_cpp, EnergyTracker_cpp
+from twinning_cpp import cross_distance_sum_cpp, pairwise_distance_sum_cpp, max_threads_cpp, simd_cpp
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import contextlib
+import threading
+import struct
+import zlib
 import math
+import os
+
+
+_num_threads = None
+_thread_local = threading.local()
+
+
+def _threads(n_jobs):
+	if n_jobs is None:
+		n_jobs = getattr(_thread_local, "n_jobs", None)
+
+	if n_jobs is None:
+		n_jobs = _num_threads
+
+	if n_jobs is None:
+		return 0
+
+	if not isinstance(n_jobs, (int, np.integer)) or n_jobs == 0:
+		raise Exception("n_jobs should be a non-zero integer or None")
+
+	if n_jobs < 0:
+		return max(os.cpu_count() + 1 + n_jobs, 1)
+
+	return int(n_jobs)
+
+
+def set_num_threads(n_jobs):
+	"""
+	**Descritpion**
+
+	``set_num_threads()`` sets the process-wide default number of threads used by the parallel functions of the module.
+
+	**Parameters**
+
+	``n_jobs`` ( int ): number of threads; negative values count back from the number of CPUs, e.g., -1 uses all CPUs and -2 all but one; ``None`` restores the OpenMP default
+
+	**Details**
+
+	The number of threads of a call is determined, in order of precedence, by its ``n_jobs`` argument, the innermost enclosing ``num_threads()`` context in the calling thread, the value set by ``set_num_threads()``, and finally the OpenMP default. The OpenMP default follows the ``OMP_NUM_THREADS`` environment variable and the limits set by threadpoolctl, so that twinning cooperates with such limits unless a number of threads is requested explicitly.
+
+	"""
+
+	global _num_threads
+	_threads(n_jobs)
+	_num_threads = n_jobs
+
+
+def get_num_threads():
+	"""
+	**Descritpion**
+
+	``get_num_threads()`` returns the number of threads that a parallel function of the module would use if called from the current thread without an ``n_jobs`` argument.
+
+	**Returns**
+
+	( int ): number of threads
+
+	"""
+
+	n_threads = _threads(None)
+	return n_threads if n_threads > 0 else max_threads_cpp()
+
+
+def get_simd():
+	"""
+	**Descritpion**
+
+	``get_simd()`` returns the vector instruction set used by the distance computations of the module.
+
+	**Returns**
+
+	( str ): one of ``"avx512f"``, ``"avx2"``, ``"sse2"``, and ``"scalar"``
+
+	**Details**
+
+	The instruction set is the widest one supported by the processor, as reported by CPUID when the module is imported, unless the environment variable ``TWINNING_SIMD`` names a narrower one, i.e., "scalar", "sse2", "avx2", or "avx512f"; any other value is ignored, with a ``RuntimeWarning`` on import. Every instruction set adds the squared differences of the columns in the same order, and no multiply-add is fused, so that twins and energy distances do not depend on the processor. Rows of fewer than 8 columns are compared column by column, as in earlier versions of the module; the distances from a row to many rows, as in ``energy()``, are then computed for several rows at once.
+
+	"""
+
+	return simd_cpp()
+
+
+@contextlib.contextmanager
+def num_threads(n_jobs):
+	"""
+	**Descritpion**
+
+	``num_threads()`` is a context manager that sets the number of threads used by the parallel functions of the module within a ``with`` block. The setting applies only to the thread that enters the block, so that concurrent workers of a service can use different limits.
+
+	**Parameters**
+
+	``n_jobs`` ( int ): number of threads, as in ``set_num_threads()``
+
+	"""
+
+	_threads(n_jobs)
+	previous = getattr(_thread_local, "n_jobs", None)
+	_thread_local.n_jobs = n_jobs
+	try:
+		yield
+	finally:
+		_thread_local.n_jobs = previous
+
+
+def _check_array(array, name):
+	if type(array) != np.ndarray or len(array.shape) != 2:
+		raise Exception(f"{name} is expected to be a 2 dimensional numpy ndarray")
+
+	if np.isnan(array).any() or np.isinf(array).any():
+		raise Exception(f"{name} cannot contain nan or infinity")
+
+
+def _strata(stratify, N):
+	stratify = np.asarray(stratify)
+	if stratify.ndim != 1 or stratify.shape[0] != N:
+		raise Exception("stratify should be a 1 dimensional array with a label for each row of data")
+
+	_, codes = np.unique(stratify, return_inverse=True)
+	codes = codes.ravel().astype('int64')
+	return codes, int(codes.max()) + 1
 
 
 def _data_format(data):
@@ -14,7 +140,7 @@ def _data_format(data):
 		return np.copy(data, order='C')
 
 
-def twin(data, r, u1=None, leaf_size=8):
+def twin(data, r, u1=None, leaf_size=8, collapse_duplicates=False, stratify=None, n_jobs=None, warm_start=False, prefetch=0, leaf_order=False, output="indices"):
 	"""
 	**Descritpion**
 
@@ -30,13 +156,39 @@ def twin(data, r, u1=None, leaf_size=8):
 
 	``leaf_size`` ( int , optional ): maximum number of elements in the leaf-nodes of the kd-tree
 
+	``collapse_duplicates`` ( bool , optional ): if ``True``, exact duplicate rows are collapsed into weighted unique rows before twinning
+
+	``stratify`` ( array , optional ): a label for each row, e.g., the classes of a classification dataset; if provided, every group of rows with the same label is twinned separately, so that the smaller twin preserves the proportions of the labels
+
+	``n_jobs`` ( int , optional ): number of threads over which the groups of ``stratify`` are distributed; negative values count back from the number of CPUs, e.g., -1 uses all CPUs; if not provided, the setting of ``num_threads()`` or ``set_num_threads()`` is used, or otherwise the OpenMP default
+
+	``warm_start`` ( bool , optional ): if ``True``, each nearest neighbor query of the algorithm starts from the *kd*-tree nodes visited by the previous query rather than from the root; ignored with ``collapse_duplicates`` or ``stratify``
+
+	``prefetch`` ( int , optional ): number of extra neighbors fetched by every search of the *kd*-tree into a pool of candidates, from which later queries are answered without the tree whenever possible; ``0`` disables the pool; ignored with ``collapse_duplicates`` or ``stratify``
+
+	``leaf_order`` ( bool , optional ): if ``True``, a copy of the scaled dataset is stored in the order of the leaves of the *kd*-tree before twinning; ignored with ``collapse_duplicates`` or ``stratify``
+
+	``output`` ( str , optional ): either "indices" for the indices of the smaller twin in the order of their selection, "sorted" for the indices in increasing order and in the smallest unsigned integer type that holds ``data.shape[0]`` - 1, or "mask" for a bitmask of the rows packed 8 per byte
+
 	**Returns**
 
-	( ndarray ): indices of the smaller twin
+	( ndarray ): indices of the smaller twin, or with ``output`` = "mask", an array of ``ceil(data.shape[0] / 8)`` bytes whose bits flag the rows of the smaller twin, as by ``np.packbits()``; ``np.unpackbits(mask, count=data.shape[0]).astype(bool)`` recovers a boolean mask
 
 	**Details**
 
-	Before twinning, constant columns are removed from ``data`` and the remaining are scaled to zero mean and unit standard deviation. Twinning algorithm requires nearest neighbor queries that are performed using a *kd*-tree. The *kd*-tree implementation in the nanoflann (Blanco and Rai, 2014) C++ library is used.
+	Before twinning, constant columns are removed from ``data`` and the remaining are scaled to zero mean and unit standard deviation. Twinning algorithm requires nearest neighbor queries that are performed using a *kd*-tree. The *kd*-tree implementation in the nanoflann (Blanco and Rai, 2014) C++ library is used. For ``r`` >= 32, the neighbors found by a query are kept in a bounded heap rather than a sorted array, so that every row visited by the query costs ``O(log r)`` rather than ``O(r)`` operations, which speeds up twinning with large ``r`` considerably. The leaves of the *kd*-tree refer to the rows by 32-bit indices if ``data.shape[0]`` < 2^32 - 1, which halves their memory, and by 64-bit indices otherwise, or if the environment variable ``TWINNING_INDEX_BITS`` is 64; the twins do not depend on the width of the indices.
+
+	With ``collapse_duplicates``, the rows are hashed to find the groups of exact duplicates, and twinning runs over one row per group, weighted by the size of the group. Each step removes ``r`` rows, as before, counting a unique row as many times as its weight, and a unique row whose weight covers several steps is chosen that many times at once; the chosen unique rows are finally expanded to distinct duplicates. The running time thus depends on the number of distinct rows rather than ``data.shape[0]``, which pays off for data with many duplicates, e.g., discrete or rounded measurements; without duplicates, the hashing is the only overhead.
+
+	With ``stratify``, the rows are grouped by label with a counting sort after scaling the whole dataset, and the groups are twinned concurrently, each with a *kd*-tree of its own, largest first. A group of ``N_s`` rows contributes ``ceil(N_s / r)`` rows, or a single row if ``N_s`` <= ``r``, and the indices are returned group by group in the sorted order of the labels. Twinning starts from ``u1`` in its own group, and from rows drawn with a seed derived from ``u1`` in the others.
+
+	Consecutive queries of the algorithm are close to each other, since each starts from the last row removed by the previous one. With ``warm_start``, the root-to-leaf path of every query is kept for each sub-tree of the *kd*-tree, and the next query starts from the deepest node of the path whose cell contains it. The sibling subtrees along the path are then visited bottom-up, pruned by their distances to the query along the cutting axes, so that the same neighbors are found as in a search from the root; only ties among equidistant rows may be broken differently. The saving grows with the depth of the tree, i.e., with ``data.shape[0]``, and is lost whenever rows are added to the tree.
+
+	Every step of the algorithm requires two searches, one for the ``r`` nearest neighbors of the current row and one for the nearest neighbor of the last of them, where the next step starts. With ``prefetch``, a search of the *kd*-tree for the ``r`` nearest neighbors of a row ``c`` returns ``r + prefetch`` neighbors, all of which lie within a distance ``R`` of ``c``. The pool of these candidates holds every remaining row closer than ``R`` to ``c``, so that the ``k`` nearest remaining rows of a later query ``q`` are found in the pool if the ``k``-th nearest candidate of ``q`` is closer than ``R - |q - c|``; otherwise, the tree is searched, and the pool is replaced by a search for ``r`` neighbors. The same twins are thus returned, up to ties among equidistant rows, with fewer searches of the tree, e.g., about a quarter of them with ``prefetch = 32`` and ``r = 2`` in three dimensions. A query scans the pool in the order of the distances to ``c`` and stops once the remaining candidates cannot be closer than its ``k``-th nearest one, but every replacement of the pool is a larger search. The pool thus pays off for one dimensional data, e.g., twinning is 1.3 to 1.8 times faster with ``prefetch = 8`` and ``r`` = 2 or 3, whereas in two or more dimensions the searches it saves do not make up for the larger ones, and twinning is slower; it is therefore disabled by default. In higher dimensions, distances concentrate and ``R - |q - c|`` rarely exceeds the distances to the nearest candidates.
+
+	The leaves of the *kd*-tree hold the indices of their rows, which are scattered over the dataset, so that the distances computed in a leaf read rows from distant locations in memory. With ``leaf_order``, the rows are renumbered in the order of the leaves once the tree is built, and copied in that order, so that the rows of a leaf are contiguous; the indices are mapped back to the rows of ``data`` only when returned. The same twins are returned, at the cost of a second copy of the scaled dataset. The gain grows with ``data.shape[0]``, as the dataset outgrows the processor caches.
+
+	The indices are encoded by the C++ extension itself, without an intermediate array of 64-bit integers. With ``output`` = "sorted", they take 1, 2, 4, or 8 bytes each, e.g., 4 bytes for up to about 4.3 billion rows, and with ``output`` = "mask", a single bit per row of ``data``, which is smaller than the indices whenever ``r`` < 64 and persists the split of a dataset of 1 billion rows in 125 MB.
 
 	**References**
 
@@ -62,11 +214,146 @@ def twin(data, r, u1=None, leaf_size=8):
 	if r not in range(2, math.floor(data.shape[0] / 2) + 1):
 		raise Exception("r should be an integer such that 2 <= r <= data.shape[0]/2")
 	
+	if prefetch not in range(data.shape[0]):
+		raise Exception("prefetch should be an integer such that 0 <= prefetch < data.shape[0]")
+
+	if output not in ("indices", "sorted", "mask"):
+		raise Exception("output should be either \"indices\", \"sorted\", or \"mask\"")
+
+	if stratify is not None:
+		codes, n_strata = _strata(stratify, data.shape[0])
+		data = _data_format(data)
+		return twin_stratified_cpp(data, codes, n_strata, r, u1, u1, leaf_size, collapse_duplicates, _threads(n_jobs), output)
+
+	data = _data_format(data)
+	if collapse_duplicates:
+		return twin_collapsed_cpp(data, r, u1, leaf_size, output)
+
+	return twin_cpp(data, r, u1, leaf_size, warm_start, prefetch, leaf_order, output)
+
+
+def twin_batch(data, offsets, r, leaf_size=8, n_jobs=None):
+	"""
+	**Descritpion**
+
+	``twin_batch()`` applies ``twin()`` to each of many datasets in a single call, e.g., the records of every customer or sensor. The datasets are passed as segments of rows of a single matrix, and are twinned in parallel.
+
+	**Parameters**
+
+	``data`` ( ndarray ): the datasets stacked on top of each other, with the same columns; should not contain nan or infinity
+
+	``offsets`` ( array ): the row offsets of the datasets in ``data``, starting at 0 and ending at ``data.shape[0]``, i.e., dataset ``s`` consists of the rows ``offsets[s]`` to ``offsets[s + 1] - 1``
+
+	``r`` ( int ): an integer representing the inverse of the splitting ratio, as in ``twin()``
+
+	``leaf_size`` ( int , optional ): maximum number of elements in the leaf-nodes of the kd-tree
+
+	``n_jobs`` ( int , optional ): number of threads; negative values count back from the number of CPUs, e.g., -1 uses all CPUs; if not provided, the setting of ``num_threads()`` or ``set_num_threads()`` is used, or otherwise the OpenMP default
+
+	**Returns**
+
+	( ndarray , ndarray ): row indices into ``data`` of the smaller twins of all datasets, one after the other, and the offsets of the twins in them, i.e., the smaller twin of dataset ``s`` consists of the indices at positions ``offsets[s]`` to ``offsets[s + 1] - 1``
+
+	**Details**
+
+	Each dataset is scaled to zero mean and unit standard deviation on its own, as in ``twin()``, except that its constant columns are set to zero rather than removed, which does not change any distance. Twinning starts from a random row of each dataset. A dataset of ``N_s`` rows contributes ``ceil(N_s / r)`` rows to the result, or a single row if ``N_s`` <= ``r``, and an empty dataset contributes none.
+
+	"""
+
+	_check_array(data, "data")
+
+	offsets = np.asarray(offsets)
+	if offsets.ndim != 1 or len(offsets) < 2 or not np.issubdtype(offsets.dtype, np.integer) or offsets[0] != 0 or offsets[-1] != data.shape[0] or np.any(np.diff(offsets) < 0):
+		raise Exception("offsets should be a non-decreasing array of integers from 0 to data.shape[0]")
+
+	if not isinstance(r, (int, np.integer)) or r < 2:
+		raise Exception("r should be an integer such that r >= 2")
+
+	indices, twin_offsets = twin_batch_cpp(np.ascontiguousarray(data, dtype='float64'), offsets.tolist(), r, np.random.randint(2**31), leaf_size, _threads(n_jobs))
+	return np.array(indices, dtype='uint64'), np.array(twin_offsets, dtype='uint64')
+
+
+def compress(data, n, u1=None, leaf_size=8):
+	"""
+	**Descritpion**
+
+	``compress()`` selects exactly ``n`` rows of a dataset that are distributed similar to the whole dataset, for any ``n`` from 1 to ``data.shape[0]``, unlike ``twin()``, whose smaller twin has about ``data.shape[0] / r`` rows for an integer ``r``.
+
+	**Parameters**
+
+	``data`` ( ndarray ): the dataset including both the predictors and response(s); should not contain nan or infinity
+
+	``n`` ( int ): number of rows to select
+
+	``u1`` ( int , optional ): index of the data point from where twinning starts; if not provided, a random point is chosen from the dataset; fixing ``u1`` makes the algorithm deterministic
+
+	``leaf_size`` ( int , optional ): maximum number of elements in the leaf-nodes of the kd-tree
+
+	**Returns**
+
+	( ndarray ): indices of the ``n`` selected rows
+
+	**Details**
+
+	The dataset is scaled as in ``twin()``, and the twinning walk runs with the fractional ratio ``N / n``, where ``N`` = ``data.shape[0]``: step ``t`` = 0, ..., ``n`` - 1 removes the ``round((t + 1) N / n) - round(t N / n)`` nearest rows, which is either ``floor(N / n)`` or ``ceil(N / n)``, and selects the first of them. If ``N`` is a multiple of ``n``, the selected rows are the smaller twin from ``twin()`` with ``r`` = ``N / n`` and the same ``u1``.
+
+	"""
+
+	_check_array(data, "data")
+
+	if u1 is None:
+		u1 = np.random.randint(data.shape[0])
+	elif u1 not in range(data.shape[0]):
+		raise Exception("u1 should be a row index such that 0 <= u1 < data.shape[0]")
+
+	if n not in range(1, data.shape[0] + 1):
+		raise Exception("n should be an integer such that 1 <= n <= data.shape[0]")
+
+	data = _data_format(data)
+	return np.array(compress_cpp(data, n, u1, leaf_size), dtype='uint64')
+
+
+def pyramid(data, levels, leaf_size=8):
+	"""
+	**Descritpion**
+
+	``pyramid()`` builds nested representative subsets of a dataset with about ``N / 2``, ``N / 4``, ..., ``N / 2^levels`` rows, where ``N`` = ``data.shape[0]``, each of which is a subset of the one before, e.g., for training models at several data budgets.
+
+	**Parameters**
+
+	``data`` ( ndarray ): the dataset including both the predictors and response(s); should not contain nan or infinity
+
+	``levels`` ( int ): number of halvings, from 1 to 255
+
+	``leaf_size`` ( int , optional ): maximum number of elements in the leaf-nodes of the kd-tree
+
+	**Returns**
+
+	( ndarray ): array of type uint8 with the level of each row in data, i.e., the number of halvings that it survives; the subset at level ``l`` consists of the rows whose level is at least ``l``, e.g., ``np.flatnonzero(levels >= l)``
+
+	**Details**
+
+	The dataset is scaled once, as in ``twin()``, and every halving keeps the smaller twin from twinning the rows of the previous level with ``r`` = 2, starting from a random row; the subset at level ``l`` thus has ``ceil(N / 2^l)`` rows. The halving stops early once at most 2 rows are left.
+
+	"""
+
+	_check_array(data, "data")
+
+	if levels not in range(1, 256):
+		raise Exception("levels should be an integer such that 1 <= levels <= 255")
+
 	data = _data_format(data)
-	return np.array(twin_cpp(data, r, u1, leaf_size), dtype='uint64')
+	return np.array(pyramid_cpp(data, levels, np.random.randint(2**31), leaf_size), dtype='uint8')
+
+
+def _multiplet_output(labels, k, output):
+	if output == "sorted":
+		return group_labels_cpp(labels, k)
+
+	return labels
 
 
-def multiplet(data, k, strategy=1, leaf_size=8):
+def multiplet(data, k, strategy=1, leaf_size=8, stratify=None, n_jobs=None, output="labels"):
 	"""
 	**Descritpion**
 
@@ -82,9 +369,21 @@ def multiplet(data, k, strategy=1, leaf_size=8):
 
 	``leaf_size`` ( int , optional ): maximum number of elements in the leaf-nodes of the kd-tree
 
+	``stratify`` ( array , optional ): a label for each row; if provided, every group of rows with the same label is partitioned separately, so that each multiplet preserves the proportions of the labels
+
+	``n_jobs`` ( int , optional ): number of threads over which the groups of ``stratify`` are distributed, as in ``twin()``
+
+	``output`` ( str , optional ): either "labels" for 64-bit multiplet ids, "compact" for the multiplet ids in the smallest unsigned integer type that holds ``k`` - 1, or "sorted" for the rows grouped by multiplet
+
 	**Returns**
 
-	( ndarray ): array with the multiplet id, ranging from 0 to ``k`` - 1, for each row in data
+	( ndarray ): array with the multiplet id, ranging from 0 to ``k`` - 1, for each row in data; with ``output`` = "sorted", a tuple of the row indices sorted by multiplet, in the smallest unsigned integer type that holds ``data.shape[0]`` - 1, and the offsets of the multiplets, such that the rows of multiplet ``j`` are ``indices[offsets[j]:offsets[j + 1]]``
+
+	**Details**
+
+	With ``stratify``, the groups are partitioned concurrently under the given strategy, and a group of at most ``k`` rows puts each row in a different multiplet. Under strategy 2, a group of fewer than ``2k`` rows, for which the repeated halving could leave some multiplets empty, is partitioned as under strategy 3. The multiplet ids of each group are rotated by the number of rows in the groups before it, modulo ``k``, so that the groups whose size is not a multiple of ``k`` do not all put their extra rows in the same multiplets.
+
+	The multiplet ids are written directly into an array of the type given by ``output``, e.g., a single byte per row for ``k`` <= 256 with ``output`` = "compact", an eighth of the memory of "labels". With ``output`` = "sorted", the rows are then grouped by a counting sort over the ids, in time linear in ``data.shape[0]``.
 
 	**References**
 
@@ -103,17 +402,34 @@ def multiplet(data, k, strategy=1, leaf_size=8):
 	if k not in range(2, math.floor(data.shape[0] / 2) + 1):
 		raise Exception("k should be an integer such that 2 <= r <= data.shape[0]/2")
 
-	data = _data_format(data)
+	if output not in ("labels", "compact", "sorted"):
+		raise Exception("output should be either \"labels\", \"compact\", or \"sorted\"")
+
 	N = data.shape[0]
+	dtype = 'uint64' if output == "labels" else np.min_scalar_type(k - 1)
+
+	if stratify is not None:
+		if strategy not in (1, 2, 3):
+			raise Exception("strategy should be 1, 2, or 3")
+
+		if strategy == 2 and not (k & (k - 1) == 0):
+			raise Exception("strategy 2 requires k to be a power of 2")
+
+		codes, n_strata = _strata(stratify, data.shape[0])
+		data = _data_format(data)
+		labels = np.empty(N, dtype=dtype)
+		multiplet_stratified_cpp(data, codes, n_strata, k, strategy, np.random.randint(2**31), leaf_size, _threads(n_jobs), labels)
+		return _multiplet_output(labels, k, output)
+
+	data = _data_format(data)
+	labels = np.empty(N, dtype=dtype)
 
 	if strategy == 1:
 		row_index = np.arange(N)
-		folds = np.empty((0, 2))
 		i = 0
 		while True:
-			multiplet_i = np.array(twin_cpp(data, k - i, np.random.randint(data.shape[0]), leaf_size), dtype='uint64')
-			fold = np.hstack((row_index[multiplet_i].reshape(len(multiplet_i), 1), np.repeat(i, len(multiplet_i)).reshape(len(multiplet_i), 1)))
-			folds = np.vstack((folds, fold))
+			multiplet_i = twin_cpp(data, k - i, np.random.randint(data.shape[0]), leaf_size, False, 0, False, "indices")
+			labels[row_index[multiplet_i]] = i
 			
 			negate = np.ones(data.shape[0], bool)
 			negate[multiplet_i] = 0
@@ -121,45 +437,53 @@ def multiplet(data, k, strategy=1, leaf_size=8):
 			row_index = row_index[negate]
 
 			if data.shape[0] <= N / k:
-				fold = np.hstack((row_index.reshape(len(row_index), 1), np.repeat(i + 1, len(row_index)).reshape(len(row_index), 1)))
-				folds = np.vstack((folds, fold))
+				labels[row_index] = i + 1
 				break
 
 			i += 1
 
-		return folds[np.argsort(folds[:, 0]), 1].astype('uint64')
+		return _multiplet_output(labels, k, output)
 
 	if strategy == 2:
 		if not (k & (k - 1) == 0):
 			raise Exception("strategy 2 requires k to be a power of 2")
 
 		row_index = np.arange(N)
-		folds = np.empty((0, 2))
 		i = 0
 
 		def equal_twins(data, row_index):
 			if data.shape[0] <= math.ceil(N / k):
-				nonlocal folds, i
-				fold = np.hstack((row_index.reshape(len(row_index), 1), np.repeat(i, len(row_index)).reshape(len(row_index), 1)))
-				folds = np.vstack((folds, fold))
+				nonlocal i
+				labels[row_index] = i
 				i += 1
 			else:
-				equal_twins_i = np.array(twin_cpp(data, 2, np.random.randint(data.shape[0]), leaf_size), dtype='uint64')
+				equal_twins_i = twin_cpp(data, 2, np.random.randint(data.shape[0]), leaf_size, False, 0, False, "indices")
 				negate = np.ones(data.shape[0], bool)
 				negate[equal_twins_i] = 0
 				equal_twins(data[negate, :], row_index[negate])
 				equal_twins(data[np.invert(negate), :], row_index[np.invert(negate)])
 
 		equal_twins(data, row_index)
-		return folds[np.argsort(folds[:, 0]), 1].astype('uint64')
+		return _multiplet_output(labels, k, output)
 
 	if strategy == 3:
 		sequence = np.array(multiplet_S3_cpp(data, k, np.random.randint(data.shape[0]), leaf_size), dtype='uint64')
-		folds = np.hstack((sequence.reshape(len(sequence), 1), np.tile(np.arange(k), math.ceil(N / k))[0:N].reshape(N, 1)))
-		return folds[np.argsort(folds[:, 0]), 1].astype('uint64')
+		labels[sequence] = np.tile(np.arange(k, dtype=dtype), math.ceil(N / k))[0:N]
+		return _multiplet_output(labels, k, output)
+
 
+def _members(index_sets, N, name):
+	# row indices of several sets, each checked on its own, as the concatenation of unsigned and signed indices would be float64
+	for idx in index_sets:
+		if not np.issubdtype(idx.dtype, np.integer) or idx.min() < 0 or idx.max() >= N:
+			raise Exception(f"{name} should contain row indices such that 0 <= index < data.shape[0]")
 
-def energy(data, points):
+	members = np.concatenate([idx.astype(np.int64) for idx in index_sets])
+	offsets = np.concatenate(([0], np.cumsum([len(idx) for idx in index_sets]))).astype(np.int64)
+	return members, offsets
+
+
+def energy(data, points, method="exact", theta=0.5, n_projections=100, n_jobs=None):
 	"""
 	**Descritpion**
 
@@ -171,6 +495,14 @@ def energy(data, points):
 
 	``points`` ( ndarray ): the set of points for which the energy distance with respect to ``data`` is to be computed; should not contain nan or infinity
 
+	``method`` ( str , optional ): either "exact", "tree" for an approximation using a *kd*-tree code, or "sliced" for an estimate from random one dimensional projections; the latter two scale to very large datasets
+
+	``theta`` ( float , optional ): accuracy parameter of the "tree" method; smaller values are more accurate but slower, and ``theta`` = 0 gives the exact energy distance
+
+	``n_projections`` ( int , optional ): number of random projections used by the "sliced" method
+
+	``n_jobs`` ( int , optional ): number of threads; negative values count back from the number of CPUs, e.g., -1 uses all CPUs; if not provided, the setting of ``num_threads()`` or ``set_num_threads()`` is used, or otherwise the OpenMP default
+
 	**Returns**
 
 	( float ): energy distance
@@ -179,6 +511,10 @@ def energy(data, points):
 
 	Smaller the energy distance, the more statistically similar the set of points is to the given dataset. The minimizer of energy distance is known as support points (Mak and Joseph, 2018), which is the basis for the twinning method. Computing energy distance between ``data`` and ``points`` involves Euclidean distance calculations among the rows of ``data``, among the rows of ``points``, and between the rows of ``data`` and ``points``. Since, ``data`` serves as the reference, the distance calculations among the rows of ``data`` are ignored for efficiency. Before computing the energy distance, the columns of ``data`` are scaled to zero mean and unit standard deviation. The mean and standard deviation of the columns of ``data`` are used to scale the respective columns in ``points``.
 
+	The "exact" method requires O(nN + n²) distance calculations for ``n`` points and ``N`` rows in ``data``. The "tree" method builds *kd*-trees over ``data`` and ``points`` that store the number of rows, centroid, and spread of every node. Sums of distances from a point to the rows of a node are approximated using the centroid of the node, with a second order correction for the spread, whenever the radius of the node is less than ``theta`` times the distance from the point to the centroid (Barnes and Hut, 1986). This reduces the cost to about O((n + N) log N) distance calculations in low dimensions; the savings diminish as the number of columns grows.
+
+	The "sliced" method projects the scaled ``data`` and ``points`` onto ``n_projections`` random directions, and computes the energy distance of every projection exactly in O(N log n) time using sorting. Since the energy distance is linear in the pairwise distances, and the mean absolute projection of a vector onto a random direction is proportional to its length, the average over the projections divided by that constant is an unbiased and consistent estimate of the energy distance. Its memory requirement does not grow with ``N``.
+
 	**References**
 
 	Vakayil, A., & Joseph, V. R. (2022). Data Twinning. Statistical Analysis and Data Mining: The ASA Data Science Journal. https://doi.org/10.1002/sam.11574
@@ -187,6 +523,8 @@ def energy(data, points):
 
 	Mak, S. & Joseph, V. R. (2018). Support Points. Annals of Statistics, 46, 2562-2592.
 
+	Barnes, J., & Hut, P. (1986). A hierarchical O(N log N) force-calculation algorithm. Nature, 324(6096), 446-449.
+
 	"""
 
 	if type(data) != np.ndarray or len(data.shape) != 2:
@@ -204,6 +542,12 @@ def energy(data, points):
 	if data.shape[1] != points.shape[1]:
 		raise Exception("data and points should have the same number of columns")
 
+	if method not in ("exact", "tree", "sliced"):
+		raise Exception("method should be either \"exact\", \"tree\", or \"sliced\"")
+
+	if theta < 0:
+		raise Exception("theta should be non-negative")
+
 	const_cols = np.all(data == data[0, :], axis=0)
 	data = data[:, np.invert(const_cols)]
 	points = points[:, np.invert(const_cols)]
@@ -219,7 +563,856 @@ def energy(data, points):
 	if not points.data.c_contiguous:
 		points = np.copy(points, order='C')
 
-	return energy_cpp(data, points)
+	if method == "tree":
+		return energy_tree_cpp(data, points, theta, 32, _threads(n_jobs))
+
+	if method == "sliced":
+		if not isinstance(n_projections, (int, np.integer)) or n_projections < 1:
+			raise Exception("n_projections should be a positive integer")
+
+		dim = data.shape[1]
+		directions = np.random.standard_normal((n_projections, dim))
+		directions /= np.linalg.norm(directions, axis=1).reshape(n_projections, 1)
+		scale = math.exp(math.lgamma(dim / 2) - math.lgamma((dim + 1) / 2)) / math.sqrt(math.pi)
+		return np.mean(energy_sliced_cpp(data, points, directions, _threads(n_jobs))) / scale
+
+	return energy_cpp(data, points, _threads(n_jobs))
+
+
+def _chunks(data, chunk_size):
+	if callable(data):
+		return iter(data())
+
+	return (data[i:i + chunk_size] for i in range(0, data.shape[0], chunk_size))
+
+
+def _update_moments(N, mean, m2, chunk):
+	# merges the means and sums of squared deviations of N rows and a chunk (Chan et al., 1983)
+	n_chunk = chunk.shape[0]
+	chunk_mean = chunk.mean(axis=0)
+	chunk_m2 = np.square(chunk - chunk_mean).sum(axis=0)
+	if N == 0:
+		return n_chunk, chunk_mean, chunk_m2
+
+	delta = chunk_mean - mean
+	mean = mean + delta * n_chunk / (N + n_chunk)
+	m2 = m2 + chunk_m2 + np.square(delta) * N * n_chunk / (N + n_chunk)
+	return N + n_chunk, mean, m2
+
+
+def energy_chunked(data, points, chunk_size=1000000, n_jobs=None):
+	"""
+	**Descritpion**
+
+	``energy_chunked()`` computes the same energy distance as ``energy()``, but streams ``data`` in chunks, so that datasets larger than memory, e.g., memory-mapped .npy files or chunked Parquet files, can serve as the reference.
+
+	**Parameters**
+
+	``data`` ( ndarray or callable ): the dataset including both the predictors and response(s), either as a numpy ndarray or memmap, or as a function that takes no arguments and returns an iterable over 2 dimensional chunks of rows; the function is called twice, and should yield the same rows each time; should not contain nan or infinity
+
+	``points`` ( ndarray ): the set of points for which the energy distance with respect to ``data`` is to be computed; should not contain nan or infinity
+
+	``chunk_size`` ( int , optional ): number of rows per chunk when ``data`` is an ndarray or memmap
+
+	``n_jobs`` ( int , optional ): number of threads; negative values count back from the number of CPUs, e.g., -1 uses all CPUs; if not provided, the setting of ``num_threads()`` or ``set_num_threads()`` is used, or otherwise the OpenMP default
+
+	**Returns**
+
+	( float ): energy distance
+
+	**Details**
+
+	Two passes are made over ``data``. The first pass finds the constant columns, and the column means and standard deviations, which are merged over the chunks as in Chan et al. (1983). The second pass scales every chunk and adds up its distances to ``points``, which remain in memory. While the distances of one chunk are being computed, the next chunk is read and scaled in a background thread, so that I/O overlaps with computation. Only ``points`` and two chunks are held in memory at any time.
+
+	**References**
+
+	Székely, G. J., & Rizzo, M. L. (2013). Energy statistics: A class of statistics based on distances. Journal of statistical planning and inference, 143(8), 1249-1272.
+
+	Chan, T. F., Golub, G. H., & LeVeque, R. J. (1983). Algorithms for computing the sample variance: Analysis and recommendations. The American Statistician, 37(3), 242-247.
+
+	"""
+
+	if not callable(data) and (not isinstance(data, np.ndarray) or len(data.shape) != 2):
+		raise Exception("data is expected to be a 2 dimensional numpy ndarray or memmap, or a function returning an iterable of such arrays")
+
+	_check_array(points, "points")
+
+	if not isinstance(chunk_size, (int, np.integer)) or chunk_size < 1:
+		raise Exception("chunk_size should be a positive integer")
+
+	n_threads = _threads(n_jobs)
+
+	N, mean, m2 = 0, None, None
+	for chunk in _chunks(data, chunk_size):
+		chunk = np.asarray(chunk, dtype='float64')
+		if len(chunk.shape) != 2 or chunk.shape[1] != points.shape[1]:
+			raise Exception("every chunk of data should be 2 dimensional, with the same number of columns as points")
+
+		if np.isnan(chunk).any() or np.isinf(chunk).any():
+			raise Exception("data cannot contain nan or infinity")
+
+		if chunk.shape[0] == 0:
+			continue
+
+		if N == 0:
+			first_row = chunk[0, :].copy()
+			varying = np.zeros(chunk.shape[1], bool)
+
+		varying |= np.any(chunk != first_row, axis=0)
+		N, mean, m2 = _update_moments(N, mean, m2, chunk)
+
+	if N == 0:
+		raise Exception("data should contain at least one row")
+
+	mean = mean[varying]
+	std = np.sqrt(m2[varying] / N)
+	points = np.ascontiguousarray((points[:, varying] - mean) / std)
+
+	def load(iterator):
+		chunk = next(iterator, None)
+		if chunk is None:
+			return None
+
+		return np.ascontiguousarray((np.asarray(chunk, dtype='float64')[:, varying] - mean) / std)
+
+	sum1 = 0.0
+	N_second_pass = 0
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		iterator = _chunks(data, chunk_size)
+		pending = executor.submit(load, iterator)
+		while True:
+			chunk = pending.result()
+			if chunk is None:
+				break
+
+			pending = executor.submit(load, iterator)
+			if chunk.shape[0] > 0:
+				sum1 += cross_distance_sum_cpp(chunk, points, n_threads)
+				N_second_pass += chunk.shape[0]
+
+	if N_second_pass != N:
+		raise Exception("data yielded a different number of rows in the second pass")
+
+	n = points.shape[0]
+	sum2 = pairwise_distance_sum_cpp(points, n_threads)
+	return 2.0 * sum1 / (N * n) - sum2 / (n * n)
+
+
+def energy_test(a, b, n_permutations=999, n_jobs=None):
+	"""
+	**Descritpion**
+
+	``energy_test()`` performs the two-sample energy test (Székely and Rizzo, 2013) of whether two datasets, e.g., the twins obtained from ``twin()``, come from the same distribution. The p-value is obtained by permutation.
+
+	**Parameters**
+
+	``a`` ( ndarray ): the first dataset; should not contain nan or infinity
+
+	``b`` ( ndarray ): the second dataset, with the same columns as ``a``; should not contain nan or infinity
+
+	``n_permutations`` ( int , optional ): number of random permutations of the pooled rows used to approximate the null distribution
+
+	``n_jobs`` ( int , optional ): number of threads; negative values count back from the number of CPUs, e.g., -1 uses all CPUs; if not provided, the setting of ``num_threads()`` or ``set_num_threads()`` is used, or otherwise the OpenMP default
+
+	**Returns**
+
+	( float , float ): the two-sample energy statistic and its permutation p-value
+
+	**Details**
+
+	Unlike ``energy()``, the statistic includes the distances among the rows of both datasets, i.e., for ``n`` rows in ``a`` and ``m`` rows in ``b``, it is nm / (n + m) times 2E|A - B| - E|A - A'| - E|B - B'|. Before the test, constant columns are removed from the pooled rows and the remaining are scaled to zero mean and unit standard deviation. The pairwise distances among the pooled rows are computed only once, streaming through them in tiles, and each tile is reused for the observed labeling and all ``n_permutations`` permutations in parallel, so that memory does not grow quadratically with the number of rows. The labelings take one byte per pooled row and permutation, e.g., 1 GB for 1 million rows and 999 permutations, and each thread keeps ``2 * (n_permutations + 1) + 1`` partial sums. Small p-values indicate that ``a`` and ``b`` are not statistically similar.
+
+	**References**
+
+	Székely, G. J., & Rizzo, M. L. (2013). Energy statistics: A class of statistics based on distances. Journal of statistical planning and inference, 143(8), 1249-1272.
+
+	"""
+
+	_check_array(a, "a")
+	_check_array(b, "b")
+
+	if a.shape[1] != b.shape[1]:
+		raise Exception("a and b should have the same number of columns")
+
+	if a.shape[0] == 0 or b.shape[0] == 0:
+		raise Exception("a and b should contain at least one row")
+
+	if not isinstance(n_permutations, (int, np.integer)) or n_permutations < 0:
+		raise Exception("n_permutations should be a non-negative integer")
+
+	pooled = _data_format(np.vstack((a, b)))
+	statistics = np.array(energy_test_cpp(pooled, a.shape[0], n_permutations, np.random.randint(2**31), _threads(n_jobs)))
+	p_value = (1 + np.sum(statistics[1:] >= statistics[0])) / (1 + n_permutations)
+	return float(statistics[0]), float(p_value)
+
+
+def energy_many(data, index_sets=None, labels=None, n_jobs=None):
+	"""
+	**Descritpion**
+
+	``energy_many()`` computes the energy distance (Székely and Rizzo, 2013) between a given dataset and each of several sets of its rows, e.g., the multiplets returned by ``multiplet()``, or the twins obtained from ``twin()`` with different seeds.
+
+	**Parameters**
+
+	``data`` ( ndarray ): the dataset including both the predictors and response(s); should not contain nan or infinity
+
+	``index_sets`` ( list , optional ): a list of arrays of row indices of ``data``, one for each set of points
+
+	``labels`` ( ndarray , optional ): an array with a set id, ranging from 0 to *k* - 1, for each row in ``data``, such as the output of ``multiplet()``; exactly one of ``index_sets`` and ``labels`` should be provided
+
+	``n_jobs`` ( int , optional ): number of threads; negative values count back from the number of CPUs, e.g., -1 uses all CPUs; if not provided, the setting of ``num_threads()`` or ``set_num_threads()`` is used, or otherwise the OpenMP default
+
+	**Returns**
+
+	( ndarray ): energy distance of each set, in the order of ``index_sets`` or of the set ids in ``labels``
+
+	**Details**
+
+	The result for a set with row indices ``idx`` equals ``energy(data, data[idx, :])``. However, ``data`` is validated and scaled only once, and the sets are passed as row indices instead of copies of the points. The distances from a row to all rows of ``data`` do not depend on the set of the row, and are computed once for every distinct row of the sets, in a single parallel sweep over blocks of rows of ``data`` that are reused from the processor cache by many rows of the sets; rows shared by several sets, e.g., by twins with different seeds, thus cost nothing extra.
+
+	**References**
+
+	Székely, G. J., & Rizzo, M. L. (2013). Energy statistics: A class of statistics based on distances. Journal of statistical planning and inference, 143(8), 1249-1272.
+
+	"""
+
+	_check_array(data, "data")
+	N = data.shape[0]
+
+	if (index_sets is None) == (labels is None):
+		raise Exception("exactly one of index_sets and labels should be provided")
+
+	if labels is not None:
+		labels = np.asarray(labels)
+		if labels.shape != (N,) or not np.issubdtype(labels.dtype, np.integer) or labels.min() < 0:
+			raise Exception("labels should be an array of non-negative integers with one label for each row in data")
+
+		counts = np.bincount(labels)
+		if np.any(counts == 0):
+			raise Exception("labels should include every set id from 0 to labels.max()")
+
+		members = np.argsort(labels, kind='stable')
+		offsets = np.concatenate(([0], np.cumsum(counts)))
+	else:
+		index_sets = [np.asarray(idx).ravel() for idx in index_sets]
+		if len(index_sets) == 0 or any(len(idx) == 0 for idx in index_sets):
+			raise Exception("index_sets should be a non-empty list of non-empty arrays of row indices")
+
+		members, offsets = _members(index_sets, N, "index_sets")
+
+	data = _data_format(data)
+	return np.array(energy_many_cpp(data, members, offsets, _threads(n_jobs)))
+
+
+class EnergyTracker:
+	"""
+	**Descritpion**
+
+	``EnergyTracker`` maintains the energy distance (Székely and Rizzo, 2013) between a given dataset and a set of points that changes over time, e.g., a candidate set in which a few points are added, removed, or swapped at every iteration of an outer loop. The per-point sums of distances to the rows of the dataset and to the other points are cached, so that adding or removing a point costs O(N + n) distance calculations instead of the O(nN + n²) required by ``energy()``.
+
+	**Parameters**
+
+	``data`` ( ndarray ): the dataset including both the predictors and response(s); should not contain nan or infinity
+
+	``points`` ( ndarray , optional ): the initial set of points; should not contain nan or infinity
+
+	``n_jobs`` ( int , optional ): number of threads; negative values count back from the number of CPUs, e.g., -1 uses all CPUs; if not provided, the setting of ``num_threads()`` or ``set_num_threads()`` is used, or otherwise the OpenMP default
+
+	**Methods**
+
+	``add(points)``: adds the rows of ``points`` to the tracked set and returns their ids ( ndarray )
+
+	``remove(ids)``: removes the points with the given ids from the tracked set; ids of removed points may be reused by later insertions
+
+	``energy()``: returns the energy distance ( float ) between ``data`` and the tracked points; identical to ``energy(data, points)`` up to floating point rounding
+
+	``contributions()``: returns the ids of the tracked points and their contributions ( ndarray , ndarray ) to the energy distance; the contributions sum to ``energy()``, and points with the largest contributions are the worst represented
+
+	**Details**
+
+	The columns of ``data`` are scaled to zero mean and unit standard deviation, and the same scaling is applied to the tracked points, as in ``energy()``. Removals subtract the cached distances, hence, after a very long sequence of updates the result may drift from ``energy()`` by accumulated rounding error.
+
+	**References**
+
+	Székely, G. J., & Rizzo, M. L. (2013). Energy statistics: A class of statistics based on distances. Journal of statistical planning and inference, 143(8), 1249-1272.
+
+	"""
+
+	def __init__(self, data, points=None, n_jobs=None):
+		_check_array(data, "data")
+
+		const_cols = np.all(data == data[0, :], axis=0)
+		self._n_features = data.shape[1]
+		self._columns = np.invert(const_cols)
+		data = data[:, self._columns]
+
+		self._mean = data.mean(axis=0)
+		self._std = data.std(axis=0)
+		self._tracker = EnergyTracker_cpp(np.ascontiguousarray((data - self._mean) / self._std), _threads(n_jobs))
+
+		if points is not None:
+			self.add(points)
+
+	def __len__(self):
+		return self._tracker.size()
+
+	def add(self, points):
+		_check_array(points, "points")
+
+		if points.shape[1] != self._n_features:
+			raise Exception("data and points should have the same number of columns")
+
+		points = (points[:, self._columns] - self._mean) / self._std
+		return np.array(self._tracker.add(np.ascontiguousarray(points)), dtype='uint64')
+
+	def remove(self, ids):
+		self._tracker.remove(np.atleast_1d(np.asarray(ids, dtype='uint64')).tolist())
+
+	def energy(self):
+		return self._tracker.energy()
+
+	def contributions(self):
+		return np.array(self._tracker.ids(), dtype='uint64'), np.array(self._tracker.contributions())
+
+
+_FILE_MAGIC = b"TWINNING"
+_FILE_VERSION = 1
+_FILE_HEADER = struct.Struct("<8s8sI4sIII28x")
+_FILE_SECTION = struct.Struct("<16s8sQQI4x")
+_FILE_ALIGNMENT = 64
+
+
+def _crc32(buffer, chunk_size=1 << 24):
+	buffer = memoryview(buffer).cast("B")
+	crc = 0
+	for i in range(0, len(buffer), chunk_size):
+		crc = zlib.crc32(buffer[i:i + chunk_size], crc)
+
+	return crc
+
+
+def _write_file(path, kind, sections):
+	# sections is a list of (name, array) pairs; arrays are written flat, and as
+	# laid out in memory, at offsets aligned for memory-mapping
+	arrays = [np.ascontiguousarray(array) for _, array in sections]
+	offset = _FILE_HEADER.size + len(sections) * _FILE_SECTION.size
+	table = b""
+	for (name, _), array in zip(sections, arrays):
+		offset = -(-offset // _FILE_ALIGNMENT) * _FILE_ALIGNMENT
+		table += _FILE_SECTION.pack(name.encode(), array.dtype.str.encode(), offset, array.nbytes, _crc32(array))
+		offset += array.nbytes
+
+	header = _FILE_HEADER.pack(_FILE_MAGIC, kind.encode(), _FILE_VERSION, struct.pack("=I", 0x01020304), struct.calcsize("P"), len(sections), zlib.crc32(table))
+
+	with open(path + ".tmp", "wb") as file:
+		file.write(header + table)
+		for (name, _), array in zip(sections, arrays):
+			file.write(b"\0" * (-file.tell() % _FILE_ALIGNMENT))
+			file.write(memoryview(array).cast("B"))
+
+	os.replace(path + ".tmp", path)
+
+
+def _read_file(path, kind, mapped=(), verify=False):
+	# sections named in mapped are memory-mapped rather than read, and their
+	# checksums are only verified on request, as that reads the whole section
+	with open(path, "rb") as file:
+		header = file.read(_FILE_HEADER.size)
+		if len(header) != _FILE_HEADER.size or header[:8] != _FILE_MAGIC:
+			raise Exception(f"{path} is not a twinning file")
+
+		magic, file_kind, version, byte_order, pointer_size, n_sections, table_crc = _FILE_HEADER.unpack(header)
+		file_kind = file_kind.rstrip(b"\0").decode()
+		if file_kind != kind:
+			raise Exception(f"{path} contains {file_kind!r} data rather than {kind!r}")
+
+		if version != _FILE_VERSION:
+			raise Exception(f"{path} has version {version} of the file format, whereas version {_FILE_VERSION} is supported")
+
+		if byte_order != struct.pack("=I", 0x01020304) or pointer_size != struct.calcsize("P"):
+			raise Exception(f"{path} was written on a platform with a different byte order or word size")
+
+		table = file.read(n_sections * _FILE_SECTION.size)
+		if len(table) != n_sections * _FILE_SECTION.size or zlib.crc32(table) != table_crc:
+			raise Exception(f"{path} is corrupted")
+
+		sections = {}
+		for i in range(n_sections):
+			name, dtype, offset, nbytes, crc = _FILE_SECTION.unpack_from(table, i * _FILE_SECTION.size)
+			name = name.rstrip(b"\0").decode()
+			dtype = np.dtype(dtype.rstrip(b"\0").decode())
+
+			if name in mapped:
+				array = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(nbytes // dtype.itemsize,)) if nbytes > 0 else np.empty(0, dtype)
+				if verify and _crc32(array) != crc:
+					raise Exception(f"{path} is corrupted")
+			else:
+				file.seek(offset)
+				array = np.frombuffer(file.read(nbytes), dtype=dtype)
+				if array.nbytes != nbytes or _crc32(array) != crc:
+					raise Exception(f"{path} is corrupted")
+
+			sections[name] = array
+
+	return sections
+
+
+class TwinningIndex:
+	"""
+	**Descritpion**
+
+	``TwinningIndex`` holds a scaled copy of a dataset and a *kd*-tree over it, which are shared by all twinning and energy computations on the dataset, e.g., twins with several ratios and seeds, multiplets, and the scoring of the results. ``twin()``, ``multiplet()``, and ``energy()`` validate and scale the dataset, and build a *kd*-tree on every call.
+
+	**Parameters**
+
+	``data`` ( ndarray ): the dataset including both the predictors and response(s); should not contain nan or infinity
+
+	``leaf_size`` ( int , optional ): maximum number of elements in the leaf-nodes of the kd-tree
+
+	**Methods**
+
+	``twin(r, u1=None)``: same as ``twin(data, r, u1)``
+
+	``multiplet(k, strategy=1)``: same as ``multiplet(data, k, strategy)``
+
+	``energy(idx, n_jobs=None)``: same as ``energy(data, data[idx, :])`` for an array of row indices ``idx``, or ``energy_many(data, idx)`` for a list of such arrays
+
+	``save(path)``: writes the index to the file ``path``
+
+	``TwinningIndex.load(path, verify=False)``: reads an index written by ``save()``; ``verify`` checks the scaled dataset against its checksum, which requires reading it in full
+
+	**Details**
+
+	Twinning removes points from the *kd*-tree as it proceeds. Instead of rebuilding the tree, the removed points are restored before every run, and runs over a subset of the rows, as in ``multiplet()``, remove the other rows beforehand.
+
+	A saved index holds the scaled dataset, the scaling, and the *kd*-tree, each with a checksum, so that other processes can load it instead of building it again. The scaled dataset is memory-mapped from the file on loading, and hence the processes share a single copy of it in the page cache. The file is specific to the byte order and word size of the platform that wrote it.
+
+	"""
+
+	def __init__(self, data, leaf_size=8):
+		_check_array(data, "data")
+
+		const_cols = np.all(data == data[0, :], axis=0)
+		self._n_features = data.shape[1]
+		self._columns = np.invert(const_cols)
+		data = data[:, self._columns]
+
+		self._mean = data.mean(axis=0)
+		self._std = data.std(axis=0)
+		self._leaf_size = leaf_size
+		self._data = np.ascontiguousarray((data - self._mean) / self._std)
+		self._index = TwinningIndex_cpp(self._data, leaf_size)
+
+	def save(self, path):
+		meta = np.array([self._data.shape[0], self._n_features, self._leaf_size], dtype='<i8')
+		tree = np.frombuffer(self._index.save_tree(), dtype='uint8')
+		_write_file(path, "index", [("meta", meta), ("columns", self._columns.astype('uint8')), ("mean", self._mean), ("std", self._std), ("data", self._data), ("tree", tree)])
+
+	@classmethod
+	def load(cls, path, verify=False):
+		sections = _read_file(path, "index", mapped=("data",), verify=verify)
+		N, n_features, leaf_size = (int(value) for value in sections["meta"])
+
+		index = cls.__new__(cls)
+		index._n_features = n_features
+		index._columns = sections["columns"].astype(bool)
+		index._mean = sections["mean"]
+		index._std = sections["std"]
+		index._leaf_size = leaf_size
+		index._data = sections["data"].reshape(N, -1)
+		index._index = TwinningIndex_cpp(index._data, leaf_size, sections["tree"].tobytes())
+		return index
+
+	def __len__(self):
+		return self._data.shape[0]
+
+	def twin(self, r, u1=None):
+		N = self._data.shape[0]
+
+		if u1 is None:
+			u1 = np.random.randint(N)
+		elif u1 not in range(N):
+			raise Exception("u1 should be a row index such that 0 <= u1 < data.shape[0]")
+
+		if r not in range(2, math.floor(N / 2) + 1):
+			raise Exception("r should be an integer such that 2 <= r <= data.shape[0]/2")
+
+		return np.array(self._index.twin(r, u1), dtype='uint64')
+
+	def multiplet(self, k, strategy=1):
+		N = self._data.shape[0]
+
+		if k not in range(2, math.floor(N / 2) + 1):
+			raise Exception("k should be an integer such that 2 <= r <= data.shape[0]/2")
+
+		labels = np.empty(N, dtype='uint64')
+
+		if strategy == 1:
+			row_index = np.arange(N)
+			i = 0
+			while True:
+				multiplet_i = np.array(self._index.twin_rows(row_index, k - i, row_index[np.random.randint(len(row_index))]), dtype='uint64')
+				labels[multiplet_i] = i
+
+				negate = np.ones(N, bool)
+				negate[multiplet_i] = 0
+				row_index = row_index[negate[row_index]]
+
+				if len(row_index) <= N / k:
+					labels[row_index] = i + 1
+					break
+
+				i += 1
+
+			return labels
+
+		if strategy == 2:
+			if not (k & (k - 1) == 0):
+				raise Exception("strategy 2 requires k to be a power of 2")
+
+			i = 0
+
+			def equal_twins(row_index):
+				nonlocal i
+				if len(row_index) <= math.ceil(N / k):
+					labels[row_index] = i
+					i += 1
+				else:
+					equal_twins_i = np.array(self._index.twin_rows(row_index, 2, row_index[np.random.randint(len(row_index))]), dtype='uint64')
+					negate = np.ones(N, bool)
+					negate[equal_twins_i] = 0
+					equal_twins(row_index[negate[row_index]])
+					equal_twins(np.sort(equal_twins_i))
+
+			equal_twins(np.arange(N))
+			return labels
+
+		if strategy == 3:
+			sequence = np.array(self._index.get_sequence(k, np.random.randint(N)), dtype='uint64')
+			labels[sequence] = np.tile(np.arange(k), math.ceil(N / k))[0:N]
+			return labels
+
+	def energy(self, idx, n_jobs=None):
+		N = self._data.shape[0]
+		index_sets = idx if isinstance(idx, list) else [idx]
+		index_sets = [np.asarray(idx).ravel() for idx in index_sets]
+
+		if len(index_sets) == 0 or any(len(idx) == 0 for idx in index_sets):
+			raise Exception("idx should be a non-empty array of row indices, or a non-empty list of such arrays")
+
+		members, offsets = _members(index_sets, N, "idx")
+		energies = np.array(energy_many_cpp(self._data, members, offsets, _threads(n_jobs)))
+		return energies if isinstance(idx, list) else energies[0]
+
+
+class TwinningPartition:
+	"""
+	**Descritpion**
+
+	``TwinningPartition`` extends a partition of a dataset, e.g., twins from ``twin()`` or multiplets from ``multiplet()``, to rows that arrive later, assigning every new row to a part based on the nearby rows instead of partitioning the whole dataset again.
+
+	**Parameters**
+
+	``data`` ( ndarray ): the dataset including both the predictors and response(s); should not contain nan or infinity
+
+	``labels`` ( ndarray ): the part of each row, from 0 to ``k`` - 1, e.g., the output of ``multiplet()``, or for twins, an array of zeros with ones at the indices returned by ``twin()``
+
+	``n_neighbors`` ( int , optional ): number of nearest rows considered for every new row; if not provided, four times the inverse of the proportion of the smallest part, rounded up
+
+	``leaf_size`` ( int , optional ): maximum number of elements in the leaf-nodes of the kd-tree
+
+	``n_jobs`` ( int , optional ): number of threads for the initial nearest neighbor distances; negative values count back from the number of CPUs, e.g., -1 uses all CPUs; if not provided, the setting of ``num_threads()`` or ``set_num_threads()`` is used, or otherwise the OpenMP default
+
+	**Methods**
+
+	``assign(rows)``: assigns new rows, given as a 2 dimensional ndarray with the columns of ``data``, and returns their parts
+
+	``labels``: the parts of all rows, the rows of ``data`` first and then the assigned rows in order
+
+	``drift``: mean distance from the assigned rows to their nearest row of ``data``, relative to the mean distance from the rows of ``data`` to their nearest other row
+
+	``save(path)``: writes the partition to the file ``path``
+
+	``TwinningPartition.load(path, verify=False)``: reads a partition written by ``save()``; ``verify`` checks the stored rows against their checksum
+
+	**Details**
+
+	The rows are scaled with the means and standard deviations of ``data``, and kept in a dynamic *kd*-tree. The proportions of the parts in ``data`` are the targets. A new row goes to the part with the largest deficit, which is the sum of its local deficit among the ``n_neighbors`` nearest rows, i.e., the target proportion times ``n_neighbors`` minus the number of neighbors in the part, and its global deficit, i.e., the target proportion times the number of rows minus the size of the part. The local deficit keeps the parts similar in every region of the data, while the global deficit bounds the deviation of the part sizes from the targets. Every assigned row is inserted into the tree, and is a neighbor of the following rows, even within the same call of ``assign()``. An assignment costs a nearest neighbor query and an insertion, both amortized *O*(log *N*).
+
+	The assignment preserves the similarity of the parts as long as the new rows follow the distribution of ``data``. A ``drift`` near 1 indicates that they do; a ``drift`` well above 1, e.g., 1.5, indicates that new rows fall in sparse regions of ``data``, and that the dataset should be partitioned again with ``twin()`` or ``multiplet()``, followed by a new ``TwinningPartition``. The assigned rows are not counted as nearest rows by ``drift``, since the distances to the nearest rows would otherwise shrink as rows accumulate. As ``drift`` is relative to the distances among the rows of ``data``, a ``data`` in which every row has an exact duplicate is rejected.
+
+	"""
+
+	def __init__(self, data, labels, n_neighbors=None, leaf_size=8, n_jobs=None):
+		_check_array(data, "data")
+
+		labels = np.asarray(labels)
+		if labels.ndim != 1 or labels.shape[0] != data.shape[0] or not np.issubdtype(labels.dtype, np.integer) or labels.min() < 0:
+			raise Exception("labels should be a 1 dimensional array of non-negative integers with a label for each row of data")
+
+		counts = np.bincount(labels)
+		if len(counts) < 2 or np.any(counts == 0):
+			raise Exception("labels should take every value from 0 to k - 1, for some k >= 2")
+
+		if n_neighbors is None:
+			n_neighbors = min(math.ceil(4 * data.shape[0] / counts.min()), data.shape[0])
+		elif n_neighbors not in range(1, data.shape[0] + 1):
+			raise Exception("n_neighbors should be an integer such that 1 <= n_neighbors <= data.shape[0]")
+
+		const_cols = np.all(data == data[0, :], axis=0)
+		self._n_features = data.shape[1]
+		self._columns = np.invert(const_cols)
+		data = data[:, self._columns]
+
+		self._mean = data.mean(axis=0)
+		self._std = data.std(axis=0)
+		self._n_neighbors = n_neighbors
+		self._leaf_size = leaf_size
+		self._partition = TwinningPartition_cpp(np.ascontiguousarray((data - self._mean) / self._std), labels.tolist(), len(counts), n_neighbors, leaf_size, _threads(n_jobs))
+
+	def __len__(self):
+		return self._partition.size()
+
+	def assign(self, rows):
+		_check_array(rows, "rows")
+
+		if rows.shape[1] != self._n_features:
+			raise Exception("data and rows should have the same number of columns")
+
+		rows = (rows[:, self._columns] - self._mean) / self._std
+		return np.array(self._partition.assign(np.ascontiguousarray(rows)), dtype='uint64')
+
+	@property
+	def labels(self):
+		return np.array(self._partition.labels(), dtype='uint64')
+
+	@property
+	def drift(self):
+		return self._partition.drift()
+
+	def save(self, path):
+		meta = np.array([len(self), self._n_features, self._leaf_size, self._n_neighbors], dtype='<i8')
+		tree = np.frombuffer(self._partition.save_tree(), dtype='uint8')
+		_write_file(path, "parts", [("meta", meta), ("columns", self._columns.astype('uint8')), ("mean", self._mean), ("std", self._std), ("targets", np.array(self._partition.targets())), ("state", np.array(self._partition.state())), ("labels", self.labels), ("data", self._partition.data()), ("tree", tree)])
+
+	@classmethod
+	def load(cls, path, verify=False):
+		sections = _read_file(path, "parts", mapped=("data",), verify=verify)
+		N, n_features, leaf_size, n_neighbors = (int(value) for value in sections["meta"])
+
+		partition = cls.__new__(cls)
+		partition._n_features = n_features
+		partition._columns = sections["columns"].astype(bool)
+		partition._mean = sections["mean"]
+		partition._std = sections["std"]
+		partition._n_neighbors = n_neighbors
+		partition._leaf_size = leaf_size
+		partition._partition = TwinningPartition_cpp(sections["data"].reshape(N, -1), sections["labels"].tolist(), sections["targets"].tolist(), n_neighbors, leaf_size, sections["tree"].tobytes(), sections["state"].tolist())
+		return partition
+
+
+class TwinningWindow:
+	"""
+	**Descritpion**
+
+	``TwinningWindow`` maintains the twins of a sliding window of rows, e.g., the most recent days of a time series, as rows enter and leave the window, repairing the twins locally instead of twinning the whole window again.
+
+	**Parameters**
+
+	``data`` ( ndarray ): the initial rows of the window; should not contain nan or infinity
+
+	``r`` ( int ): an integer representing the inverse of the splitting ratio, as in ``twin()``
+
+	``u1`` ( int , optional ): index of the row from where the twinning of ``data`` starts; if not provided, a random row is chosen
+
+	``n_neighbors`` ( int , optional ): number of nearest rows considered for every new row; if not provided, 4 ``r``
+
+	``leaf_size`` ( int , optional ): maximum number of elements in the leaf-nodes of the kd-tree
+
+	**Methods**
+
+	``insert(rows)``: adds new rows, given as a 2 dimensional ndarray with the columns of ``data``, to the window, and returns their ids; the rows of ``data`` have ids 0 to ``data.shape[0]`` - 1, and later rows the following integers in order of insertion
+
+	``remove(ids)``: removes the rows with the given ids from the window, which should keep at least 2 ``r`` rows
+
+	``selected``: ids of the rows of the smaller twin, in increasing order
+
+	``ids``: ids of all rows in the window, in increasing order
+
+	**Details**
+
+	The rows are scaled with the means and standard deviations of ``data``, and ``data`` is twinned as in ``twin()``. A new row joins the smaller twin if the deficit of the smaller twin exceeds that of the larger one, as in ``TwinningPartition``, among its ``n_neighbors`` nearest rows in the window and overall. If removing a row of the smaller twin leaves it more than half a row short of 1 / ``r`` of the window, its nearest row of the larger twin is moved into the smaller twin, and vice versa, so that the twins stay locally balanced at the cost of a nearest neighbor query. The rows in the window are kept in a dynamic *kd*-tree, with amortized *O*(log *N*) insertions, from which removed rows are deleted lazily. Once the removed rows outnumber the rows in the window, the window is compacted and its tree rebuilt, which costs *O*(*N* log *N*) and is amortized over at least *N* removals.
+
+	"""
+
+	def __init__(self, data, r, u1=None, n_neighbors=None, leaf_size=8):
+		_check_array(data, "data")
+
+		if u1 is None:
+			u1 = np.random.randint(data.shape[0])
+		elif u1 not in range(data.shape[0]):
+			raise Exception("u1 should be a row index such that 0 <= u1 < data.shape[0]")
+
+		if r not in range(2, math.floor(data.shape[0] / 2) + 1):
+			raise Exception("r should be an integer such that 2 <= r <= data.shape[0]/2")
+
+		if n_neighbors is None:
+			n_neighbors = 4 * r
+		elif not isinstance(n_neighbors, (int, np.integer)) or n_neighbors < 1:
+			raise Exception("n_neighbors should be a positive integer")
+
+		const_cols = np.all(data == data[0, :], axis=0)
+		self._n_features = data.shape[1]
+		self._columns = np.invert(const_cols)
+		data = data[:, self._columns]
+
+		self._mean = data.mean(axis=0)
+		self._std = data.std(axis=0)
+		self._window = TwinningWindow_cpp(np.ascontiguousarray((data - self._mean) / self._std), r, u1, n_neighbors, leaf_size)
+
+	def __len__(self):
+		return self._window.size()
+
+	def insert(self, rows):
+		_check_array(rows, "rows")
+
+		if rows.shape[1] != self._n_features:
+			raise Exception("data and rows should have the same number of columns")
+
+		rows = (rows[:, self._columns] - self._mean) / self._std
+		return np.array(self._window.insert(np.ascontiguousarray(rows)), dtype='uint64')
+
+	def remove(self, ids):
+		ids = np.asarray(ids).ravel()
+		if not np.issubdtype(ids.dtype, np.integer) or (len(ids) > 0 and ids.min() < 0):
+			raise Exception("ids should be an array of row ids")
+
+		self._window.remove(ids.tolist())
+
+	@property
+	def selected(self):
+		return np.array(self._window.selected(), dtype='uint64')
+
+	@property
+	def ids(self):
+		return np.array(self._window.ids(), dtype='uint64')
+
+
+class TwinningCoreset:
+	"""
+	**Descritpion**
+
+	``TwinningCoreset`` compresses a stream of rows that does not fit in memory, e.g., chunks read from files or a message queue, into a weighted representative sample of a fixed size, using memory logarithmic in the length of the stream.
+
+	**Parameters**
+
+	``size`` ( int ): number of rows in the sample
+
+	``block_size`` ( int , optional ): number of rows of the stream that are compressed at a time; at least 2 ``size``, and 4 ``size`` if not provided
+
+	``leaf_size`` ( int , optional ): maximum number of elements in the leaf-nodes of the kd-tree
+
+	**Methods**
+
+	``update(chunk)``: adds the rows of a 2 dimensional ndarray to the stream
+
+	``extend(chunks)``: adds every chunk of an iterable of 2 dimensional ndarrays, and returns the object
+
+	``coreset()``: returns the sample, as an ndarray of rows of the stream, and an ndarray with their weights, i.e., the numbers of rows of the stream they represent, which add up to the number of rows in the stream
+
+	**Details**
+
+	The stream is buffered into blocks of ``block_size`` rows, and every block is reduced to ``size`` rows: the rows are ordered by the twinning walk of ``multiplet()`` with strategy 3 and ``r`` = ``ceil(block_size / size)``, every group of ``r`` consecutive rows, which are the nearest unvisited rows at a step of the walk, is replaced by its first row, and the weights of the group are added up. The reduced blocks are merged in a binary counter: level ``l`` holds at most one sample representing ``2^l`` blocks, and two samples of the same level are concatenated and reduced with ``r`` = 2 into one sample of the next level. ``coreset()`` reduces the samples of all levels and the buffered rows to at most ``size`` rows in the same way. Thus at most ``block_size`` buffered rows and ``size`` rows per level are kept, i.e., *O*(``size`` log(*N* / ``block_size``)) rows for *N* rows in the stream. The rows are scaled with the running means and standard deviations of the stream before every reduction. The walk does not take the weights into account.
+
+	**References**
+
+	Har-Peled, S., & Mazumdar, S. (2004). On coresets for k-means and k-median clustering. In Proceedings of the thirty-sixth annual ACM symposium on Theory of computing (pp. 291-300).
+
+	"""
+
+	def __init__(self, size, block_size=None, leaf_size=8):
+		if not isinstance(size, (int, np.integer)) or size < 1:
+			raise Exception("size should be a positive integer")
+
+		if block_size is None:
+			block_size = 4 * size
+		elif not isinstance(block_size, (int, np.integer)) or block_size < 2 * size:
+			raise Exception("block_size should be an integer such that block_size >= 2 size")
+
+		self._size = size
+		self._block_size = block_size
+		self._leaf_size = leaf_size
+		self._levels = []
+		self._buffer = []
+		self._n_buffered = 0
+		self._N, self._mean, self._m2 = 0, None, None
+
+	def __len__(self):
+		return self._N
+
+	def update(self, chunk):
+		_check_array(chunk, "chunk")
+
+		if self._N > 0 and chunk.shape[1] != self._mean.shape[0]:
+			raise Exception("every chunk should have the same number of columns")
+
+		if chunk.shape[0] == 0:
+			return
+
+		chunk = np.asarray(chunk, dtype='float64')
+		self._N, self._mean, self._m2 = _update_moments(self._N, self._mean, self._m2, chunk)
+		self._buffer.append(chunk)
+		self._n_buffered += chunk.shape[0]
+
+		if self._n_buffered >= self._block_size:
+			rows = np.vstack(self._buffer)
+			n_blocks = rows.shape[0] // self._block_size
+			for b in range(n_blocks):
+				block = rows[b * self._block_size:(b + 1) * self._block_size]
+				self._carry(self._reduce(block, np.ones(self._block_size, dtype='int64'), math.ceil(self._block_size / self._size)))
+
+			self._buffer = [rows[n_blocks * self._block_size:]]
+			self._n_buffered = self._buffer[0].shape[0]
+
+	def extend(self, chunks):
+		for chunk in chunks:
+			self.update(chunk)
+
+		return self
+
+	def coreset(self):
+		if self._N == 0:
+			raise Exception("the stream should contain at least one row")
+
+		samples = [level for level in self._levels if level is not None]
+		samples.append((np.vstack(self._buffer), np.ones(self._n_buffered, dtype='int64')))
+		points = np.vstack([sample[0] for sample in samples])
+		weights = np.concatenate([sample[1] for sample in samples])
+
+		if points.shape[0] <= self._size:
+			return points, weights
+
+		return self._reduce(points, weights, math.ceil(points.shape[0] / self._size))
+
+	def _reduce(self, points, weights, r):
+		std = np.sqrt(self._m2 / self._N)
+		std[std == 0] = 1
+		scaled = np.ascontiguousarray((points - self._mean) / std)
+
+		sequence = np.array(multiplet_S3_cpp(scaled, r, np.random.randint(points.shape[0]), self._leaf_size), dtype='int64')
+		starts = np.arange(0, len(sequence), r)
+		return points[sequence[starts]], np.add.reduceat(weights[sequence], starts)
 
+	def _carry(self, sample):
+		level = 0
+		while level < len(self._levels) and self._levels[level] is not None:
+			points = np.vstack((self._levels[level][0], sample[0]))
+			weights = np.concatenate((self._levels[level][1], sample[1]))
+			sample = self._reduce(points, weights, 2)
+			self._levels[level] = None
+			level += 1
 
+		if level == len(self._levels):
+			self._levels.append(None)
 
+		self._levels[level] = sample
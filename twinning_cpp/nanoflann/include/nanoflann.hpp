@@ -2196,7 +2196,12 @@ class KDTreeSingleIndexDynamicAdaptor
         m_leaf_max_size = params.leaf_max_size;
         init();
         const size_t num_initial_points = dataset.kdtree_get_point_count();
-        if (num_initial_points > 0) { addPoints(0, num_initial_points - 1); }
+        if (num_initial_points > 0 &&
+            !(params.flags &
+              KDTreeSingleIndexAdaptorFlags::SkipInitialBuildIndex))
+        {
+            addPoints(0, num_initial_points - 1);
+        }
     }
 
     /** Deleted copy constructor*/
@@ -2225,7 +2230,7 @@ class KDTreeSingleIndexDynamicAdaptor
 
             for (int i = 0; i < pos; i++)
             {
-                for (int j = 0; j < static_cast<int>(index[i].vAcc.size()); j++)
+                for (size_t j = 0; j < index[i].vAcc.size(); j++)
                 {
                     index[pos].vAcc.push_back(index[i].vAcc[j]);
                     if (treeIndex[index[i].vAcc[j]] != -1)
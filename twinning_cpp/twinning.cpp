@@ -5,6 +5,26 @@
 #include <vector>
 #include <memory>
 #include <cmath>
+#include <string>
+#include <stdexcept>
+#include <algorithm>
+#include <random>
+#include <cstdint>
+#include <sstream>
+#include <unordered_map>
+#include <cstring>
+#include <limits>
+#include <utility>
+#include <cstdlib>
+
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#define TWINNING_X86_DISPATCH
+#include <immintrin.h>
+#endif
 
 #define STRINGIFY(x) #x
 #define MACRO_STRINGIFY(x) STRINGIFY(x)
@@ -14,12 +34,27 @@ namespace py = pybind11;
 class DF
 {
 private:
-    std::shared_ptr<py::detail::unchecked_reference<double, 2>> data_access_;
+    py::object array_;
+    const double* data_;
+    std::size_t nrow_;
+    std::size_t ncol_;
 
 public:
-    DF(py::array_t<double> data)
+    DF(py::array_t<double, py::array::c_style | py::array::forcecast> data) : array_(data)
+    {
+        data_ = data.data();
+        nrow_ = data.shape(0);
+        ncol_ = data.shape(1);
+    }
+
+    // view of a buffer owned by the caller; does not require the GIL
+    DF(const double* data, std::size_t nrow, std::size_t ncol) : data_(data), nrow_(nrow), ncol_(ncol) {}
+
+    // moves a view to the new location of a buffer, e.g., after it has grown
+    void rebind(const double* data, std::size_t nrow)
     {
-        data_access_ = std::make_shared<py::detail::unchecked_reference<double, 2>>(data.unchecked<2>());
+        data_ = data;
+        nrow_ = nrow;
     }
 
     /*
@@ -27,12 +62,12 @@ public:
     */
     std::size_t kdtree_get_point_count() const
     {
-        return data_access_->shape(0);
+        return nrow_;
     }
 
     double kdtree_get_pt(const std::size_t idx, const std::size_t dim) const 
     {
-        return (*data_access_)(idx, dim);
+        return data_[idx * ncol_ + dim];
     }
 
     template <class BBOX>
@@ -46,243 +81,3527 @@ public:
     */
     const double* get_row(const std::size_t idx) const
     {
-        return data_access_->data(idx, 0);
+        return data_ + idx * ncol_;
     }
 
     std::size_t nrow() const
     {
-        return data_access_->shape(0);
+        return nrow_;
     }
 
     std::size_t ncol() const
     {
-        return data_access_->shape(1);
+        return ncol_;
     }
 };
 
 
-typedef nanoflann::KDTreeSingleIndexDynamicAdaptor<nanoflann::L2_Adaptor<double, DF>, DF, -1, std::size_t> KDTree;
+/*
+    distance kernels
 
+    The squared distance between rows of fewer than SIMD_MIN_DIM columns is summed
+    column by column. Wider rows are summed in 8 lanes, lane l holding the columns
+    l, l + 8, l + 16, ..., which are then added in the fixed order
+    ((0 + 4) + (2 + 6)) + ((1 + 5) + (3 + 7)); likewise, distance_sum() adds the
+    distances to row j in lane j % 8. Every kernel, from the scalar one to
+    AVX-512, follows the same order, and the extension is compiled without
+    floating-point contraction, so that the results do not depend on the
+    instruction set picked at import time.
+*/
+const std::size_t SIMD_MIN_DIM = 8;
 
-class Twinning
+inline double sequential_squared_distance(const double* u, const double* v, std::size_t dim)
 {
-private:
-    const std::size_t r_;
-    const std::size_t u1_;
-    const std::size_t leaf_size_;
-    std::shared_ptr<DF> data_;
+    double sum = 0.0;
+    for(std::size_t k = 0; k < dim; k++)
+    {
+        double diff = u[k] - v[k];
+        sum += diff * diff;
+    }
 
-public:
-    Twinning(py::array_t<double> data, std::size_t r, std::size_t u1, std::size_t leaf_size) : 
-    r_(r), u1_(u1), leaf_size_(leaf_size)
+    return sum;
+}
+
+inline double reduce_lanes(const double* lanes)
+{
+    return ((lanes[0] + lanes[4]) + (lanes[2] + lanes[6])) + ((lanes[1] + lanes[5]) + (lanes[3] + lanes[7]));
+}
+
+// the columns past the last block of 8, added to their lanes
+inline double finish_lanes(double* lanes, const double* u, const double* v, std::size_t k, std::size_t dim)
+{
+    for(; k < dim; k++)
     {
-        data_ = std::make_shared<DF>(data);
+        double diff = u[k] - v[k];
+        lanes[k % 8] += diff * diff;
     }
 
-    std::vector<std::size_t> twin()
+    return reduce_lanes(lanes);
+}
+
+double squared_distance_scalar(const double* u, const double* v, std::size_t dim)
+{
+    double lanes[8] = {0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0};
+    std::size_t k = 0;
+    for(; k + 8 <= dim; k += 8)
+        for(std::size_t l = 0; l < 8; l++)
+        {
+            double diff = u[k + l] - v[k + l];
+            lanes[l] += diff * diff;
+        }
+
+    return finish_lanes(lanes, u, v, k, dim);
+}
+
+// sum of the distances from u to the count consecutive rows starting at rows
+double distance_sum_scalar(const double* u, const double* rows, std::size_t count, std::size_t dim)
+{
+    double lanes[8] = {0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0};
+    for(std::size_t j = 0; j < count; j++)
     {
-        std::size_t N = data_->nrow();
-        std::size_t dim = data_->ncol();
+        const double* v = rows + j * dim;
+        lanes[j % 8] += std::sqrt(dim < SIMD_MIN_DIM ? sequential_squared_distance(u, v, dim) : squared_distance_scalar(u, v, dim));
+    }
 
-        KDTree tree(dim, *data_, nanoflann::KDTreeSingleIndexAdaptorParams(leaf_size_));
-        
-        nanoflann::KNNResultSet<double> resultSet(r_);
-        std::size_t *index = new std::size_t[r_];
-        double *distance = new double[r_];
+    return reduce_lanes(lanes);
+}
 
-        nanoflann::KNNResultSet<double> resultSet_next_u(1);
-        std::size_t index_next_u;
-        double distance_next_u;
+#ifdef TWINNING_X86_DISPATCH
 
-        std::vector<std::size_t> indices;
-        indices.reserve(N / r_ + 1);
-        std::size_t position = u1_;
-        
-        while(true)
+__attribute__((target("sse2")))
+double squared_distance_sse2(const double* u, const double* v, std::size_t dim)
+{
+    __m128d a0 = _mm_setzero_pd(), a2 = _mm_setzero_pd(), a4 = _mm_setzero_pd(), a6 = _mm_setzero_pd();
+    double u_tail[8] = {0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0};
+    double v_tail[8] = {0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0};
+    for(std::size_t k = 0; k < dim; k += 8)
+    {
+        const double* u_k = u + k;
+        const double* v_k = v + k;
+        if(k + 8 > dim)
         {
-            resultSet.init(index, distance);
-            tree.findNeighbors(resultSet, data_->get_row(position), nanoflann::SearchParams());
-            indices.push_back(index[0]);
-            
-            for(std::size_t i = 0; i < r_; i++)
-                tree.removePoint(index[i]);
+            // the last columns, padded with zero differences
+            std::copy(u_k, u + dim, u_tail);
+            std::copy(v_k, v + dim, v_tail);
+            u_k = u_tail;
+            v_k = v_tail;
+        }
 
-            resultSet_next_u.init(&index_next_u, &distance_next_u);
-            tree.findNeighbors(resultSet_next_u, data_->get_row(index[r_ - 1]), nanoflann::SearchParams());  
-            position = index_next_u;
+        __m128d d0 = _mm_sub_pd(_mm_loadu_pd(u_k), _mm_loadu_pd(v_k));
+        __m128d d2 = _mm_sub_pd(_mm_loadu_pd(u_k + 2), _mm_loadu_pd(v_k + 2));
+        __m128d d4 = _mm_sub_pd(_mm_loadu_pd(u_k + 4), _mm_loadu_pd(v_k + 4));
+        __m128d d6 = _mm_sub_pd(_mm_loadu_pd(u_k + 6), _mm_loadu_pd(v_k + 6));
+        a0 = _mm_add_pd(a0, _mm_mul_pd(d0, d0));
+        a2 = _mm_add_pd(a2, _mm_mul_pd(d2, d2));
+        a4 = _mm_add_pd(a4, _mm_mul_pd(d4, d4));
+        a6 = _mm_add_pd(a6, _mm_mul_pd(d6, d6));
+    }
+
+    __m128d half = _mm_add_pd(_mm_add_pd(a0, a4), _mm_add_pd(a2, a6));
+    return _mm_cvtsd_f64(_mm_add_sd(half, _mm_unpackhi_pd(half, half)));
+}
 
-            if(N - indices.size() * r_ <= r_)
+__attribute__((target("sse2")))
+double distance_sum_sse2(const double* u, const double* rows, std::size_t count, std::size_t dim)
+{
+    double lanes[8] = {0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0};
+    std::size_t j = 0;
+    if(dim < SIMD_MIN_DIM)
+    {
+        __m128d a[4] = {_mm_setzero_pd(), _mm_setzero_pd(), _mm_setzero_pd(), _mm_setzero_pd()};
+        for(; j + 8 <= count; j += 8)
+            for(std::size_t p = 0; p < 4; p++)
             {
-                indices.push_back(position);
-                break;
+                const double* v0 = rows + (j + 2 * p) * dim;
+                const double* v1 = v0 + dim;
+                __m128d sum = _mm_setzero_pd();
+                for(std::size_t k = 0; k < dim; k++)
+                {
+                    __m128d diff = _mm_sub_pd(_mm_set1_pd(u[k]), _mm_set_pd(v1[k], v0[k]));
+                    sum = _mm_add_pd(sum, _mm_mul_pd(diff, diff));
+                }
+                a[p] = _mm_add_pd(a[p], _mm_sqrt_pd(sum));
             }
-        }
 
-        delete[] index;
-        delete[] distance;
+        for(std::size_t p = 0; p < 4; p++)
+            _mm_storeu_pd(lanes + 2 * p, a[p]);
+    }
 
-        return indices;
+    for(; j < count; j++)
+    {
+        const double* v = rows + j * dim;
+        lanes[j % 8] += std::sqrt(dim < SIMD_MIN_DIM ? sequential_squared_distance(u, v, dim) : squared_distance_sse2(u, v, dim));
     }
 
-    std::vector<std::size_t> get_sequence()
+    return reduce_lanes(lanes);
+}
+
+// ((0 + 4) + (2 + 6)) + ((1 + 5) + (3 + 7)) of the lanes lo = (0, 1, 2, 3) and hi = (4, 5, 6, 7)
+__attribute__((target("avx2")))
+inline double reduce_lanes_avx2(__m256d lo, __m256d hi)
+{
+    __m256d sum = _mm256_add_pd(lo, hi);
+    __m128d half = _mm_add_pd(_mm256_castpd256_pd128(sum), _mm256_extractf128_pd(sum, 1));
+    return _mm_cvtsd_f64(_mm_add_sd(half, _mm_unpackhi_pd(half, half)));
+}
+
+__attribute__((target("avx2")))
+double squared_distance_avx2(const double* u, const double* v, std::size_t dim)
+{
+    __m256d lo = _mm256_setzero_pd(), hi = _mm256_setzero_pd();
+    std::size_t k = 0;
+    for(; k + 8 <= dim; k += 8)
     {
-        std::size_t N = data_->nrow();
-        std::size_t dim = data_->ncol();
+        __m256d d_lo = _mm256_sub_pd(_mm256_loadu_pd(u + k), _mm256_loadu_pd(v + k));
+        __m256d d_hi = _mm256_sub_pd(_mm256_loadu_pd(u + k + 4), _mm256_loadu_pd(v + k + 4));
+        lo = _mm256_add_pd(lo, _mm256_mul_pd(d_lo, d_lo));
+        hi = _mm256_add_pd(hi, _mm256_mul_pd(d_hi, d_hi));
+    }
 
-        KDTree tree(dim, *data_, nanoflann::KDTreeSingleIndexAdaptorParams(leaf_size_));
-        
-        nanoflann::KNNResultSet<double> resultSet(r_);
-        std::size_t* index = new std::size_t[r_];
-        double* distance = new double[r_];
+    if(k < dim)
+    {
+        // the last columns, padded with zero differences
+        __m256i tail = _mm256_set1_epi64x(static_cast<long long>(dim - k));
+        __m256i mask_lo = _mm256_cmpgt_epi64(tail, _mm256_set_epi64x(3, 2, 1, 0));
+        __m256i mask_hi = _mm256_cmpgt_epi64(tail, _mm256_set_epi64x(7, 6, 5, 4));
+        __m256d d_lo = _mm256_sub_pd(_mm256_maskload_pd(u + k, mask_lo), _mm256_maskload_pd(v + k, mask_lo));
+        __m256d d_hi = _mm256_sub_pd(_mm256_maskload_pd(u + k + 4, mask_hi), _mm256_maskload_pd(v + k + 4, mask_hi));
+        lo = _mm256_add_pd(lo, _mm256_mul_pd(d_lo, d_lo));
+        hi = _mm256_add_pd(hi, _mm256_mul_pd(d_hi, d_hi));
+    }
 
-        nanoflann::KNNResultSet<double> resultSet_next_u(1);
-        std::size_t index_next_u;
-        double distance_next_u;
+    return reduce_lanes_avx2(lo, hi);
+}
 
-        std::vector<std::size_t> sequence;
-        sequence.reserve(N);
-        std::size_t position = u1_;
-        
-        while(sequence.size() != N)
+__attribute__((target("avx2")))
+double distance_sum_avx2(const double* u, const double* rows, std::size_t count, std::size_t dim)
+{
+    double lanes[8] = {0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0};
+    std::size_t j = 0;
+    if(dim < SIMD_MIN_DIM)
+    {
+        __m256d lo = _mm256_setzero_pd(), hi = _mm256_setzero_pd();
+        for(; j + 8 <= count; j += 8)
         {
-            if(sequence.size() > N - r_)
+            const double* v = rows + j * dim;
+            __m256d sum_lo = _mm256_setzero_pd(), sum_hi = _mm256_setzero_pd();
+            for(std::size_t k = 0; k < dim; k++)
             {
-                std::size_t r_f = N - sequence.size();
-                nanoflann::KNNResultSet<double> resultSet_f(r_f);
-                std::size_t* index_f = new std::size_t[r_f];
-                double* distance_f = new double[r_f]; 
+                __m256d u_k = _mm256_set1_pd(u[k]);
+                __m256d d_lo = _mm256_sub_pd(u_k, _mm256_set_pd(v[3 * dim + k], v[2 * dim + k], v[dim + k], v[k]));
+                __m256d d_hi = _mm256_sub_pd(u_k, _mm256_set_pd(v[7 * dim + k], v[6 * dim + k], v[5 * dim + k], v[4 * dim + k]));
+                sum_lo = _mm256_add_pd(sum_lo, _mm256_mul_pd(d_lo, d_lo));
+                sum_hi = _mm256_add_pd(sum_hi, _mm256_mul_pd(d_hi, d_hi));
+            }
+            lo = _mm256_add_pd(lo, _mm256_sqrt_pd(sum_lo));
+            hi = _mm256_add_pd(hi, _mm256_sqrt_pd(sum_hi));
+        }
 
-                resultSet_f.init(index_f, distance_f);
-                tree.findNeighbors(resultSet_f, data_->get_row(position), nanoflann::SearchParams());
+        _mm256_storeu_pd(lanes, lo);
+        _mm256_storeu_pd(lanes + 4, hi);
+    }
 
-                for(std::size_t i = 0; i < r_f; i++)
-                    sequence.push_back(index_f[i]);
+    for(; j < count; j++)
+    {
+        const double* v = rows + j * dim;
+        lanes[j % 8] += std::sqrt(dim < SIMD_MIN_DIM ? sequential_squared_distance(u, v, dim) : squared_distance_avx2(u, v, dim));
+    }
 
-                delete[] index_f;
-                delete[] distance_f;
+    return reduce_lanes(lanes);
+}
 
-                break;
-            }
+__attribute__((target("avx2,avx512f")))
+double squared_distance_avx512(const double* u, const double* v, std::size_t dim)
+{
+    __m512d acc = _mm512_setzero_pd();
+    std::size_t k = 0;
+    for(; k + 8 <= dim; k += 8)
+    {
+        __m512d diff = _mm512_sub_pd(_mm512_loadu_pd(u + k), _mm512_loadu_pd(v + k));
+        acc = _mm512_add_pd(acc, _mm512_mul_pd(diff, diff));
+    }
 
-            resultSet.init(index, distance);
-            tree.findNeighbors(resultSet, data_->get_row(position), nanoflann::SearchParams());
-            
-            for(std::size_t i = 0; i < r_; i++)
-            {
-                sequence.push_back(index[i]);
-                tree.removePoint(index[i]);
-            }
+    if(k < dim)
+    {
+        // the last columns, padded with zero differences
+        __mmask8 mask = static_cast<__mmask8>((1u << (dim - k)) - 1);
+        __m512d diff = _mm512_sub_pd(_mm512_maskz_loadu_pd(mask, u + k), _mm512_maskz_loadu_pd(mask, v + k));
+        acc = _mm512_add_pd(acc, _mm512_mul_pd(diff, diff));
+    }
 
-            resultSet_next_u.init(&index_next_u, &distance_next_u);
-            tree.findNeighbors(resultSet_next_u, data_->get_row(index[r_ - 1]), nanoflann::SearchParams());  
-            position = index_next_u;
-        }
+    return reduce_lanes_avx2(_mm512_castpd512_pd256(acc), _mm512_extractf64x4_pd(acc, 1));
+}
 
-        delete[] index;
-        delete[] distance;
+// rows of fewer than SIMD_MIN_DIM columns are left to the AVX2 kernel, which is faster than gathers
+__attribute__((target("avx2,avx512f")))
+double distance_sum_avx512(const double* u, const double* rows, std::size_t count, std::size_t dim)
+{
+    if(dim < SIMD_MIN_DIM)
+        return distance_sum_avx2(u, rows, count, dim);
 
-        return sequence;
-    }
+    double lanes[8] = {0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0};
+    for(std::size_t j = 0; j < count; j++)
+        lanes[j % 8] += std::sqrt(squared_distance_avx512(u, rows + j * dim, dim));
+
+    return reduce_lanes(lanes);
+}
+
+#endif
+
+struct DistanceKernels
+{
+    const char* name;
+    double (*squared_distance)(const double*, const double*, std::size_t);
+    double (*distance_sum)(const double*, const double*, std::size_t, std::size_t);
 };
 
+const char* const SIMD_NAMES[] = {"scalar", "sse2", "avx2", "avx512f"};
 
-std::vector<std::size_t> twin_cpp(py::array_t<double> data, std::size_t r, std::size_t u1, std::size_t leaf_size) 
+/*
+    the widest instruction set allowed by the environment variable TWINNING_SIMD,
+    as an index into SIMD_NAMES, or -1 if it names none of them; all of them are
+    allowed if it is not set
+*/
+int simd_limit()
 {
-    Twinning twinning(data, r, u1, leaf_size);
-    return twinning.twin();
+    const char* requested = std::getenv("TWINNING_SIMD");
+    if(requested == nullptr)
+        return 3;
+
+    for(int level = 0; level < 4; level++)
+        if(std::strcmp(requested, SIMD_NAMES[level]) == 0)
+            return level;
+
+    return -1;
 }
 
+/*
+    the widest kernels supported by the processor, as reported by CPUID, unless
+    the environment variable TWINNING_SIMD names a narrower instruction set; an
+    unknown name is ignored here, and reported by a warning on import
+*/
+DistanceKernels select_kernels()
+{
+    const char* const* names = SIMD_NAMES;
+    int limit = simd_limit();
+    if(limit < 0)
+        limit = 3;
 
-std::vector<std::size_t> multiplet_S3_cpp(py::array_t<double> data, std::size_t n, std::size_t u1, std::size_t leaf_size) 
+#ifdef TWINNING_X86_DISPATCH
+    __builtin_cpu_init();
+    if(limit >= 3 && __builtin_cpu_supports("avx512f") && __builtin_cpu_supports("avx2"))
+        return {names[3], squared_distance_avx512, distance_sum_avx512};
+    if(limit >= 2 && __builtin_cpu_supports("avx2"))
+        return {names[2], squared_distance_avx2, distance_sum_avx2};
+    if(limit >= 1 && __builtin_cpu_supports("sse2"))
+        return {names[1], squared_distance_sse2, distance_sum_sse2};
+#endif
+    return {names[0], squared_distance_scalar, distance_sum_scalar};
+}
+
+const DistanceKernels distance_kernels = select_kernels();
+
+
+inline double squared_distance(const double* u, const double* v, std::size_t dim)
 {
-    Twinning twinning(data, n, u1, leaf_size);
-    return twinning.get_sequence();
+    if(dim < SIMD_MIN_DIM)
+        return sequential_squared_distance(u, v, dim);
+
+    return distance_kernels.squared_distance(u, v, dim);
 }
 
+// sum of the distances from u to the count consecutive rows starting at rows
+inline double row_distance_sum(const double* u, const double* rows, std::size_t count, std::size_t dim)
+{
+    return distance_kernels.distance_sum(u, rows, count, dim);
+}
 
-double energy_cpp(py::array_t<double> data, py::array_t<double> points)
+std::string simd_cpp()
 {
-    DF D(data), sp(points);
-    std::size_t dim = D.ncol();
-    std::size_t N = D.nrow();
-    std::size_t n = sp.nrow();
+    return distance_kernels.name;
+}
 
-    std::vector<double> ed_1;
-    std::vector<double> ed_2;
-    ed_1.resize(n);
-    ed_2.resize(n);
 
-    #pragma omp parallel for
-    for(int i = 0; i < static_cast<int>(n); i++)
+/*
+    squared Euclidean distance of nanoflann::L2_Adaptor, computed by the
+    distance kernels
+*/
+struct L2_Kernel_Adaptor
+{
+    typedef double ElementType;
+    typedef double DistanceType;
+
+    const DF& data_source;
+
+    L2_Kernel_Adaptor(const DF& data_source) : data_source(data_source) {}
+
+    inline double evalMetric(const double* a, const std::size_t b_idx, std::size_t size) const
     {
-        const double* u_i = sp.get_row(i);
+        return squared_distance(a, data_source.get_row(b_idx), size);
+    }
 
-        double distance_sum = 0.0;
-        double inner_sum = 0.0;
-        for(std::size_t j = 0; j < N; j++)
-        {
-            const double* z_j = D.get_row(j);
+    template <typename U, typename V>
+    inline double accum_dist(const U a, const V b, const std::size_t) const
+    {
+        return (a - b) * (a - b);
+    }
+};
 
-            inner_sum = 0.0;
-            for(std::size_t k = 0; k < dim; k++)
-                inner_sum += std::pow(*(u_i + k) - *(z_j + k), 2);
 
-            distance_sum += std::sqrt(inner_sum);
+template <class AccessorType>
+using DynamicKDTree = nanoflann::KDTreeSingleIndexDynamicAdaptor<L2_Kernel_Adaptor, DF, -1, AccessorType>;
+typedef nanoflann::KDTreeSingleIndexAdaptor<L2_Kernel_Adaptor, DF, -1, std::size_t> StaticKDTree;
+
+
+/*
+    result set of the k nearest neighbors in a bounded max-heap, so that adding a
+    point costs O(log k) rather than the O(k) of the insertion sort in
+    nanoflann::KNNResultSet; the storage of the heap is supplied by the caller,
+    to be reused by consecutive searches, and sort() writes the neighbors in
+    increasing order of distance, and of index among ties
+*/
+class HeapResultSet
+{
+public:
+    typedef double DistanceType;
+    typedef std::size_t IndexType;
+
+    // rows at equal distances are ordered by their insertion, as in nanoflann::KNNResultSet
+    struct Entry
+    {
+        double dist;
+        std::size_t order;
+        std::size_t index;
+
+        bool operator<(const Entry& other) const
+        {
+            return dist < other.dist || (dist == other.dist && order < other.order);
         }
+    };
 
-        ed_1[i] = distance_sum;
+private:
+    const std::size_t capacity_;
+    std::vector<Entry>& heap_;
+    std::size_t* indices_ = nullptr;
+    double* dists_ = nullptr;
+    std::size_t n_added_ = 0;
 
-        distance_sum = 0.0;
-        for(int j = 0; j < static_cast<int>(n); j++)
-            if(j != i)
-            {
-                const double* u_j = sp.get_row(j);
+public:
 
-                inner_sum = 0.0;
-                for(std::size_t k = 0; k < dim; k++)
-                    inner_sum += std::pow(*(u_i + k) - *(u_j + k), 2); 
+    HeapResultSet(std::size_t capacity, std::vector<Entry>& storage) : capacity_(capacity), heap_(storage) {}
 
-                distance_sum += std::sqrt(inner_sum);
-            }
+    void init(std::size_t* indices, double* dists)
+    {
+        indices_ = indices;
+        dists_ = dists;
+        heap_.clear();
+        heap_.reserve(capacity_);
+        n_added_ = 0;
+    }
 
-        ed_2[i] = distance_sum;
+    /*
+        functions required by nanoflann
+    */
+    std::size_t size() const
+    {
+        return heap_.size();
     }
 
-    double sum1 = 0.0;
-    double sum2 = 0.0;
-    for(std::size_t i = 0; i < n; i++)
+    bool full() const
     {
-        sum1 += ed_1[i];
-        sum2 += ed_2[i];
+        return heap_.size() == capacity_;
     }
 
-    return 2.0 * sum1 / (N * n) - sum2 / (n * n);
+    bool addPoint(double dist, std::size_t index)
+    {
+        Entry entry = {dist, n_added_++, index};
+        if(heap_.size() < capacity_)
+        {
+            heap_.push_back(entry);
+            std::push_heap(heap_.begin(), heap_.end());
+        }
+        else if(dist < heap_.front().dist)
+        {
+            std::pop_heap(heap_.begin(), heap_.end());
+            heap_.back() = entry;
+            std::push_heap(heap_.begin(), heap_.end());
+        }
+
+        return true;
+    }
+
+    double worstDist() const
+    {
+        return full() ? heap_.front().dist : std::numeric_limits<double>::max();
+    }
+
+    void sort()
+    {
+        std::sort_heap(heap_.begin(), heap_.end());
+        for(std::size_t i = 0; i < heap_.size(); i++)
+        {
+            dists_[i] = heap_[i].dist;
+            indices_[i] = heap_[i].index;
+        }
+    }
+};
+
+// number of neighbors from which a search collects its result in a HeapResultSet
+const std::size_t HEAP_MIN_NEIGHBORS = 32;
+
+
+/*
+    number of threads for a parallel region; a non-positive request defers to the
+    OpenMP default, which follows OMP_NUM_THREADS and threadpoolctl-style limits
+*/
+inline int resolve_threads(int n_threads)
+{
+#ifdef _OPENMP
+    return n_threads > 0 ? n_threads : omp_get_max_threads();
+#else
+    return 1;
+#endif
 }
 
 
-PYBIND11_MODULE(twinning_cpp, m){
-    m.doc() = R"pbdoc(
-        .. currentmodule:: twinning_cpp
+// index of the calling thread within its parallel region
+inline int thread_number()
+{
+#ifdef _OPENMP
+    return omp_get_thread_num();
+#else
+    return 0;
+#endif
+}
 
-        .. autosummary::
-           :toctree: _generate
 
-           twin_cpp
-           multiplet_S3_cpp
-           energy_cpp
-    )pbdoc";
+int max_threads_cpp()
+{
+    return resolve_threads(0);
+}
 
-    m.def("twin_cpp", &twin_cpp, R"pbdoc(
-        Partition a dataset into statistically similar twin sets (C++ extension).
-    )pbdoc");
 
-    m.def("multiplet_S3_cpp", &multiplet_S3_cpp, R"pbdoc(
-        Generate multiplets using strategy 3 (C++ extension).
-    )pbdoc");
+/*
+    dynamic kd-tree whose removed points can be restored, so that the tree can be
+    reused by several twinning runs instead of being rebuilt for each of them; the
+    leaves refer to the points by AccessorType, e.g., 32-bit integers, which
+    halve the memory of the leaves of a tree of fewer than 2^32 points
+*/
+template <class AccessorType>
+class BasicKDTree : public DynamicKDTree<AccessorType>
+{
+private:
+    typedef DynamicKDTree<AccessorType> Base;
+    typedef typename Base::index_container_t index_container_t;
+    typedef typename index_container_t::Node Node;
 
-    m.def("energy_cpp", &energy_cpp, R"pbdoc(
-        Energy distance computation (C++ extension).
-    )pbdoc");
+    using Base::dataset;
+    using Base::treeIndex;
+    using Base::treeCount;
+    using Base::pointCount;
+    using Base::index;
+
+    /*
+        nanoflann keeps a sub-tree for every bit of the number of points, up to
+        a default of 1e9 points; larger datasets get the sub-trees they need
+    */
+    static std::size_t capacity(std::size_t N)
+    {
+        return std::max<std::size_t>(N, 1000000000);
+    }
+
+    /*
+        root-to-leaf path of the last warm search in a sub-tree, with the box of
+        every node bounded by the mid planes (divlow + divhigh) / 2 of its
+        ancestors, i.e., the region of the queries whose descent passes the node
+    */
+    struct Path
+    {
+        std::vector<const Node*> nodes;
+        std::vector<double> lows;
+        std::vector<double> highs;
+    };
+
+    std::vector<int> initial_;
+    std::vector<Path> paths_;
+    std::vector<double> dists_;
+
+    // nanoflann's search below a node of a sub-tree, given a lower bound on the distance to the node
+    template <class RESULTSET>
+    void search(RESULTSET& result, const double* query, const index_container_t& tree, const Node* node, double mindistsq, std::vector<double>& dists) const
+    {
+        std::size_t dim = dataset.ncol();
+        if(node->child1 == nullptr && node->child2 == nullptr)
+        {
+            double worst = result.worstDist();
+            for(std::size_t i = node->node_type.lr.left; i < node->node_type.lr.right; i++)
+            {
+                std::size_t idx = tree.vAcc[i];
+                if(treeIndex[idx] == -1)
+                    continue;
+
+                double distance = squared_distance(query, dataset.get_row(idx), dim);
+                if(distance < worst)
+                {
+                    result.addPoint(distance, idx);
+                    worst = result.worstDist();
+                }
+            }
+            return;
+        }
+
+        int feature = node->node_type.sub.divfeat;
+        double value = query[feature];
+        double diff1 = value - node->node_type.sub.divlow;
+        double diff2 = value - node->node_type.sub.divhigh;
+
+        const Node* best = diff1 + diff2 < 0 ? node->child1 : node->child2;
+        const Node* other = diff1 + diff2 < 0 ? node->child2 : node->child1;
+        double cut_dist = diff1 + diff2 < 0 ? diff2 * diff2 : diff1 * diff1;
+
+        search(result, query, tree, best, mindistsq, dists);
+
+        double dst = dists[feature];
+        mindistsq = mindistsq + cut_dist - dst;
+        dists[feature] = cut_dist;
+        if(mindistsq <= result.worstDist())
+            search(result, query, tree, other, mindistsq, dists);
+        dists[feature] = dst;
+    }
+
+    /*
+        a sub-tree as by nanoflann's saveIndex() and loadIndex(), except that the
+        indices of the points are written as 64-bit integers whatever AccessorType
+        is, so that saved trees do not depend on the width of the indices
+    */
+    static void save_index(std::ostream& stream, index_container_t& tree)
+    {
+        nanoflann::save_value(stream, tree.m_size);
+        nanoflann::save_value(stream, tree.dim);
+        nanoflann::save_value(stream, tree.root_bbox);
+        nanoflann::save_value(stream, tree.m_leaf_max_size);
+        nanoflann::save_value(stream, std::vector<std::uint64_t>(tree.vAcc.begin(), tree.vAcc.end()));
+        tree.save_tree(tree, stream, tree.root_node);
+    }
+
+    static void load_index(std::istream& stream, index_container_t& tree)
+    {
+        std::vector<std::uint64_t> indices;
+        nanoflann::load_value(stream, tree.m_size);
+        nanoflann::load_value(stream, tree.dim);
+        nanoflann::load_value(stream, tree.root_bbox);
+        nanoflann::load_value(stream, tree.m_leaf_max_size);
+        nanoflann::load_value(stream, indices);
+        tree.vAcc.assign(indices.begin(), indices.end());
+        tree.load_tree(tree, stream, tree.root_node);
+    }
+
+    bool inside(const Path& path, std::size_t depth, const double* query, std::size_t dim) const
+    {
+        for(std::size_t k = 0; k < dim; k++)
+            if(query[k] < path.lows[depth * dim + k] || query[k] >= path.highs[depth * dim + k])
+                return false;
+        return true;
+    }
+
+public:
+    BasicKDTree(const DF& data, std::size_t leaf_size) : 
+    Base(data.ncol(), data, nanoflann::KDTreeSingleIndexAdaptorParams(leaf_size), capacity(data.nrow()))
+    {
+        // the sub-trees emptied while the points were inserted keep the memory of their indices otherwise
+        for(std::size_t i = 0; i < treeCount; i++)
+            index[i].vAcc.shrink_to_fit();
+
+        initial_ = treeIndex;
+    }
+
+    // restores a tree written by save() for the same data, without building it again
+    BasicKDTree(const DF& data, std::size_t leaf_size, const std::string& serialized) : 
+    Base(data.ncol(), data, nanoflann::KDTreeSingleIndexAdaptorParams(leaf_size, nanoflann::KDTreeSingleIndexAdaptorFlags::SkipInitialBuildIndex), capacity(data.nrow()))
+    {
+        std::istringstream stream(serialized);
+        std::size_t tree_count = 0;
+
+        nanoflann::load_value(stream, pointCount);
+        nanoflann::load_value(stream, tree_count);
+        nanoflann::load_value(stream, initial_);
+        if(!stream || pointCount != data.nrow() || initial_.size() != pointCount || tree_count != treeCount)
+            throw std::runtime_error("the saved kd-tree does not match the data");
+
+        for(std::size_t i = 0; i < treeCount; i++)
+        {
+            std::uint8_t built = 0;
+            nanoflann::load_value(stream, built);
+            if(built)
+                load_index(stream, index[i]);
+
+            if(!stream || (built && index[i].dim != static_cast<int>(data.ncol())))
+                throw std::runtime_error("the saved kd-tree does not match the data");
+        }
+
+        treeIndex = initial_;
+    }
+
+    // the sub-trees of the unmodified tree, i.e., without the removals
+    std::string save()
+    {
+        std::ostringstream stream;
+
+        nanoflann::save_value(stream, pointCount);
+        nanoflann::save_value(stream, treeCount);
+        nanoflann::save_value(stream, initial_);
+        for(std::size_t i = 0; i < treeCount; i++)
+        {
+            std::uint8_t built = !index[i].vAcc.empty();
+            nanoflann::save_value(stream, built);
+            if(built)
+                save_index(stream, index[i]);
+        }
+
+        return stream.str();
+    }
+
+    /*
+        same neighbors as findNeighbors(), up to ties, for queries close to the
+        previous one, e.g., the consecutive queries of the twinning walk; in
+        every sub-tree, largest first, the search starts from the deepest node
+        of the previous path whose box contains the query, rather than from the
+        root, and then visits the siblings of the path bottom-up, as the
+        recursion from the root would
+    */
+    template <class RESULTSET>
+    void findNeighborsWarm(RESULTSET& result, const double* query)
+    {
+        std::size_t dim = dataset.ncol();
+        paths_.resize(treeCount);
+        dists_.assign(dim, 0.0);
+
+        for(std::size_t i = treeCount; i-- > 0; )
+        {
+            const index_container_t& tree = index[i];
+            if(tree.vAcc.empty() || tree.root_node == nullptr)
+                continue;
+
+            double bbox_dist = 0.0;
+            for(std::size_t k = 0; k < dim; k++)
+            {
+                if(query[k] < tree.root_bbox[k].low)
+                    bbox_dist += (tree.root_bbox[k].low - query[k]) * (tree.root_bbox[k].low - query[k]);
+                else if(query[k] > tree.root_bbox[k].high)
+                    bbox_dist += (query[k] - tree.root_bbox[k].high) * (query[k] - tree.root_bbox[k].high);
+            }
+            if(bbox_dist > result.worstDist())
+                continue;
+
+            Path& path = paths_[i];
+            if(path.nodes.empty() || path.nodes[0] != tree.root_node)
+            {
+                path.nodes.assign(1, tree.root_node);
+                path.lows.assign(dim, -std::numeric_limits<double>::infinity());
+                path.highs.assign(dim, std::numeric_limits<double>::infinity());
+            }
+
+            std::size_t depth = path.nodes.size() - 1;
+            while(depth > 0 && !inside(path, depth, query, dim))
+                depth--;
+
+            path.nodes.resize(depth + 1);
+            path.lows.resize((depth + 1) * dim);
+            path.highs.resize((depth + 1) * dim);
+
+            const Node* node = path.nodes[depth];
+            while(node->child1 != nullptr || node->child2 != nullptr)
+            {
+                int feature = node->node_type.sub.divfeat;
+                double mid = (node->node_type.sub.divlow + node->node_type.sub.divhigh) / 2;
+                bool first = query[feature] - node->node_type.sub.divlow + query[feature] - node->node_type.sub.divhigh < 0;
+
+                path.lows.insert(path.lows.end(), path.lows.end() - dim, path.lows.end());
+                path.highs.insert(path.highs.end(), path.highs.end() - dim, path.highs.end());
+                if(first)
+                    path.highs[path.highs.size() - dim + feature] = mid;
+                else
+                    path.lows[path.lows.size() - dim + feature] = mid;
+
+                node = first ? node->child1 : node->child2;
+                path.nodes.push_back(node);
+            }
+
+            search(result, query, tree, node, 0.0, dists_);
+            for(std::size_t d = path.nodes.size() - 1; d > 0; d--)
+            {
+                const Node* parent = path.nodes[d - 1];
+                int feature = parent->node_type.sub.divfeat;
+                double value = query[feature];
+
+                const Node* sibling;
+                double cut_dist = 0.0;
+                if(path.nodes[d] == parent->child1)
+                {
+                    sibling = parent->child2;
+                    if(value < parent->node_type.sub.divhigh)
+                        cut_dist = (parent->node_type.sub.divhigh - value) * (parent->node_type.sub.divhigh - value);
+                }
+                else
+                {
+                    sibling = parent->child1;
+                    if(value > parent->node_type.sub.divlow)
+                        cut_dist = (value - parent->node_type.sub.divlow) * (value - parent->node_type.sub.divlow);
+                }
+
+                if(cut_dist <= result.worstDist())
+                {
+                    dists_[feature] = cut_dist;
+                    search(result, query, tree, sibling, cut_dist, dists_);
+                    dists_[feature] = 0.0;
+                }
+            }
+        }
+    }
+
+    /*
+        renumbers the points in the order of the leaves, so that the rows scanned
+        in a leaf are contiguous in memory; the rows are written in the new order
+        to buffer, to which the data must be rebound before the next search, and
+        the original number of every new point is returned
+    */
+    std::vector<std::size_t> reorder(std::vector<double>& buffer)
+    {
+        std::size_t dim = dataset.ncol();
+        std::vector<std::size_t> order;
+        order.reserve(pointCount);
+        for(std::size_t i = 0; i < treeCount; i++)
+            for(std::size_t j = 0; j < index[i].vAcc.size(); j++)
+            {
+                order.push_back(index[i].vAcc[j]);
+                index[i].vAcc[j] = static_cast<AccessorType>(order.size() - 1);
+            }
+
+        buffer.resize(order.size() * dim);
+        std::vector<int> tree_index(order.size());
+        std::vector<int> initial(order.size());
+        for(std::size_t i = 0; i < order.size(); i++)
+        {
+            std::copy(dataset.get_row(order[i]), dataset.get_row(order[i]) + dim, buffer.begin() + i * dim);
+            tree_index[i] = treeIndex[order[i]];
+            initial[i] = initial_[order[i]];
+        }
+
+        treeIndex.swap(tree_index);
+        initial_.swap(initial);
+        paths_.clear();
+
+        return order;
+    }
+
+    // inserts the rows first, ..., last, which must have been appended to the data
+    void append(std::size_t first, std::size_t last)
+    {
+        paths_.clear();
+        // the sub-trees that addPoints() rebuilds, by the positions of the lowest zero bits of the counts
+        std::size_t rebuilt = 0;
+        for(std::size_t count = pointCount; count <= pointCount + last - first; count++)
+        {
+            std::size_t pos = 0;
+            for(std::size_t bits = count; bits & 1; bits >>= 1)
+                pos++;
+            rebuilt = std::max(rebuilt, pos);
+        }
+
+        this->addPoints(first, last);
+        initial_.resize(treeIndex.size());
+        for(std::size_t i = 0; i <= rebuilt; i++)
+            for(std::size_t j = 0; j < index[i].vAcc.size(); j++)
+                initial_[index[i].vAcc[j]] = static_cast<int>(i);
+    }
+
+    // lazy deletion; unlike the base class, removed points are not recorded for re-insertion
+    void removePoint(std::size_t idx)
+    {
+        if(idx < pointCount)
+            treeIndex[idx] = -1;
+    }
+
+    bool removed(std::size_t idx) const
+    {
+        return treeIndex[idx] == -1;
+    }
+
+    // restores every point
+    void reset()
+    {
+        treeIndex = initial_;
+    }
+
+    // restores the given points, and removes all others
+    void reset(const std::vector<std::size_t>& rows)
+    {
+        std::fill(treeIndex.begin(), treeIndex.end(), -1);
+        for(std::size_t i = 0; i < rows.size(); i++)
+            treeIndex[rows[i]] = initial_[rows[i]];
+    }
+};
+
+typedef BasicKDTree<std::size_t> KDTree;
+typedef BasicKDTree<std::uint32_t> CompactKDTree;
+
+/*
+    the width of the indices in the kd-trees requested by the environment variable
+    TWINNING_INDEX_BITS, i.e., 64 for 64-bit indices in every tree, e.g., to compare
+    them with 32-bit ones, and 32 for 32-bit indices in the trees of fewer than
+    2^32 - 1 points, which is the default; any other value is -1, which is
+    ignored here, and reported by a warning on import
+*/
+int index_bits()
+{
+    const char* requested = std::getenv("TWINNING_INDEX_BITS");
+    if(requested == nullptr || std::strcmp(requested, "32") == 0)
+        return 32;
+    if(std::strcmp(requested, "64") == 0)
+        return 64;
+
+    return -1;
+}
+
+const bool wide_indices = index_bits() == 64;
+
+// whether the rows of a dataset fit the 32-bit indices of a CompactKDTree
+inline bool compact_rows(std::size_t N)
+{
+    return !wide_indices && N < std::numeric_limits<std::uint32_t>::max();
+}
+
+
+/*
+    kd-tree of a dataset that is kept, and possibly grown, by a structure, e.g.,
+    TwinningIndex; it is a CompactKDTree while the points fit 32-bit indices,
+    and a KDTree otherwise. The searches are forwarded to the tree in use, and
+    the twinning walk gets it from compact() or wide(), one of which is null
+*/
+class AdaptiveKDTree
+{
+private:
+    const DF& data_;
+    std::size_t leaf_size_;
+    std::unique_ptr<CompactKDTree> compact_;
+    std::unique_ptr<KDTree> wide_;
+
+public:
+    AdaptiveKDTree(const DF& data, std::size_t leaf_size) : data_(data), leaf_size_(leaf_size)
+    {
+        if(compact_rows(data.nrow()))
+            compact_.reset(new CompactKDTree(data, leaf_size));
+        else
+            wide_.reset(new KDTree(data, leaf_size));
+    }
+
+    // restores a tree written by save(), which does not depend on the width of the indices
+    AdaptiveKDTree(const DF& data, std::size_t leaf_size, const std::string& serialized) : data_(data), leaf_size_(leaf_size)
+    {
+        if(compact_rows(data.nrow()))
+            compact_.reset(new CompactKDTree(data, leaf_size, serialized));
+        else
+            wide_.reset(new KDTree(data, leaf_size, serialized));
+    }
+
+    CompactKDTree* compact()
+    {
+        return compact_.get();
+    }
+
+    KDTree* wide()
+    {
+        return wide_.get();
+    }
+
+    template <class RESULTSET>
+    void findNeighbors(RESULTSET& result, const double* query, const nanoflann::SearchParams& params) const
+    {
+        if(compact_)
+            compact_->findNeighbors(result, query, params);
+        else
+            wide_->findNeighbors(result, query, params);
+    }
+
+    std::string save()
+    {
+        return compact_ ? compact_->save() : wide_->save();
+    }
+
+    /*
+        inserts the rows first, ..., last, which must have been appended to the
+        data; once the rows do not fit 32-bit indices, the tree is rebuilt over
+        all rows with 64-bit indices, once, and the removed points are removed
+        again
+    */
+    void append(std::size_t first, std::size_t last)
+    {
+        if(compact_ && !compact_rows(last + 1))
+        {
+            std::unique_ptr<KDTree> wide(new KDTree(data_, leaf_size_));
+            for(std::size_t i = 0; i < first; i++)
+                if(compact_->removed(i))
+                    wide->removePoint(i);
+
+            compact_.reset();
+            wide_ = std::move(wide);
+            return;
+        }
+
+        if(compact_)
+            compact_->append(first, last);
+        else
+            wide_->append(first, last);
+    }
+
+    void removePoint(std::size_t idx)
+    {
+        if(compact_)
+            compact_->removePoint(idx);
+        else
+            wide_->removePoint(idx);
+    }
+
+    bool removed(std::size_t idx) const
+    {
+        return compact_ ? compact_->removed(idx) : wide_->removed(idx);
+    }
+
+    void reset()
+    {
+        if(compact_)
+            compact_->reset();
+        else
+            wide_->reset();
+    }
+};
+
+
+/*
+    the k nearest live points of query in increasing order of distance, and their
+    number, which is less than k only if fewer points are live; heap is the
+    storage of a HeapResultSet, used for large k
+*/
+template <class TREE>
+std::size_t k_nearest(TREE& tree, const double* query, std::size_t k, std::size_t* index, double* distance, std::vector<HeapResultSet::Entry>& heap, bool warm = false)
+{
+    if(k < HEAP_MIN_NEIGHBORS)
+    {
+        nanoflann::KNNResultSet<double> resultSet(k);
+        resultSet.init(index, distance);
+        if(warm)
+            tree.findNeighborsWarm(resultSet, query);
+        else
+            tree.findNeighbors(resultSet, query, nanoflann::SearchParams());
+        return resultSet.size();
+    }
+
+    HeapResultSet resultSet(k, heap);
+    resultSet.init(index, distance);
+    if(warm)
+        tree.findNeighborsWarm(resultSet, query);
+    else
+        tree.findNeighbors(resultSet, query, nanoflann::SearchParams());
+    resultSet.sort();
+    return resultSet.size();
+}
+
+
+template <class TREE>
+class BasicTwinning
+{
+private:
+    const std::size_t r_;
+    const std::size_t u1_;
+    const std::size_t N_;
+    const DF& data_;
+    TREE& tree_;
+    const bool warm_start_;
+    const std::size_t prefetch_;
+
+    /*
+        candidate pool of the last tree search: the k + prefetch_ nearest rows of
+        center_, i.e., every live row closer than radius_ to center_, as long as
+        the removed rows are skipped
+    */
+    std::vector<std::size_t> pool_;
+    std::vector<double> pool_dists_;
+    std::vector<double> distances_;
+    std::vector<HeapResultSet::Entry> heap_;
+    std::vector<std::pair<double, std::size_t>> candidates_;
+    std::vector<char> removed_;
+    const double* center_ = nullptr;
+    double radius_ = 0.0;
+
+    /*
+        the k nearest live rows of the pool, if they are provably the k nearest
+        live rows of the dataset: a row outside the pool is at least
+        radius_ - |query - center_| away from query
+    */
+    bool from_pool(const double* query, std::size_t k, std::size_t* index)
+    {
+        std::size_t dim = data_.ncol();
+        double rho = std::sqrt(squared_distance(query, center_, dim));
+        double bound = radius_ - rho;
+        if(bound <= 0.0)
+            return false;
+
+        // the pool is sorted by the distances to center_, which exceed the distances to query by at most rho,
+        // so that the scan stops at bound, or at the k-th nearest candidate once k candidates are held
+        double bound_sq = bound * bound;
+        double limit = bound;
+        candidates_.clear();
+        std::size_t live = 0;
+        std::size_t i = 0;
+        for(; i < pool_.size(); i++)
+        {
+            std::size_t row = pool_[i];
+            if(removed_[row])
+                continue;
+
+            if(pool_dists_[i] - rho >= limit)
+                break;
+
+            pool_dists_[live] = pool_dists_[i];
+            pool_[live++] = row;
+            double distance = squared_distance(query, data_.get_row(row), dim);
+            if(distance >= bound_sq)
+                continue;
+
+            std::pair<double, std::size_t> candidate(distance, row);
+            if(candidates_.size() < k)
+            {
+                candidates_.push_back(candidate);
+                std::push_heap(candidates_.begin(), candidates_.end());
+            }
+            else if(candidate < candidates_.front())
+            {
+                std::pop_heap(candidates_.begin(), candidates_.end());
+                candidates_.back() = candidate;
+                std::push_heap(candidates_.begin(), candidates_.end());
+            }
+
+            if(candidates_.size() == k)
+                limit = std::sqrt(candidates_.front().first);
+        }
+
+        // the rest of the pool was not scanned, and its removed rows are skipped by later scans
+        std::copy(pool_.begin() + i, pool_.end(), pool_.begin() + live);
+        std::copy(pool_dists_.begin() + i, pool_dists_.end(), pool_dists_.begin() + live);
+        pool_.resize(live + pool_.size() - i);
+        pool_dists_.resize(pool_.size());
+
+        if(candidates_.size() < k)
+            return false;
+
+        std::sort_heap(candidates_.begin(), candidates_.end());
+        for(std::size_t j = 0; j < k; j++)
+            index[j] = candidates_[j].second;
+
+        return true;
+    }
+
+    /*
+        the k nearest live rows of query, in increasing order of distance; a
+        search of the tree for k > 1 neighbors fetches prefetch_ extra rows into
+        the pool, whereas a single nearest neighbor that cannot be taken from the
+        pool is searched for in the tree without replacing the pool
+    */
+    void nearest(const double* query, std::size_t k, std::size_t* index)
+    {
+        if(prefetch_ > 0 && center_ != nullptr && from_pool(query, k, index))
+            return;
+
+        if(prefetch_ == 0 || k == 1)
+        {
+            distances_.resize(k);
+            k_nearest(tree_, query, k, index, distances_.data(), heap_, warm_start_);
+            return;
+        }
+
+        std::size_t K = k + prefetch_;
+        pool_.resize(K);
+        pool_dists_.resize(K);
+        std::size_t found = k_nearest(tree_, query, K, pool_.data(), pool_dists_.data(), heap_, warm_start_);
+
+        pool_.resize(found);
+        pool_dists_.resize(found);
+        for(std::size_t i = 0; i < pool_dists_.size(); i++)
+            pool_dists_[i] = std::sqrt(pool_dists_[i]);
+
+        center_ = query;
+        radius_ = found == K ? pool_dists_[K - 1] : std::numeric_limits<double>::infinity();
+        std::copy(pool_.begin(), pool_.begin() + k, index);
+    }
+
+    void remove(std::size_t row)
+    {
+        tree_.removePoint(row);
+        if(prefetch_ > 0)
+            removed_[row] = 1;
+    }
+
+public:
+    BasicTwinning(const DF& data, TREE& tree, std::size_t N_, std::size_t r, std::size_t u1, bool warm_start = false, std::size_t prefetch = 0) : 
+    r_(r), u1_(u1), N_(N_), data_(data), tree_(tree), warm_start_(warm_start), prefetch_(prefetch)
+    {
+        if(prefetch_ > 0)
+            removed_.assign(data_.nrow(), 0);
+    }
+
+    std::vector<std::size_t> twin()
+    {
+        std::vector<std::size_t> index(r_);
+        std::size_t index_next_u;
+
+        std::vector<std::size_t> indices;
+        indices.reserve(N_ / r_ + 1);
+        std::size_t position = u1_;
+        
+        while(true)
+        {
+            nearest(data_.get_row(position), r_, index.data());
+            indices.push_back(index[0]);
+            
+            for(std::size_t i = 0; i < r_; i++)
+                remove(index[i]);
+
+            nearest(data_.get_row(index[r_ - 1]), 1, &index_next_u);
+            position = index_next_u;
+
+            if(N_ - indices.size() * r_ <= r_)
+            {
+                indices.push_back(position);
+                break;
+            }
+        }
+
+        return indices;
+    }
+
+    std::vector<std::size_t> get_sequence()
+    {
+        std::vector<std::size_t> index(r_);
+        std::size_t index_next_u;
+
+        std::vector<std::size_t> sequence;
+        sequence.reserve(N_);
+        std::size_t position = u1_;
+        
+        while(sequence.size() != N_)
+        {
+            if(sequence.size() > N_ - r_)
+            {
+                std::size_t r_f = N_ - sequence.size();
+                nearest(data_.get_row(position), r_f, index.data());
+
+                for(std::size_t i = 0; i < r_f; i++)
+                    sequence.push_back(index[i]);
+
+                break;
+            }
+
+            nearest(data_.get_row(position), r_, index.data());
+            
+            for(std::size_t i = 0; i < r_; i++)
+            {
+                sequence.push_back(index[i]);
+                remove(index[i]);
+            }
+
+            nearest(data_.get_row(index[r_ - 1]), 1, &index_next_u);
+            position = index_next_u;
+        }
+
+        return sequence;
+    }
+};
+
+typedef BasicTwinning<KDTree> Twinning;
+
+
+/*
+    hash and equality of rows given by pointers to their first elements, so that
+    exact duplicates fall into the same bucket; -0.0 and 0.0 are equal
+*/
+struct RowHash
+{
+    std::size_t dim;
+
+    std::size_t operator()(const double* row) const
+    {
+        std::uint64_t hash = 14695981039346656037ULL;
+        for(std::size_t i = 0; i < dim; i++)
+        {
+            double value = row[i] == 0.0 ? 0.0 : row[i];
+            std::uint64_t bits;
+            std::memcpy(&bits, &value, sizeof(bits));
+            hash = (hash ^ bits) * 1099511628211ULL;
+            hash ^= hash >> 32;
+        }
+        return static_cast<std::size_t>(hash);
+    }
+};
+
+struct RowEqual
+{
+    std::size_t dim;
+
+    bool operator()(const double* u, const double* v) const
+    {
+        for(std::size_t i = 0; i < dim; i++)
+            if(u[i] != v[i])
+                return false;
+        return true;
+    }
+};
+
+
+/*
+    groups the exact duplicates among the rows of D; group g consists of the rows
+    members[offsets[g]], ..., members[offsets[g + 1] - 1] in increasing order, and
+    the groups are ordered by their first row
+*/
+void group_duplicates(const DF& D, std::vector<std::size_t>& offsets, std::vector<std::size_t>& members)
+{
+    std::size_t N = D.nrow();
+    std::unordered_map<const double*, std::size_t, RowHash, RowEqual> groups(N, RowHash{D.ncol()}, RowEqual{D.ncol()});
+    std::vector<std::size_t> group(N);
+
+    for(std::size_t i = 0; i < N; i++)
+        group[i] = groups.emplace(D.get_row(i), groups.size()).first->second;
+
+    offsets.assign(groups.size() + 1, 0);
+    for(std::size_t i = 0; i < N; i++)
+        offsets[group[i] + 1]++;
+    for(std::size_t g = 0; g < groups.size(); g++)
+        offsets[g + 1] += offsets[g];
+
+    std::vector<std::size_t> position(offsets.begin(), offsets.end() - 1);
+    members.resize(N);
+    for(std::size_t i = 0; i < N; i++)
+        members[position[group[i]]++] = i;
+}
+
+
+/*
+    twinning over weighted unique rows, each standing for weights_[i] identical
+    rows of the dataset; the walk removes the same number of rows per step as
+    twinning over the dataset itself, but takes every run of whole steps on a
+    single unique row at once, and consumes the weights of partly removed rows
+*/
+template <class TREE>
+class WeightedTwinning
+{
+private:
+    const std::size_t r_;
+    const std::size_t u1_;
+    const DF& data_;
+    TREE& tree_;
+    std::vector<std::size_t> weights_;
+
+    std::size_t next_position(std::size_t last)
+    {
+        if(weights_[last] > 0)
+            return last;
+
+        nanoflann::KNNResultSet<double> resultSet_next_u(1);
+        std::size_t index_next_u;
+        double distance_next_u;
+
+        resultSet_next_u.init(&index_next_u, &distance_next_u);
+        tree_.findNeighbors(resultSet_next_u, data_.get_row(last), nanoflann::SearchParams());
+        return index_next_u;
+    }
+
+public:
+    WeightedTwinning(const DF& data, TREE& tree, const std::vector<std::size_t>& weights, std::size_t r, std::size_t u1) : 
+    r_(r), u1_(u1), data_(data), tree_(tree), weights_(weights) {}
+
+    // indices of the unique rows chosen at each step, with repetitions
+    std::vector<std::size_t> twin()
+    {
+        std::size_t N = 0;
+        for(std::size_t i = 0; i < weights_.size(); i++)
+            N += weights_[i];
+
+        // the walk stops once at most r rows would remain after a step
+        std::size_t n_steps = (N + r_ - 1) / r_ - 1;
+
+        std::vector<std::size_t> index(r_);
+        std::vector<double> distance(r_);
+        std::vector<HeapResultSet::Entry> heap;
+
+        std::vector<std::size_t> indices;
+        indices.reserve(n_steps + 1);
+        std::size_t position = u1_;
+
+        while(indices.size() < n_steps)
+        {
+            std::size_t whole = std::min(weights_[position] / r_, n_steps - indices.size());
+            if(whole > 0)
+            {
+                indices.insert(indices.end(), whole, position);
+                weights_[position] -= whole * r_;
+                if(weights_[position] == 0)
+                    tree_.removePoint(position);
+
+                position = next_position(position);
+                continue;
+            }
+
+            std::size_t found = k_nearest(tree_, data_.get_row(position), r_, index.data(), distance.data(), heap);
+            indices.push_back(position);
+
+            std::size_t needed = r_;
+            std::size_t last = position;
+            for(std::size_t i = 0; i < found && needed > 0; i++)
+            {
+                std::size_t taken = std::min(weights_[index[i]], needed);
+                weights_[index[i]] -= taken;
+                needed -= taken;
+                last = index[i];
+
+                if(weights_[index[i]] == 0)
+                    tree_.removePoint(index[i]);
+            }
+
+            position = next_position(last);
+        }
+
+        indices.push_back(position);
+        return indices;
+    }
+};
+
+
+/*
+    output encodings
+
+    The rows chosen from a dataset of N rows are returned as "indices" in the
+    order of their selection, as "sorted" indices in the smallest unsigned type
+    that holds N - 1, or as a "mask" of N bits, packed 8 per byte with the first
+    row in the most significant bit, as by numpy.packbits(). Labels from 0 to
+    k - 1 are written to an array of the smallest unsigned type that holds k - 1.
+*/
+inline std::size_t unsigned_bytes(std::size_t max_value)
+{
+    if(max_value <= std::numeric_limits<std::uint8_t>::max())
+        return 1;
+    if(max_value <= std::numeric_limits<std::uint16_t>::max())
+        return 2;
+    if(max_value <= std::numeric_limits<std::uint32_t>::max())
+        return 4;
+    return 8;
+}
+
+// 1 dimensional array of n elements; the strides are explicit, as pybind11 infers them from the layout of the numpy dtype
+template <class T>
+py::array_t<T> new_array(std::size_t n)
+{
+    return py::array_t<T>({static_cast<py::ssize_t>(n)}, {static_cast<py::ssize_t>(sizeof(T))});
+}
+
+template <class T>
+py::array rows_as(const std::vector<std::size_t>& rows, bool sorted)
+{
+    py::array_t<T> result = new_array<T>(rows.size());
+    T* out = result.mutable_data();
+    for(std::size_t i = 0; i < rows.size(); i++)
+        out[i] = static_cast<T>(rows[i]);
+
+    if(sorted)
+        std::sort(out, out + rows.size());
+
+    return result;
+}
+
+py::array encode_rows(const std::vector<std::size_t>& rows, std::size_t N, const std::string& output)
+{
+    if(output == "sorted")
+    {
+        switch(unsigned_bytes(N - 1))
+        {
+            case 1: return rows_as<std::uint8_t>(rows, true);
+            case 2: return rows_as<std::uint16_t>(rows, true);
+            case 4: return rows_as<std::uint32_t>(rows, true);
+            default: return rows_as<std::uint64_t>(rows, true);
+        }
+    }
+
+    if(output == "mask")
+    {
+        py::array_t<std::uint8_t> mask = new_array<std::uint8_t>((N + 7) / 8);
+        std::uint8_t* bits = mask.mutable_data();
+        std::fill(bits, bits + (N + 7) / 8, 0);
+        for(std::size_t i = 0; i < rows.size(); i++)
+            bits[rows[i] / 8] |= static_cast<std::uint8_t>(0x80 >> (rows[i] % 8));
+        return mask;
+    }
+
+    return rows_as<std::uint64_t>(rows, false);
+}
+
+// counting sort of the rows by their labels, i.e., the rows of label l are indices[offsets[l]], ..., indices[offsets[l + 1] - 1]
+template <class T, class U>
+py::tuple group_labels(const T* labels, std::size_t N, std::size_t k)
+{
+    py::array_t<U> indices = new_array<U>(N);
+    py::array_t<std::uint64_t> offsets = new_array<std::uint64_t>(k + 1);
+    U* index = indices.mutable_data();
+    std::uint64_t* offset = offsets.mutable_data();
+
+    std::fill(offset, offset + k + 1, 0);
+    for(std::size_t i = 0; i < N; i++)
+        offset[labels[i] + 1]++;
+    for(std::size_t l = 0; l < k; l++)
+        offset[l + 1] += offset[l];
+
+    std::vector<std::uint64_t> next(offset, offset + k);
+    for(std::size_t i = 0; i < N; i++)
+        index[next[labels[i]]++] = static_cast<U>(i);
+
+    return py::make_tuple(indices, offsets);
+}
+
+template <class T>
+py::tuple group_labels_as(const T* labels, std::size_t N, std::size_t k)
+{
+    switch(unsigned_bytes(N - 1))
+    {
+        case 1: return group_labels<T, std::uint8_t>(labels, N, k);
+        case 2: return group_labels<T, std::uint16_t>(labels, N, k);
+        case 4: return group_labels<T, std::uint32_t>(labels, N, k);
+        default: return group_labels<T, std::uint64_t>(labels, N, k);
+    }
+}
+
+py::tuple group_labels_cpp(py::array labels, std::size_t k)
+{
+    py::buffer_info info = labels.request();
+    if(info.ndim != 1 || info.strides[0] != info.itemsize)
+        throw std::invalid_argument("labels should be a contiguous 1 dimensional array");
+
+    std::size_t N = info.shape[0];
+    switch(info.itemsize)
+    {
+        case 1: return group_labels_as(static_cast<const std::uint8_t*>(info.ptr), N, k);
+        case 2: return group_labels_as(static_cast<const std::uint16_t*>(info.ptr), N, k);
+        case 4: return group_labels_as(static_cast<const std::uint32_t*>(info.ptr), N, k);
+        default: return group_labels_as(static_cast<const std::uint64_t*>(info.ptr), N, k);
+    }
+}
+
+
+template <class TREE>
+std::vector<std::size_t> twin_tree(DF& D, std::size_t r, std::size_t u1, std::size_t leaf_size, bool warm_start, std::size_t prefetch, bool leaf_order) 
+{
+    TREE tree(D, leaf_size);
+    if(!leaf_order)
+    {
+        BasicTwinning<TREE> twinning(D, tree, D.nrow(), r, u1, warm_start, prefetch);
+        return twinning.twin();
+    }
+
+    std::vector<double> buffer;
+    std::vector<std::size_t> order = tree.reorder(buffer);
+    D.rebind(buffer.data(), D.nrow());
+
+    std::size_t u1_ordered = std::find(order.begin(), order.end(), u1) - order.begin();
+    BasicTwinning<TREE> twinning(D, tree, D.nrow(), r, u1_ordered, warm_start, prefetch);
+    std::vector<std::size_t> indices = twinning.twin();
+    for(std::size_t i = 0; i < indices.size(); i++)
+        indices[i] = order[indices[i]];
+
+    return indices;
+}
+
+
+py::array twin_cpp(py::array_t<double> data, std::size_t r, std::size_t u1, std::size_t leaf_size, bool warm_start, std::size_t prefetch, bool leaf_order, const std::string& output) 
+{
+    DF D(data);
+    if(compact_rows(D.nrow()))
+        return encode_rows(twin_tree<CompactKDTree>(D, r, u1, leaf_size, warm_start, prefetch, leaf_order), D.nrow(), output);
+
+    return encode_rows(twin_tree<KDTree>(D, r, u1, leaf_size, warm_start, prefetch, leaf_order), D.nrow(), output);
+}
+
+
+// twinning walk over all rows of D, with the kd-tree of the narrowest indices that hold them
+std::vector<std::size_t> twin_walk(const DF& D, std::size_t r, std::size_t u1, std::size_t leaf_size)
+{
+    if(compact_rows(D.nrow()))
+    {
+        CompactKDTree tree(D, leaf_size);
+        BasicTwinning<CompactKDTree> twinning(D, tree, D.nrow(), r, u1);
+        return twinning.twin();
+    }
+
+    KDTree tree(D, leaf_size);
+    Twinning twinning(D, tree, D.nrow(), r, u1);
+    return twinning.twin();
+}
+
+
+template <class TREE>
+std::vector<std::size_t> twin_weighted(const DF& U, const std::vector<std::size_t>& weights, std::size_t r, std::size_t u1, std::size_t leaf_size)
+{
+    TREE tree(U, leaf_size);
+    WeightedTwinning<TREE> twinning(U, tree, weights, r, u1);
+    return twinning.twin();
+}
+
+
+/*
+    twin_cpp() over the unique rows of the dataset, weighted by their number of
+    duplicates; each chosen unique row is expanded to a distinct duplicate, and
+    u1 itself is the first duplicate chosen from its group
+*/
+std::vector<std::size_t> twin_collapsed(const DF& D, std::size_t r, std::size_t u1, std::size_t leaf_size)
+{
+    std::vector<std::size_t> offsets, members;
+    group_duplicates(D, offsets, members);
+
+    std::size_t n_unique = offsets.size() - 1;
+    if(n_unique == D.nrow())
+        return twin_walk(D, r, u1, leaf_size);
+
+    std::size_t dim = D.ncol();
+    std::vector<double> buffer(n_unique * dim);
+    std::vector<std::size_t> weights(n_unique);
+    std::size_t u1_unique = 0;
+    for(std::size_t g = 0; g < n_unique; g++)
+    {
+        std::copy(D.get_row(members[offsets[g]]), D.get_row(members[offsets[g]]) + dim, buffer.begin() + g * dim);
+        weights[g] = offsets[g + 1] - offsets[g];
+
+        for(std::size_t i = offsets[g]; i < offsets[g + 1]; i++)
+            if(members[i] == u1)
+            {
+                std::swap(members[offsets[g]], members[i]);
+                u1_unique = g;
+            }
+    }
+
+    DF U(buffer.data(), n_unique, dim);
+    std::vector<std::size_t> indices = compact_rows(n_unique) ? twin_weighted<CompactKDTree>(U, weights, r, u1_unique, leaf_size) : twin_weighted<KDTree>(U, weights, r, u1_unique, leaf_size);
+
+    std::vector<std::size_t> chosen(n_unique, 0);
+    for(std::size_t i = 0; i < indices.size(); i++)
+    {
+        std::size_t g = indices[i];
+        indices[i] = members[offsets[g] + chosen[g]++];
+    }
+
+    return indices;
+}
+
+
+py::array twin_collapsed_cpp(py::array_t<double> data, std::size_t r, std::size_t u1, std::size_t leaf_size, const std::string& output)
+{
+    DF D(data);
+    return encode_rows(twin_collapsed(D, r, u1, leaf_size), D.nrow(), output);
+}
+
+
+/*
+    twinning walk with a fractional ratio N / n; step t removes the nearest
+    r_t = round((t + 1) N / n) - round(t N / n) points and keeps the first, so
+    exactly n points are kept and the last step removes all remaining points.
+    For n = N / r, it is the walk of twin() with ratio r
+*/
+template <class TREE>
+std::vector<std::size_t> compress(const DF& data, TREE& tree, std::size_t N, std::size_t n, std::size_t u1)
+{
+    std::size_t r_max = (N + n - 1) / n + 1;
+    std::vector<std::size_t> index(r_max);
+    std::vector<double> distance(r_max);
+    std::vector<HeapResultSet::Entry> heap;
+
+    nanoflann::KNNResultSet<double> resultSet_next_u(1);
+    std::size_t index_next_u;
+    double distance_next_u;
+
+    std::vector<std::size_t> indices;
+    indices.reserve(n);
+    std::size_t position = u1;
+    std::size_t removed = 0;
+
+    for(std::size_t t = 0; t < n; t++)
+    {
+        std::size_t r_t = (2 * (t + 1) * N + n) / (2 * n) - removed;
+
+        k_nearest(tree, data.get_row(position), r_t, index.data(), distance.data(), heap);
+        indices.push_back(index[0]);
+
+        for(std::size_t i = 0; i < r_t; i++)
+            tree.removePoint(index[i]);
+        removed += r_t;
+
+        if(removed == N)
+            break;
+
+        resultSet_next_u.init(&index_next_u, &distance_next_u);
+        tree.findNeighbors(resultSet_next_u, data.get_row(index[r_t - 1]), nanoflann::SearchParams());
+        position = index_next_u;
+    }
+
+    return indices;
+}
+
+
+std::vector<std::size_t> compress_cpp(py::array_t<double> data, std::size_t n, std::size_t u1, std::size_t leaf_size)
+{
+    DF D(data);
+    if(compact_rows(D.nrow()))
+    {
+        CompactKDTree tree(D, leaf_size);
+        return compress(D, tree, D.nrow(), n, u1);
+    }
+
+    KDTree tree(D, leaf_size);
+    return compress(D, tree, D.nrow(), n, u1);
+}
+
+
+template <class TREE>
+std::vector<std::size_t> sequence_tree(const DF& D, std::size_t n, std::size_t u1, std::size_t leaf_size)
+{
+    TREE tree(D, leaf_size);
+    BasicTwinning<TREE> twinning(D, tree, D.nrow(), n, u1);
+    return twinning.get_sequence();
+}
+
+
+std::vector<std::size_t> multiplet_S3_cpp(py::array_t<double> data, std::size_t n, std::size_t u1, std::size_t leaf_size) 
+{
+    DF D(data);
+    if(compact_rows(D.nrow()))
+        return sequence_tree<CompactKDTree>(D, n, u1, leaf_size);
+
+    return sequence_tree<KDTree>(D, n, u1, leaf_size);
+}
+
+
+/*
+    twins the given rows of data only; the other rows are removed from the tree
+    when they are at most a tenth of all rows, otherwise searches would spend much
+    of their time on removed points, and a tree over a compact copy of the rows
+    is built
+*/
+template <class TREE>
+std::vector<std::size_t> twin_rows(const DF& data, TREE& tree, const std::vector<std::size_t>& rows, std::size_t r, std::size_t u1, std::size_t leaf_size)
+{
+    if(10 * rows.size() >= 9 * data.nrow())
+    {
+        tree.reset(rows);
+        BasicTwinning<TREE> twinning(data, tree, rows.size(), r, u1);
+        return twinning.twin();
+    }
+
+    std::size_t dim = data.ncol();
+    std::vector<double> buffer(rows.size() * dim);
+    std::size_t u1_subset = 0;
+    for(std::size_t i = 0; i < rows.size(); i++)
+    {
+        std::copy(data.get_row(rows[i]), data.get_row(rows[i]) + dim, buffer.begin() + i * dim);
+        if(rows[i] == u1)
+            u1_subset = i;
+    }
+
+    DF subset(buffer.data(), rows.size(), dim);
+    TREE subset_tree(subset, leaf_size);
+    BasicTwinning<TREE> twinning(subset, subset_tree, rows.size(), r, u1_subset);
+
+    std::vector<std::size_t> indices = twinning.twin();
+    for(std::size_t i = 0; i < indices.size(); i++)
+        indices[i] = rows[indices[i]];
+
+    return indices;
+}
+
+
+class TwinningIndex
+{
+private:
+    DF data_;
+    AdaptiveKDTree tree_;
+    std::size_t leaf_size_;
+
+    // the walk over all rows, or its sequence of visited rows
+    template <class TREE>
+    std::vector<std::size_t> walk(TREE& tree, std::size_t r, std::size_t u1, bool sequence)
+    {
+        tree.reset();
+        BasicTwinning<TREE> twinning(data_, tree, data_.nrow(), r, u1);
+        return sequence ? twinning.get_sequence() : twinning.twin();
+    }
+
+public:
+    TwinningIndex(py::array_t<double> data, std::size_t leaf_size) : data_(data), tree_(data_, leaf_size), leaf_size_(leaf_size) {}
+
+    TwinningIndex(py::array_t<double> data, std::size_t leaf_size, const std::string& tree) : data_(data), tree_(data_, leaf_size, tree), leaf_size_(leaf_size) {}
+
+    py::bytes save_tree()
+    {
+        return py::bytes(tree_.save());
+    }
+
+    std::vector<std::size_t> twin(std::size_t r, std::size_t u1)
+    {
+        if(tree_.compact())
+            return walk(*tree_.compact(), r, u1, false);
+
+        return walk(*tree_.wide(), r, u1, false);
+    }
+
+    std::vector<std::size_t> twin_rows(const std::vector<std::size_t>& rows, std::size_t r, std::size_t u1)
+    {
+        if(tree_.compact())
+            return ::twin_rows(data_, *tree_.compact(), rows, r, u1, leaf_size_);
+
+        return ::twin_rows(data_, *tree_.wide(), rows, r, u1, leaf_size_);
+    }
+
+    std::vector<std::size_t> get_sequence(std::size_t r, std::size_t u1)
+    {
+        if(tree_.compact())
+            return walk(*tree_.compact(), r, u1, true);
+
+        return walk(*tree_.wide(), r, u1, true);
+    }
+};
+
+
+/*
+    rows of a dataset grouped by stratum with a counting sort; the rows of stratum
+    s are rows[offsets[s]], ..., rows[offsets[s + 1] - 1] in increasing order, and
+    are copied in the same order to a contiguous buffer, so that every stratum can
+    be processed as a dataset of its own without the GIL
+*/
+class Strata
+{
+private:
+    std::vector<double> buffer_;
+    std::size_t dim_;
+
+public:
+    std::vector<std::size_t> offsets;
+    std::vector<std::size_t> rows;
+
+    Strata(const DF& D, const std::int64_t* codes, std::size_t n_strata) : dim_(D.ncol())
+    {
+        std::size_t N = D.nrow();
+        offsets.assign(n_strata + 1, 0);
+        for(std::size_t i = 0; i < N; i++)
+            offsets[codes[i] + 1]++;
+        for(std::size_t s = 0; s < n_strata; s++)
+            offsets[s + 1] += offsets[s];
+
+        std::vector<std::size_t> position(offsets.begin(), offsets.end() - 1);
+        rows.resize(N);
+        buffer_.resize(N * dim_);
+        for(std::size_t i = 0; i < N; i++)
+        {
+            std::size_t j = position[codes[i]]++;
+            rows[j] = i;
+            std::copy(D.get_row(i), D.get_row(i) + dim_, buffer_.begin() + j * dim_);
+        }
+    }
+
+    std::size_t count() const
+    {
+        return offsets.size() - 1;
+    }
+
+    std::size_t size(std::size_t s) const
+    {
+        return offsets[s + 1] - offsets[s];
+    }
+
+    DF stratum(std::size_t s) const
+    {
+        return DF(buffer_.data() + offsets[s] * dim_, size(s), dim_);
+    }
+
+    // largest strata first, so that the dynamic schedule balances the threads
+    std::vector<std::size_t> schedule() const
+    {
+        std::vector<std::size_t> order(count());
+        for(std::size_t s = 0; s < order.size(); s++)
+            order[s] = s;
+
+        std::stable_sort(order.begin(), order.end(), [this](std::size_t a, std::size_t b) { return size(a) > size(b); });
+        return order;
+    }
+};
+
+
+/*
+    twin_cpp() within every stratum, in parallel; a stratum of at most r rows
+    contributes its starting row, so stratum s contributes ceil(N_s / r) rows,
+    and the results are written stratum by stratum to a single output. The walk
+    in stratum s starts from a row drawn with the seed seed + s, except in the
+    stratum of u1, where it starts from u1, if u1 < N
+*/
+py::array twin_stratified_cpp(py::array_t<double> data, py::array_t<std::int64_t, py::array::c_style | py::array::forcecast> codes, std::size_t n_strata, std::size_t r, std::size_t u1, std::uint64_t seed, std::size_t leaf_size, bool collapse_duplicates, int n_threads, const std::string& output)
+{
+    DF D(data);
+    const std::int64_t* code = codes.data();
+    std::vector<std::size_t> indices;
+    {
+        py::gil_scoped_release release;
+
+        Strata strata(D, code, n_strata);
+        std::vector<std::size_t> schedule = strata.schedule();
+
+        std::vector<std::size_t> output_offsets(n_strata + 1, 0);
+        for(std::size_t s = 0; s < n_strata; s++)
+            output_offsets[s + 1] = output_offsets[s] + (strata.size(s) + r - 1) / r;
+
+        indices.resize(output_offsets[n_strata]);
+
+        #pragma omp parallel for schedule(dynamic) num_threads(resolve_threads(n_threads))
+        for(int t = 0; t < static_cast<int>(n_strata); t++)
+        {
+            std::size_t s = schedule[t];
+            std::size_t N_s = strata.size(s);
+            const std::size_t* rows = strata.rows.data() + strata.offsets[s];
+            if(N_s == 0)
+                continue;
+
+            std::mt19937_64 rng(seed + s);
+            std::size_t start = rng() % N_s;
+            if(u1 < D.nrow() && static_cast<std::size_t>(code[u1]) == s)
+                start = std::lower_bound(rows, rows + N_s, u1) - rows;
+
+            std::vector<std::size_t> twin_s(1, start);
+            if(N_s > r)
+            {
+                DF S = strata.stratum(s);
+                if(collapse_duplicates)
+                    twin_s = twin_collapsed(S, r, start, leaf_size);
+                else
+                    twin_s = twin_walk(S, r, start, leaf_size);
+            }
+
+            for(std::size_t i = 0; i < twin_s.size(); i++)
+                indices[output_offsets[s] + i] = rows[twin_s[i]];
+        }
+    }
+
+    return encode_rows(indices, D.nrow(), output);
+}
+
+
+/*
+    twin_cpp() on every segment of rows first = offsets[s], ..., offsets[s + 1] - 1
+    of data, in parallel; each segment is scaled on its own, as by _data_format(),
+    except that its constant columns are set to zero rather than dropped, which
+    leaves the distances unchanged. A segment of at most r rows contributes its
+    starting row, which is drawn with the seed seed + s. Returns the indices into
+    data, and the offsets of the segments in them
+*/
+std::pair<std::vector<std::size_t>, std::vector<std::size_t>> twin_batch_cpp(py::array_t<double> data, std::vector<std::size_t> offsets, std::size_t r, std::uint64_t seed, std::size_t leaf_size, int n_threads)
+{
+    DF D(data);
+    std::size_t dim = D.ncol();
+    std::size_t n_segments = offsets.size() - 1;
+    py::gil_scoped_release release;
+
+    std::vector<std::size_t> output_offsets(n_segments + 1, 0);
+    for(std::size_t s = 0; s < n_segments; s++)
+    {
+        std::size_t N_s = offsets[s + 1] - offsets[s];
+        output_offsets[s + 1] = output_offsets[s] + (N_s + r - 1) / r;
+    }
+
+    std::vector<std::size_t> indices(output_offsets[n_segments]);
+
+    #pragma omp parallel num_threads(resolve_threads(n_threads))
+    {
+        std::vector<double> buffer;
+
+        #pragma omp for schedule(dynamic)
+        for(int t = 0; t < static_cast<int>(n_segments); t++)
+        {
+            std::size_t first = offsets[t];
+            std::size_t N_s = offsets[t + 1] - first;
+            if(N_s == 0)
+                continue;
+
+            std::mt19937_64 rng(seed + t);
+            std::size_t start = rng() % N_s;
+            if(N_s <= r)
+            {
+                indices[output_offsets[t]] = first + start;
+                continue;
+            }
+
+            buffer.resize(N_s * dim);
+            for(std::size_t j = 0; j < dim; j++)
+            {
+                double value = D.get_row(first)[j];
+                bool constant = true;
+                double mean = 0.0;
+                for(std::size_t i = 0; i < N_s; i++)
+                {
+                    constant = constant && D.get_row(first + i)[j] == value;
+                    mean += D.get_row(first + i)[j];
+                }
+                mean /= N_s;
+
+                double variance = 0.0;
+                for(std::size_t i = 0; i < N_s; i++)
+                    variance += (D.get_row(first + i)[j] - mean) * (D.get_row(first + i)[j] - mean);
+                double deviation = std::sqrt(variance / N_s);
+
+                for(std::size_t i = 0; i < N_s; i++)
+                    buffer[i * dim + j] = constant ? 0.0 : (D.get_row(first + i)[j] - mean) / deviation;
+            }
+
+            DF S(buffer.data(), N_s, dim);
+            std::vector<std::size_t> twin_s = twin_walk(S, r, start, leaf_size);
+
+            for(std::size_t i = 0; i < twin_s.size(); i++)
+                indices[output_offsets[t] + i] = first + twin_s[i];
+        }
+    }
+
+    return std::make_pair(indices, output_offsets);
+}
+
+
+/*
+    repeated halving of the rows of data by twinning with r = 2, each time on the
+    smaller twin of the previous one; the label of a row is the number of halvings
+    that it survives. The survivors of every halving are twinned over a compact
+    copy with a tree of its own, by twin_rows(), since removing the other half
+    from one tree would leave most points searched at the deeper levels removed
+*/
+template <class TREE>
+std::vector<std::uint8_t> pyramid_tree(const DF& D, std::size_t levels, std::uint64_t seed, std::size_t leaf_size)
+{
+    std::size_t N = D.nrow();
+    std::vector<std::uint8_t> labels(N, 0);
+    std::vector<std::size_t> rows(N);
+    for(std::size_t i = 0; i < N; i++)
+        rows[i] = i;
+
+    TREE tree(D, leaf_size);
+    std::mt19937_64 rng(seed);
+
+    for(std::size_t level = 1; level <= levels && rows.size() > 2; level++)
+    {
+        rows = twin_rows(D, tree, rows, 2, rows[rng() % rows.size()], leaf_size);
+        std::sort(rows.begin(), rows.end());
+
+        for(std::size_t i = 0; i < rows.size(); i++)
+            labels[rows[i]] = static_cast<std::uint8_t>(level);
+    }
+
+    return labels;
+}
+
+
+std::vector<std::uint8_t> pyramid_cpp(py::array_t<double> data, std::size_t levels, std::uint64_t seed, std::size_t leaf_size)
+{
+    DF D(data);
+    py::gil_scoped_release release;
+
+    if(compact_rows(D.nrow()))
+        return pyramid_tree<CompactKDTree>(D, levels, seed, leaf_size);
+
+    return pyramid_tree<KDTree>(D, levels, seed, leaf_size);
+}
+
+
+/*
+    multiplet labels, from 0 to k - 1, of the rows of a single dataset under the
+    strategies of multiplet(), with starting rows drawn from rng; a dataset of
+    at most k rows is labelled 0, 1, ... in order, and under strategy 2, a dataset
+    of fewer than 2k rows, whose halving could leave some labels unused, is
+    labelled as under strategy 3
+*/
+template <class TREE>
+std::vector<std::size_t> multiplet_labels_tree(const DF& D, std::size_t k, int strategy, std::size_t leaf_size, std::mt19937_64& rng)
+{
+    std::size_t N = D.nrow();
+    std::vector<std::size_t> labels(N);
+    std::vector<std::size_t> rows(N);
+    for(std::size_t i = 0; i < N; i++)
+        rows[i] = i;
+
+    if(N <= k)
+    {
+        labels = rows;
+        return labels;
+    }
+
+    TREE tree(D, leaf_size);
+
+    if(strategy == 1)
+    {
+        std::vector<bool> chosen(N, false);
+        for(std::size_t i = 0; ; i++)
+        {
+            if(rows.size() <= k - i)
+            {
+                for(std::size_t j = 0; j < rows.size(); j++)
+                    labels[rows[j]] = i + j;
+                break;
+            }
+
+            std::vector<std::size_t> multiplet_i = twin_rows(D, tree, rows, k - i, rows[rng() % rows.size()], leaf_size);
+            for(std::size_t j = 0; j < multiplet_i.size(); j++)
+            {
+                labels[multiplet_i[j]] = i;
+                chosen[multiplet_i[j]] = true;
+            }
+
+            rows.erase(std::remove_if(rows.begin(), rows.end(), [&chosen](std::size_t row) { return chosen[row]; }), rows.end());
+            if(rows.size() * k <= N)
+            {
+                for(std::size_t j = 0; j < rows.size(); j++)
+                    labels[rows[j]] = i + 1;
+                break;
+            }
+        }
+    }
+    else if(strategy == 2 && N >= 2 * k)
+    {
+        std::size_t size = (N + k - 1) / k;
+        std::size_t label = 0;
+        std::vector<bool> chosen(N, false);
+
+        // the halves are labelled in the order of the recursion in multiplet()
+        std::vector<std::vector<std::size_t>> stack(1, rows);
+        while(!stack.empty())
+        {
+            std::vector<std::size_t> part = std::move(stack.back());
+            stack.pop_back();
+
+            if(part.size() <= size || part.size() <= 2)
+            {
+                for(std::size_t j = 0; j < part.size(); j++)
+                    labels[part[j]] = std::min(label, k - 1);
+                label++;
+                continue;
+            }
+
+            std::vector<std::size_t> half = twin_rows(D, tree, part, 2, part[rng() % part.size()], leaf_size);
+            for(std::size_t j = 0; j < half.size(); j++)
+                chosen[half[j]] = true;
+
+            std::vector<std::size_t> rest;
+            rest.reserve(part.size() - half.size());
+            for(std::size_t j = 0; j < part.size(); j++)
+                if(!chosen[part[j]])
+                    rest.push_back(part[j]);
+            for(std::size_t j = 0; j < half.size(); j++)
+                chosen[half[j]] = false;
+
+            std::sort(half.begin(), half.end());
+            stack.push_back(std::move(half));
+            stack.push_back(std::move(rest));
+        }
+    }
+    else
+    {
+        BasicTwinning<TREE> twinning(D, tree, N, k, rng() % N);
+        std::vector<std::size_t> sequence = twinning.get_sequence();
+        for(std::size_t i = 0; i < N; i++)
+            labels[sequence[i]] = i % k;
+    }
+
+    return labels;
+}
+
+std::vector<std::size_t> multiplet_labels(const DF& D, std::size_t k, int strategy, std::size_t leaf_size, std::mt19937_64& rng)
+{
+    if(compact_rows(D.nrow()))
+        return multiplet_labels_tree<CompactKDTree>(D, k, strategy, leaf_size, rng);
+
+    return multiplet_labels_tree<KDTree>(D, k, strategy, leaf_size, rng);
+}
+
+
+/*
+    multiplet labels within every stratum, in parallel; the labels of stratum s
+    are rotated by the number of rows in the strata before it, modulo k, so that
+    the remainders of the strata are spread over the multiplets. The labels are
+    written to out, an array of D.nrow() unsigned integers that hold k - 1
+*/
+template <class T>
+void multiplet_stratified(const DF& D, const std::int64_t* code, std::size_t n_strata, std::size_t k, int strategy, std::uint64_t seed, std::size_t leaf_size, int n_threads, T* labels)
+{
+    Strata strata(D, code, n_strata);
+    std::vector<std::size_t> schedule = strata.schedule();
+
+    #pragma omp parallel for schedule(dynamic) num_threads(resolve_threads(n_threads))
+    for(int t = 0; t < static_cast<int>(n_strata); t++)
+    {
+        std::size_t s = schedule[t];
+        const std::size_t* rows = strata.rows.data() + strata.offsets[s];
+        if(strata.size(s) == 0)
+            continue;
+
+        std::mt19937_64 rng(seed + s);
+        DF S = strata.stratum(s);
+        std::vector<std::size_t> labels_s = multiplet_labels(S, k, strategy, leaf_size, rng);
+
+        std::size_t shift = strata.offsets[s] % k;
+        for(std::size_t i = 0; i < labels_s.size(); i++)
+            labels[rows[i]] = static_cast<T>((labels_s[i] + shift) % k);
+    }
+}
+
+void multiplet_stratified_cpp(py::array_t<double> data, py::array_t<std::int64_t, py::array::c_style | py::array::forcecast> codes, std::size_t n_strata, std::size_t k, int strategy, std::uint64_t seed, std::size_t leaf_size, int n_threads, py::array out)
+{
+    DF D(data);
+    const std::int64_t* code = codes.data();
+    py::buffer_info info = out.request(true);
+    if(info.ndim != 1 || static_cast<std::size_t>(info.shape[0]) != D.nrow() || info.strides[0] != info.itemsize)
+        throw std::invalid_argument("out should be a contiguous array with one entry per row of data");
+    if(info.itemsize < 8 && k - 1 > (std::size_t(1) << (8 * info.itemsize)) - 1)
+        throw std::invalid_argument("out cannot hold the labels 0, ..., k - 1");
+
+    void* labels = info.ptr;
+    py::gil_scoped_release release;
+
+    switch(info.itemsize)
+    {
+        case 1: multiplet_stratified(D, code, n_strata, k, strategy, seed, leaf_size, n_threads, static_cast<std::uint8_t*>(labels)); break;
+        case 2: multiplet_stratified(D, code, n_strata, k, strategy, seed, leaf_size, n_threads, static_cast<std::uint16_t*>(labels)); break;
+        case 4: multiplet_stratified(D, code, n_strata, k, strategy, seed, leaf_size, n_threads, static_cast<std::uint32_t*>(labels)); break;
+        default: multiplet_stratified(D, code, n_strata, k, strategy, seed, leaf_size, n_threads, static_cast<std::uint64_t*>(labels)); break;
+    }
+}
+
+
+/*
+    result set of the single nearest point among the points 0, ..., n - 1 of a
+    tree, i.e., the points it held before any were appended
+*/
+class PrefixResultSet
+{
+private:
+    const std::size_t n_;
+    double dist_ = std::numeric_limits<double>::max();
+    bool found_ = false;
+
+public:
+    typedef double DistanceType;
+    typedef std::size_t IndexType;
+
+    explicit PrefixResultSet(std::size_t n) : n_(n) {}
+
+    /*
+        functions required by nanoflann
+    */
+    std::size_t size() const
+    {
+        return found_ ? 1 : 0;
+    }
+
+    bool full() const
+    {
+        return found_;
+    }
+
+    bool addPoint(double dist, std::size_t index)
+    {
+        if(index < n_ && dist < dist_)
+        {
+            dist_ = dist;
+            found_ = true;
+        }
+
+        return true;
+    }
+
+    double worstDist() const
+    {
+        return dist_;
+    }
+};
+
+
+/*
+    partition of a growing dataset into k labelled parts, e.g., twins or folds;
+    a new row goes to the label with the largest sum of its local deficit among
+    the n_neighbors nearest rows and its global deficit, with respect to the
+    proportions of the labels in the initial rows, and is then inserted into the
+    tree with that label. The rows are stored in a buffer owned by the partition,
+    which grows as rows are assigned
+*/
+class TwinningPartition
+{
+private:
+    std::vector<double> buffer_;
+    DF data_;
+    AdaptiveKDTree tree_;
+    std::vector<std::size_t> labels_;
+    std::vector<std::size_t> counts_;
+    std::vector<double> targets_;
+    std::size_t n_neighbors_;
+    double reference_distance_;
+    double distance_sum_;
+    std::size_t n_assigned_;
+
+    static std::vector<double> copy(const DF& data)
+    {
+        return std::vector<double>(data.get_row(0), data.get_row(0) + data.nrow() * data.ncol());
+    }
+
+public:
+    TwinningPartition(py::array_t<double> data, std::vector<std::size_t> labels, std::size_t n_labels, std::size_t n_neighbors, std::size_t leaf_size, int n_threads) : 
+    buffer_(copy(DF(data))), data_(buffer_.data(), labels.size(), data.shape(1)), tree_(data_, leaf_size), labels_(labels), counts_(n_labels, 0), 
+    targets_(n_labels), n_neighbors_(n_neighbors), distance_sum_(0.0), n_assigned_(0)
+    {
+        std::size_t N = labels_.size();
+        for(std::size_t i = 0; i < N; i++)
+            counts_[labels_[i]]++;
+        for(std::size_t j = 0; j < n_labels; j++)
+            targets_[j] = static_cast<double>(counts_[j]) / N;
+
+        // mean distance from the initial rows to their nearest other row
+        std::vector<double> distances(N);
+        #pragma omp parallel for num_threads(resolve_threads(n_threads))
+        for(std::int64_t i = 0; i < static_cast<std::int64_t>(N); i++)
+        {
+            nanoflann::KNNResultSet<double> resultSet(2);
+            std::size_t index[2];
+            double distance[2];
+
+            resultSet.init(index, distance);
+            tree_.findNeighbors(resultSet, data_.get_row(i), nanoflann::SearchParams());
+            distances[i] = std::sqrt(distance[1]);
+        }
+
+        reference_distance_ = 0.0;
+        for(std::size_t i = 0; i < N; i++)
+            reference_distance_ += distances[i];
+        reference_distance_ /= N;
+
+        if(reference_distance_ == 0.0)
+            throw std::invalid_argument("every row of data has an exact duplicate, hence the drift of new rows cannot be measured");
+    }
+
+    // restores a partition from its rows, labels, saved tree, and state()
+    TwinningPartition(py::array_t<double> data, std::vector<std::size_t> labels, std::vector<double> targets, std::size_t n_neighbors, std::size_t leaf_size, const std::string& tree, std::vector<double> state) : 
+    buffer_(copy(DF(data))), data_(buffer_.data(), labels.size(), data.shape(1)), tree_(data_, leaf_size, tree), labels_(labels), counts_(targets.size(), 0), 
+    targets_(targets), n_neighbors_(n_neighbors), reference_distance_(state[0]), distance_sum_(state[1]), n_assigned_(static_cast<std::size_t>(state[2]))
+    {
+        for(std::size_t i = 0; i < labels_.size(); i++)
+            counts_[labels_[i]]++;
+    }
+
+    std::vector<std::size_t> assign(py::array_t<double> rows)
+    {
+        DF X(rows);
+        std::size_t dim = data_.ncol();
+        std::size_t k = targets_.size();
+        std::vector<std::size_t> assigned(X.nrow());
+
+        std::vector<std::size_t> index(n_neighbors_);
+        std::vector<double> distance(n_neighbors_);
+        std::vector<double> deficit(k);
+
+        for(std::size_t i = 0; i < X.nrow(); i++)
+        {
+            nanoflann::KNNResultSet<double> resultSet(std::min(n_neighbors_, labels_.size()));
+            resultSet.init(index.data(), distance.data());
+            tree_.findNeighbors(resultSet, X.get_row(i), nanoflann::SearchParams());
+
+            // distance to the nearest initial row, which is among the neighbors unless they are all assigned rows
+            std::size_t n_initial = labels_.size() - n_assigned_;
+            std::size_t m = 0;
+            while(m < resultSet.size() && index[m] >= n_initial)
+                m++;
+
+            if(m < resultSet.size())
+                distance_sum_ += std::sqrt(distance[m]);
+            else
+            {
+                PrefixResultSet initialSet(n_initial);
+                tree_.findNeighbors(initialSet, X.get_row(i), nanoflann::SearchParams());
+                distance_sum_ += std::sqrt(initialSet.worstDist());
+            }
+            n_assigned_++;
+
+            std::size_t N = labels_.size() + 1;
+            for(std::size_t j = 0; j < k; j++)
+                deficit[j] = targets_[j] * (resultSet.size() + N) - counts_[j];
+            for(std::size_t m = 0; m < resultSet.size(); m++)
+                deficit[labels_[index[m]]] -= 1.0;
+
+            std::size_t label = std::max_element(deficit.begin(), deficit.end()) - deficit.begin();
+            assigned[i] = label;
+
+            buffer_.insert(buffer_.end(), X.get_row(i), X.get_row(i) + dim);
+            data_.rebind(buffer_.data(), N);
+            tree_.append(N - 1, N - 1);
+
+            labels_.push_back(label);
+            counts_[label]++;
+        }
+
+        return assigned;
+    }
+
+    // mean distance from the assigned rows to their nearest initial row, relative to that of the initial rows
+    double drift() const
+    {
+        if(n_assigned_ == 0)
+            return 1.0;
+
+        return distance_sum_ / n_assigned_ / reference_distance_;
+    }
+
+    std::size_t size() const
+    {
+        return labels_.size();
+    }
+
+    std::vector<std::size_t> labels() const
+    {
+        return labels_;
+    }
+
+    std::vector<double> targets() const
+    {
+        return targets_;
+    }
+
+    std::vector<double> state() const
+    {
+        return {reference_distance_, distance_sum_, static_cast<double>(n_assigned_)};
+    }
+
+    py::array_t<double> data() const
+    {
+        return py::array_t<double>({labels_.size(), data_.ncol()}, buffer_.data());
+    }
+
+    py::bytes save_tree()
+    {
+        return py::bytes(tree_.save());
+    }
+};
+
+
+/*
+    twins of a sliding window of rows, which are identified by the order in which
+    they enter the window; the initial rows are twinned by the twinning walk, and
+    later changes are repaired locally: a new row joins the smaller twin if its
+    deficit there, among the n_neighbors nearest rows and overall, exceeds that
+    of the larger twin, a removed row of the smaller twin is replaced by its
+    nearest row of the larger twin, if the smaller twin falls short of its size,
+    and vice versa. Removed rows stay in the tree until they outnumber the rows
+    in the window, when the window is compacted and the tree rebuilt
+*/
+class TwinningWindow
+{
+private:
+    std::vector<double> buffer_;
+    DF data_;
+    std::unique_ptr<AdaptiveKDTree> tree_;
+    std::vector<std::uint64_t> ids_;
+    std::vector<std::uint8_t> selected_;
+    std::size_t r_;
+    std::size_t n_neighbors_;
+    std::size_t leaf_size_;
+    std::uint64_t next_id_;
+    std::size_t n_live_;
+    std::size_t n_selected_;
+
+    static std::vector<double> copy(const DF& data)
+    {
+        return std::vector<double>(data.get_row(0), data.get_row(0) + data.nrow() * data.ncol());
+    }
+
+    // moves the nearest row of the other twin to the given row into its twin
+    void exchange(std::size_t slot)
+    {
+        std::size_t k = std::min(n_neighbors_, n_live_);
+        std::vector<std::size_t> index(k);
+        std::vector<double> distance(k);
+
+        nanoflann::KNNResultSet<double> resultSet(k);
+        resultSet.init(index.data(), distance.data());
+        tree_->findNeighbors(resultSet, data_.get_row(slot), nanoflann::SearchParams());
+
+        for(std::size_t m = 0; m < resultSet.size(); m++)
+            if(selected_[index[m]] != selected_[slot])
+            {
+                selected_[index[m]] = selected_[slot];
+                if(selected_[slot])
+                    n_selected_++;
+                else
+                    n_selected_--;
+                return;
+            }
+    }
+
+    void compact()
+    {
+        std::size_t dim = data_.ncol();
+        std::vector<double> buffer;
+        std::vector<std::uint64_t> ids;
+        std::vector<std::uint8_t> selected;
+        buffer.reserve(n_live_ * dim);
+        ids.reserve(n_live_);
+        selected.reserve(n_live_);
+
+        for(std::size_t i = 0; i < ids_.size(); i++)
+            if(!tree_->removed(i))
+            {
+                buffer.insert(buffer.end(), data_.get_row(i), data_.get_row(i) + dim);
+                ids.push_back(ids_[i]);
+                selected.push_back(selected_[i]);
+            }
+
+        tree_.reset();
+        buffer_.swap(buffer);
+        ids_.swap(ids);
+        selected_.swap(selected);
+        data_.rebind(buffer_.data(), ids_.size());
+        tree_.reset(new AdaptiveKDTree(data_, leaf_size_));
+    }
+
+public:
+    TwinningWindow(py::array_t<double> data, std::size_t r, std::size_t u1, std::size_t n_neighbors, std::size_t leaf_size) : 
+    buffer_(copy(DF(data))), data_(buffer_.data(), data.shape(0), data.shape(1)), tree_(new AdaptiveKDTree(data_, leaf_size)), ids_(data.shape(0)), 
+    selected_(data.shape(0), 0), r_(r), n_neighbors_(n_neighbors), leaf_size_(leaf_size), next_id_(data.shape(0)), n_live_(data.shape(0)), n_selected_(0)
+    {
+        for(std::size_t i = 0; i < ids_.size(); i++)
+            ids_[i] = i;
+
+        std::vector<std::size_t> indices;
+        if(tree_->compact())
+            indices = BasicTwinning<CompactKDTree>(data_, *tree_->compact(), n_live_, r_, u1).twin();
+        else
+            indices = Twinning(data_, *tree_->wide(), n_live_, r_, u1).twin();
+        tree_->reset();
+
+        for(std::size_t i = 0; i < indices.size(); i++)
+            selected_[indices[i]] = 1;
+        n_selected_ = indices.size();
+    }
+
+    std::vector<std::uint64_t> insert(py::array_t<double> rows)
+    {
+        DF X(rows);
+        std::size_t dim = data_.ncol();
+        std::vector<std::uint64_t> inserted(X.nrow());
+
+        std::vector<std::size_t> index(n_neighbors_);
+        std::vector<double> distance(n_neighbors_);
+
+        for(std::size_t i = 0; i < X.nrow(); i++)
+        {
+            nanoflann::KNNResultSet<double> resultSet(std::min(n_neighbors_, n_live_));
+            resultSet.init(index.data(), distance.data());
+            tree_->findNeighbors(resultSet, X.get_row(i), nanoflann::SearchParams());
+
+            std::size_t local = 0;
+            for(std::size_t m = 0; m < resultSet.size(); m++)
+                local += selected_[index[m]];
+
+            // deficits of the smaller and the larger twin, as in TwinningPartition
+            double total = static_cast<double>(resultSet.size() + n_live_ + 1);
+            double deficit_selected = total / r_ - (local + n_selected_);
+            double deficit_other = total * (r_ - 1) / r_ - (resultSet.size() - local + n_live_ - n_selected_);
+
+            std::size_t slot = ids_.size();
+            buffer_.insert(buffer_.end(), X.get_row(i), X.get_row(i) + dim);
+            ids_.push_back(next_id_);
+            selected_.push_back(deficit_selected > deficit_other);
+            data_.rebind(buffer_.data(), ids_.size());
+            tree_->append(slot, slot);
+
+            inserted[i] = next_id_++;
+            n_live_++;
+            n_selected_ += selected_[slot];
+        }
+
+        return inserted;
+    }
+
+    void remove(std::vector<std::uint64_t> ids)
+    {
+        std::vector<std::size_t> slots(ids.size());
+        for(std::size_t i = 0; i < ids.size(); i++)
+        {
+            slots[i] = std::lower_bound(ids_.begin(), ids_.end(), ids[i]) - ids_.begin();
+            if(slots[i] == ids_.size() || ids_[slots[i]] != ids[i] || tree_->removed(slots[i]))
+                throw std::invalid_argument("row " + std::to_string(ids[i]) + " is not in the window");
+        }
+
+        std::vector<std::size_t> sorted(slots);
+        std::sort(sorted.begin(), sorted.end());
+        if(std::adjacent_find(sorted.begin(), sorted.end()) != sorted.end())
+            throw std::invalid_argument("rows to be removed should be distinct");
+
+        if(slots.size() + 2 * r_ > n_live_)
+            throw std::invalid_argument("the window should keep at least 2r rows");
+
+        for(std::size_t i = 0; i < slots.size(); i++)
+        {
+            std::size_t slot = slots[i];
+            tree_->removePoint(slot);
+            n_live_--;
+            n_selected_ -= selected_[slot];
+
+            double target = static_cast<double>(n_live_) / r_;
+            if(selected_[slot] ? n_selected_ + 0.5 < target : n_selected_ > target + 0.5)
+                exchange(slot);
+        }
+
+        if(ids_.size() > 2 * n_live_)
+            compact();
+    }
+
+    std::vector<std::uint64_t> selected() const
+    {
+        std::vector<std::uint64_t> ids;
+        ids.reserve(n_selected_);
+        for(std::size_t i = 0; i < ids_.size(); i++)
+            if(selected_[i] && !tree_->removed(i))
+                ids.push_back(ids_[i]);
+
+        return ids;
+    }
+
+    std::vector<std::uint64_t> ids() const
+    {
+        std::vector<std::uint64_t> ids;
+        ids.reserve(n_live_);
+        for(std::size_t i = 0; i < ids_.size(); i++)
+            if(!tree_->removed(i))
+                ids.push_back(ids_[i]);
+
+        return ids;
+    }
+
+    std::size_t size() const
+    {
+        return n_live_;
+    }
+};
+
+
+/*
+    sum of the Euclidean distances over all ordered pairs (i, j), i != j, of rows
+    of sp; only the upper triangle is evaluated, in blocks of rows whose partial
+    sums are added in a fixed order, so the result does not depend on the number
+    of threads
+*/
+double pairwise_distance_sum(const DF& sp, int n_threads)
+{
+    const std::size_t block_size = 64;
+    std::size_t dim = sp.ncol();
+    std::size_t n = sp.nrow();
+    std::size_t n_blocks = (n + block_size - 1) / block_size;
+
+    std::vector<double> partial_sums(n_blocks);
+
+    #pragma omp parallel for schedule(dynamic) num_threads(resolve_threads(n_threads))
+    for(int b = 0; b < static_cast<int>(n_blocks); b++)
+    {
+        std::size_t first = b * block_size;
+        std::size_t last = std::min(first + block_size, n);
+
+        double distance_sum = 0.0;
+        for(std::size_t i = first; i < last; i++)
+        {
+            const double* u_i = sp.get_row(i);
+            if(i + 1 < n)
+                distance_sum += row_distance_sum(u_i, sp.get_row(i + 1), n - i - 1, dim);
+        }
+
+        partial_sums[b] = distance_sum;
+    }
+
+    double sum = 0.0;
+    for(std::size_t b = 0; b < n_blocks; b++)
+        sum += partial_sums[b];
+
+    return 2.0 * sum;
+}
+
+
+/*
+    sum of the Euclidean distances between all rows of sp and all rows of D
+*/
+double cross_distance_sum(const DF& D, const DF& sp, int n_threads)
+{
+    std::size_t dim = D.ncol();
+    std::size_t N = D.nrow();
+    std::size_t n = sp.nrow();
+
+    std::vector<double> ed_1;
+    ed_1.resize(n);
+
+    #pragma omp parallel for num_threads(resolve_threads(n_threads))
+    for(int i = 0; i < static_cast<int>(n); i++)
+    {
+        const double* u_i = sp.get_row(i);
+
+        ed_1[i] = row_distance_sum(u_i, D.get_row(0), N, dim);
+    }
+
+    double sum = 0.0;
+    for(std::size_t i = 0; i < n; i++)
+        sum += ed_1[i];
+
+    return sum;
+}
+
+
+double energy_cpp(py::array_t<double> data, py::array_t<double> points, int n_threads)
+{
+    DF D(data), sp(points);
+    std::size_t N = D.nrow();
+    std::size_t n = sp.nrow();
+    py::gil_scoped_release release;
+
+    double sum1 = cross_distance_sum(D, sp, n_threads);
+    double sum2 = pairwise_distance_sum(sp, n_threads);
+
+    return 2.0 * sum1 / (N * n) - sum2 / (n * n);
+}
+
+
+double cross_distance_sum_cpp(py::array_t<double> data, py::array_t<double> points, int n_threads)
+{
+    DF D(data), sp(points);
+    py::gil_scoped_release release;
+    return cross_distance_sum(D, sp, n_threads);
+}
+
+
+double pairwise_distance_sum_cpp(py::array_t<double> points, int n_threads)
+{
+    DF sp(points);
+    py::gil_scoped_release release;
+    return pairwise_distance_sum(sp, n_threads);
+}
+
+/*
+    energy distance between the projections of data and points onto each of the
+    given directions, computed exactly in one dimension: the projected points are
+    sorted, and the projected rows of data are streamed and binned by their rank
+    among the points, so that only O(n) memory is needed per direction
+*/
+std::vector<double> energy_sliced_cpp(py::array_t<double> data, py::array_t<double> points, py::array_t<double> directions, int n_threads)
+{
+    DF D(data), sp(points), theta(directions);
+    std::size_t dim = D.ncol();
+    std::size_t N = D.nrow();
+    std::size_t n = sp.nrow();
+    py::gil_scoped_release release;
+
+    std::vector<double> energies(theta.nrow());
+
+    #pragma omp parallel for schedule(dynamic) num_threads(resolve_threads(n_threads))
+    for(int p = 0; p < static_cast<int>(theta.nrow()); p++)
+    {
+        const double* theta_p = theta.get_row(p);
+
+        std::vector<double> y(n);
+        for(std::size_t i = 0; i < n; i++)
+        {
+            const double* u_i = sp.get_row(i);
+            double projection = 0.0;
+            for(std::size_t k = 0; k < dim; k++)
+                projection += u_i[k] * theta_p[k];
+            y[i] = projection;
+        }
+        std::sort(y.begin(), y.end());
+
+        // bin b holds the rows of data lying in [y[b - 1], y[b])
+        std::vector<std::size_t> bin_count(n + 1, 0);
+        std::vector<double> bin_sum(n + 1, 0.0);
+        for(std::size_t j = 0; j < N; j++)
+        {
+            const double* z_j = D.get_row(j);
+            double projection = 0.0;
+            for(std::size_t k = 0; k < dim; k++)
+                projection += z_j[k] * theta_p[k];
+
+            std::size_t b = std::upper_bound(y.begin(), y.end(), projection) - y.begin();
+            bin_count[b]++;
+            bin_sum[b] += projection;
+        }
+
+        double total = 0.0;
+        for(std::size_t b = 0; b <= n; b++)
+            total += bin_sum[b];
+
+        double sum1 = 0.0;
+        double sum2 = 0.0;
+        std::size_t count_below = 0;
+        double sum_below = 0.0;
+        for(std::size_t i = 0; i < n; i++)
+        {
+            count_below += bin_count[i];
+            sum_below += bin_sum[i];
+            sum1 += y[i] * count_below - sum_below + (total - sum_below) - y[i] * (N - count_below);
+            sum2 += y[i] * (2.0 * i - (n - 1.0));
+        }
+
+        energies[p] = 2.0 * sum1 / (N * n) - 2.0 * sum2 / (n * n);
+    }
+
+    return energies;
+}
+
+
+/*
+    two-sample energy statistic of the first n_a rows of pooled against the rest,
+    followed by the statistics of n_permutations random relabelings; the pairwise
+    distances are computed once, in tiles of rows and columns, and every tile is
+    reused for all permutations before moving on; each thread accumulates its own
+    2 * P + 1 partial sums, over a fixed cyclic share of the blocks of rows, so that
+    the sums do not depend on the scheduling
+*/
+std::vector<double> energy_test_cpp(py::array_t<double> pooled, std::size_t n_a, std::size_t n_permutations, std::uint64_t seed, int n_threads)
+{
+    const std::size_t block_size = 64;
+    const std::size_t chunk_size = 1024;
+
+    DF Z(pooled);
+    std::size_t dim = Z.ncol();
+    std::size_t M = Z.nrow();
+    std::size_t n_b = M - n_a;
+    std::size_t P = n_permutations + 1;
+    py::gil_scoped_release release;
+
+    // labels[p * M + i] is 1 if row i belongs to the second sample under permutation p
+    std::vector<std::uint8_t> labels(P * M);
+    for(std::size_t i = 0; i < M; i++)
+        labels[i] = i >= n_a;
+
+    #pragma omp parallel for num_threads(resolve_threads(n_threads))
+    for(int p = 1; p < static_cast<int>(P); p++)
+    {
+        std::uint8_t* label = labels.data() + p * M;
+        std::copy(labels.begin(), labels.begin() + M, label);
+
+        std::mt19937_64 rng(seed + p);
+        for(std::size_t i = M - 1; i > 0; i--)
+            std::swap(label[i], label[rng() % (i + 1)]);
+    }
+
+    std::size_t n_blocks = (M + block_size - 1) / block_size;
+    int threads = resolve_threads(n_threads);
+    std::vector<double> partial_sums(threads * (2 * P + 1), 0.0);
+
+    #pragma omp parallel num_threads(threads)
+    {
+        std::vector<double> tile(block_size * chunk_size);
+        double* partial_sum = partial_sums.data() + thread_number() * (2 * P + 1);
+
+        #pragma omp for schedule(static, 1)
+        for(int b = 0; b < static_cast<int>(n_blocks); b++)
+        {
+            std::size_t first = b * block_size;
+            std::size_t last = std::min(first + block_size, M);
+
+            for(std::size_t j0 = first; j0 < M; j0 += chunk_size)
+            {
+                std::size_t j1 = std::min(j0 + chunk_size, M);
+                std::size_t width = j1 - j0;
+
+                // upper triangle only: pairs with j <= i are left at zero
+                for(std::size_t i = first; i < last; i++)
+                {
+                    double* distance = tile.data() + (i - first) * chunk_size;
+                    const double* z_i = Z.get_row(i);
+                    for(std::size_t j = j0; j < j1; j++)
+                        distance[j - j0] = j > i ? std::sqrt(squared_distance(z_i, Z.get_row(j), dim)) : 0.0;
+
+                    double row_sum = 0.0;
+                    for(std::size_t j = 0; j < width; j++)
+                        row_sum += distance[j];
+                    partial_sum[2 * P] += row_sum;
+                }
+
+                for(std::size_t p = 0; p < P; p++)
+                {
+                    const std::uint8_t* label = labels.data() + p * M;
+                    double sum_aa = 0.0;
+                    double sum_bb = 0.0;
+                    for(std::size_t i = first; i < last; i++)
+                    {
+                        const double* distance = tile.data() + (i - first) * chunk_size;
+
+                        double row_sum = 0.0;
+                        double row_sum_b = 0.0;
+                        for(std::size_t j = 0; j < width; j++)
+                        {
+                            row_sum += distance[j];
+                            row_sum_b += distance[j] * label[j0 + j];
+                        }
+
+                        if(label[i])
+                            sum_bb += row_sum_b;
+                        else
+                            sum_aa += row_sum - row_sum_b;
+                    }
+
+                    partial_sum[2 * p] += sum_aa;
+                    partial_sum[2 * p + 1] += sum_bb;
+                }
+            }
+        }
+    }
+
+    std::vector<double> sums(2 * P + 1, 0.0);
+    for(int t = 0; t < threads; t++)
+        for(std::size_t k = 0; k < 2 * P + 1; k++)
+            sums[k] += partial_sums[t * (2 * P + 1) + k];
+
+    double total = sums[2 * P];
+    std::vector<double> statistics(P);
+    for(std::size_t p = 0; p < P; p++)
+    {
+        double sum_aa = sums[2 * p];
+        double sum_bb = sums[2 * p + 1];
+        double sum_ab = total - sum_aa - sum_bb;
+
+        double e = 2.0 * sum_ab / (n_a * n_b) - 2.0 * sum_aa / (n_a * n_a) - 2.0 * sum_bb / (n_b * n_b);
+        statistics[p] = e * n_a * n_b / M;
+    }
+
+    return statistics;
+}
+
+
+/*
+    energy distances between data and k sets of its rows, the rows of set s being
+    members[offsets[s]], ..., members[offsets[s + 1] - 1]. The data term of a row
+    does not depend on its set, and is computed once for every distinct member in
+    a single sweep over blocks of rows of data: each thread takes a chunk of the
+    distinct members, and adds their distances to a block of rows while the block
+    stays in cache
+*/
+std::vector<double> energy_many_cpp(py::array_t<double> data, py::array_t<std::int64_t, py::array::c_style | py::array::forcecast> members_, py::array_t<std::int64_t, py::array::c_style | py::array::forcecast> offsets_, int n_threads)
+{
+    const std::size_t block_size = 1024;
+    const std::size_t chunk_size = 64;
+
+    DF D(data);
+    std::size_t dim = D.ncol();
+    std::size_t N = D.nrow();
+    const std::int64_t* members = members_.data();
+    const std::int64_t* offsets = offsets_.data();
+    std::size_t M = members_.size();
+    std::size_t k = offsets_.size() - 1;
+    py::gil_scoped_release release;
+
+    if(offsets_.size() < 2 || offsets[0] != 0 || static_cast<std::size_t>(offsets[k]) != M)
+        throw std::invalid_argument("offsets should start at 0 and end at the number of members");
+
+    for(std::size_t i = 0; i < M; i++)
+        if(members[i] < 0 || static_cast<std::size_t>(members[i]) >= N)
+            throw std::invalid_argument("row index " + std::to_string(members[i]) + " is out of range");
+
+    std::vector<std::int64_t> rows(members, members + M);
+    std::sort(rows.begin(), rows.end());
+    rows.erase(std::unique(rows.begin(), rows.end()), rows.end());
+
+    std::vector<double> row_sums(rows.size(), 0.0);
+    std::int64_t n_chunks = (rows.size() + chunk_size - 1) / chunk_size;
+
+    #pragma omp parallel for schedule(dynamic) num_threads(resolve_threads(n_threads))
+    for(std::int64_t c = 0; c < n_chunks; c++)
+    {
+        std::size_t first = c * chunk_size;
+        std::size_t last = std::min(first + chunk_size, rows.size());
+        for(std::size_t b = 0; b < N; b += block_size)
+        {
+            std::size_t count = std::min(block_size, N - b);
+            for(std::size_t i = first; i < last; i++)
+                row_sums[i] += row_distance_sum(D.get_row(rows[i]), D.get_row(b), count, dim);
+        }
+    }
+
+    std::vector<std::size_t> set_of(M);
+    for(std::size_t s = 0; s < k; s++)
+        for(std::int64_t i = offsets[s]; i < offsets[s + 1]; i++)
+            set_of[i] = s;
+
+    std::vector<double> ed_1(M);
+    std::vector<double> ed_2(M);
+
+    #pragma omp parallel for schedule(dynamic) num_threads(resolve_threads(n_threads))
+    for(std::int64_t i = 0; i < static_cast<std::int64_t>(M); i++)
+    {
+        const double* u_i = D.get_row(members[i]);
+        ed_1[i] = row_sums[std::lower_bound(rows.begin(), rows.end(), members[i]) - rows.begin()];
+
+        std::size_t s = set_of[i];
+        double distance_sum = 0.0;
+        for(std::int64_t j = offsets[s]; j < offsets[s + 1]; j++)
+            if(j != i)
+                distance_sum += std::sqrt(squared_distance(u_i, D.get_row(members[j]), dim));
+
+        ed_2[i] = distance_sum;
+    }
+
+    std::vector<double> energies(k);
+    for(std::size_t s = 0; s < k; s++)
+    {
+        double sum1 = 0.0;
+        double sum2 = 0.0;
+        for(std::int64_t i = offsets[s]; i < offsets[s + 1]; i++)
+        {
+            sum1 += ed_1[i];
+            sum2 += ed_2[i];
+        }
+
+        std::size_t n = offsets[s + 1] - offsets[s];
+        energies[s] = 2.0 * sum1 / (N * n) - sum2 / (n * n);
+    }
+
+    return energies;
+}
+
+
+/*
+    Barnes-Hut style approximation of sums of Euclidean distances from a query to
+    the rows of a dataset: every node of a kd-tree keeps the count, centroid and
+    spread of its rows, and a node that is far from the query, i.e., whose radius
+    is below theta times the distance to its centroid, is replaced by its centroid
+*/
+class TreeCode
+{
+private:
+    struct Cell
+    {
+        std::size_t count;
+        std::size_t first;
+        std::size_t last;
+        std::size_t child1;
+        std::size_t child2;
+        double radius;
+        double spread;
+    };
+
+    const DF& data_;
+    std::size_t dim_;
+    std::vector<std::size_t> order_;
+    std::vector<Cell> cells_;
+    std::vector<double> centroids_;
+    std::vector<double> lows_;
+    std::vector<double> highs_;
+
+    static const std::size_t leaf_ = 0;
+
+    std::size_t build(const StaticKDTree::Node* node)
+    {
+        std::size_t id = cells_.size();
+        cells_.push_back(Cell());
+        centroids_.resize(centroids_.size() + dim_, 0.0);
+        lows_.resize(lows_.size() + dim_);
+        highs_.resize(highs_.size() + dim_);
+
+        double* centroid = centroids_.data() + id * dim_;
+        double* low = lows_.data() + id * dim_;
+        double* high = highs_.data() + id * dim_;
+
+        if(node->child1 == nullptr && node->child2 == nullptr)
+        {
+            Cell cell;
+            cell.first = node->node_type.lr.left;
+            cell.last = node->node_type.lr.right;
+            cell.count = cell.last - cell.first;
+            cell.child1 = cell.child2 = leaf_;
+
+            std::copy(data_.get_row(order_[cell.first]), data_.get_row(order_[cell.first]) + dim_, low);
+            std::copy(low, low + dim_, high);
+            for(std::size_t i = cell.first; i < cell.last; i++)
+            {
+                const double* z = data_.get_row(order_[i]);
+                for(std::size_t k = 0; k < dim_; k++)
+                {
+                    centroid[k] += z[k];
+                    low[k] = std::min(low[k], z[k]);
+                    high[k] = std::max(high[k], z[k]);
+                }
+            }
+
+            for(std::size_t k = 0; k < dim_; k++)
+                centroid[k] /= cell.count;
+
+            cell.spread = 0.0;
+            for(std::size_t i = cell.first; i < cell.last; i++)
+                cell.spread += squared_distance(data_.get_row(order_[i]), centroid, dim_);
+
+            cells_[id] = cell;
+        }
+        else
+        {
+            std::size_t child1 = build(node->child1);
+            std::size_t child2 = build(node->child2);
+
+            // build() may have reallocated the buffers
+            centroid = centroids_.data() + id * dim_;
+            low = lows_.data() + id * dim_;
+            high = highs_.data() + id * dim_;
+
+            const Cell& cell1 = cells_[child1];
+            const Cell& cell2 = cells_[child2];
+            const double* centroid1 = centroids_.data() + child1 * dim_;
+            const double* centroid2 = centroids_.data() + child2 * dim_;
+
+            Cell cell;
+            cell.first = cell1.first;
+            cell.last = cell2.last;
+            cell.count = cell1.count + cell2.count;
+            cell.child1 = child1;
+            cell.child2 = child2;
+
+            for(std::size_t k = 0; k < dim_; k++)
+            {
+                centroid[k] = (cell1.count * centroid1[k] + cell2.count * centroid2[k]) / cell.count;
+                low[k] = std::min(lows_[child1 * dim_ + k], lows_[child2 * dim_ + k]);
+                high[k] = std::max(highs_[child1 * dim_ + k], highs_[child2 * dim_ + k]);
+            }
+
+            cell.spread = cell1.spread + cell1.count * squared_distance(centroid1, centroid, dim_) + 
+                          cell2.spread + cell2.count * squared_distance(centroid2, centroid, dim_);
+
+            cells_[id] = cell;
+        }
+
+        // the farthest corner of the bounding box bounds the distance of any row from the centroid
+        double radius = 0.0;
+        for(std::size_t k = 0; k < dim_; k++)
+        {
+            double extent = std::max(centroid[k] - low[k], high[k] - centroid[k]);
+            radius += extent * extent;
+        }
+        cells_[id].radius = std::sqrt(radius);
+
+        return id;
+    }
+
+public:
+    TreeCode(const DF& data, std::size_t leaf_size) : data_(data), dim_(data.ncol())
+    {
+        StaticKDTree tree(dim_, data_, nanoflann::KDTreeSingleIndexAdaptorParams(leaf_size));
+        order_ = tree.vAcc;
+        cells_.reserve(2 * data_.nrow() / leaf_size + 1);
+        build(tree.root_node);
+    }
+
+    double distance_sum(const double* u, double theta) const
+    {
+        double sum = 0.0;
+        std::vector<std::size_t> stack(1, 0);
+        while(!stack.empty())
+        {
+            const Cell& cell = cells_[stack.back()];
+            const double* centroid = centroids_.data() + stack.back() * dim_;
+            stack.pop_back();
+
+            double distance = std::sqrt(squared_distance(u, centroid, dim_));
+            if(cell.radius < theta * distance)
+            {
+                // centroid term, corrected to second order assuming an isotropic spread
+                sum += cell.count * distance + (1.0 - 1.0 / dim_) * cell.spread / (2.0 * distance);
+            }
+            else if(cell.child1 == leaf_)
+            {
+                for(std::size_t i = cell.first; i < cell.last; i++)
+                    sum += std::sqrt(squared_distance(u, data_.get_row(order_[i]), dim_));
+            }
+            else
+            {
+                stack.push_back(cell.child2);
+                stack.push_back(cell.child1);
+            }
+        }
+
+        return sum;
+    }
+};
+
+
+double energy_tree_cpp(py::array_t<double> data, py::array_t<double> points, double theta, std::size_t leaf_size, int n_threads)
+{
+    DF D(data), sp(points);
+    std::size_t N = D.nrow();
+    std::size_t n = sp.nrow();
+
+    py::gil_scoped_release release;
+
+    TreeCode data_tree(D, leaf_size);
+    TreeCode points_tree(sp, leaf_size);
+
+    std::vector<double> ed_1(n);
+    std::vector<double> ed_2(n);
+
+    #pragma omp parallel for schedule(dynamic) num_threads(resolve_threads(n_threads))
+    for(int i = 0; i < static_cast<int>(n); i++)
+    {
+        ed_1[i] = data_tree.distance_sum(sp.get_row(i), theta);
+        ed_2[i] = points_tree.distance_sum(sp.get_row(i), theta);
+    }
+
+    double sum1 = 0.0;
+    double sum2 = 0.0;
+    for(std::size_t i = 0; i < n; i++)
+    {
+        sum1 += ed_1[i];
+        sum2 += ed_2[i];
+    }
+
+    return 2.0 * sum1 / (N * n) - sum2 / (n * n);
+}
+
+
+class EnergyTracker
+{
+private:
+    DF data_;
+    std::size_t dim_;
+    std::size_t n_;
+    std::vector<double> points_;
+    std::vector<double> ed_1_;
+    std::vector<double> ed_2_;
+    std::vector<char> active_;
+    std::vector<std::size_t> free_;
+    int n_threads_;
+
+    const double* get_point(const std::size_t slot) const
+    {
+        return points_.data() + slot * dim_;
+    }
+
+    std::vector<std::size_t> active_slots() const
+    {
+        std::vector<std::size_t> slots;
+        slots.reserve(n_);
+        for(std::size_t i = 0; i < active_.size(); i++)
+            if(active_[i])
+                slots.push_back(i);
+
+        return slots;
+    }
+
+public:
+    EnergyTracker(py::array_t<double> data, int n_threads) : data_(data), dim_(data_.ncol()), n_(0), n_threads_(n_threads) {}
+
+    std::vector<std::size_t> add(py::array_t<double> points)
+    {
+        DF sp(points);
+        if(sp.ncol() != dim_)
+            throw std::invalid_argument("points should have the same number of columns as data");
+
+        std::vector<std::size_t> added(sp.nrow());
+        for(std::size_t i = 0; i < sp.nrow(); i++)
+        {
+            std::size_t slot;
+            if(free_.empty())
+            {
+                slot = active_.size();
+                active_.push_back(0);
+                ed_1_.push_back(0.0);
+                ed_2_.push_back(0.0);
+                points_.resize(points_.size() + dim_);
+            }
+            else
+            {
+                slot = free_.back();
+                free_.pop_back();
+            }
+
+            std::copy(sp.get_row(i), sp.get_row(i) + dim_, points_.begin() + slot * dim_);
+            added[i] = slot;
+        }
+
+        std::vector<std::size_t> existing = active_slots();
+        for(std::size_t i = 0; i < added.size(); i++)
+            active_[added[i]] = 1;
+        n_ += added.size();
+        std::vector<std::size_t> current = active_slots();
+
+        std::size_t N = data_.nrow();
+
+        // data term and points term of the inserted points: O(N + n) each
+        #pragma omp parallel for schedule(dynamic) num_threads(resolve_threads(n_threads_))
+        for(int i = 0; i < static_cast<int>(added.size()); i++)
+        {
+            const double* u_i = get_point(added[i]);
+
+            ed_1_[added[i]] = row_distance_sum(u_i, data_.get_row(0), N, dim_);
+
+            double distance_sum = 0.0;
+            for(std::size_t j = 0; j < current.size(); j++)
+                if(current[j] != added[i])
+                    distance_sum += std::sqrt(squared_distance(u_i, get_point(current[j]), dim_));
+
+            ed_2_[added[i]] = distance_sum;
+        }
+
+        // points term of the existing points gains the distances to the inserted points
+        #pragma omp parallel for num_threads(resolve_threads(n_threads_))
+        for(int j = 0; j < static_cast<int>(existing.size()); j++)
+        {
+            const double* u_j = get_point(existing[j]);
+
+            double distance_sum = 0.0;
+            for(std::size_t i = 0; i < added.size(); i++)
+                distance_sum += std::sqrt(squared_distance(u_j, get_point(added[i]), dim_));
+
+            ed_2_[existing[j]] += distance_sum;
+        }
+
+        return added;
+    }
+
+    void remove(std::vector<std::size_t> slots)
+    {
+        for(std::size_t i = 0; i < slots.size(); i++)
+        {
+            if(slots[i] >= active_.size() || !active_[slots[i]])
+            {
+                for(std::size_t j = 0; j < i; j++)
+                    active_[slots[j]] = 1;
+
+                throw std::invalid_argument("point " + std::to_string(slots[i]) + " is not tracked");
+            }
+
+            active_[slots[i]] = 0;
+        }
+
+        free_.insert(free_.end(), slots.begin(), slots.end());
+        n_ -= slots.size();
+
+        std::vector<std::size_t> current = active_slots();
+
+        // points term of the remaining points loses the distances to the removed points
+        #pragma omp parallel for num_threads(resolve_threads(n_threads_))
+        for(int j = 0; j < static_cast<int>(current.size()); j++)
+        {
+            const double* u_j = get_point(current[j]);
+
+            double distance_sum = 0.0;
+            for(std::size_t i = 0; i < slots.size(); i++)
+                distance_sum += std::sqrt(squared_distance(u_j, get_point(slots[i]), dim_));
+
+            ed_2_[current[j]] -= distance_sum;
+        }
+    }
+
+    double energy() const
+    {
+        if(n_ == 0)
+            throw std::invalid_argument("no points are tracked");
+
+        double sum1 = 0.0;
+        double sum2 = 0.0;
+        for(std::size_t i = 0; i < active_.size(); i++)
+            if(active_[i])
+            {
+                sum1 += ed_1_[i];
+                sum2 += ed_2_[i];
+            }
+
+        std::size_t N = data_.nrow();
+        return 2.0 * sum1 / (N * n_) - sum2 / (n_ * n_);
+    }
+
+    std::vector<std::size_t> ids() const
+    {
+        return active_slots();
+    }
+
+    std::vector<double> contributions() const
+    {
+        std::size_t N = data_.nrow();
+        std::vector<double> contribution;
+        contribution.reserve(n_);
+        for(std::size_t i = 0; i < active_.size(); i++)
+            if(active_[i])
+                contribution.push_back(2.0 * ed_1_[i] / (N * n_) - ed_2_[i] / (n_ * n_));
+
+        return contribution;
+    }
+
+    std::size_t size() const
+    {
+        return n_;
+    }
+};
+
+
+PYBIND11_MODULE(twinning_cpp, m){
+    m.doc() = R"pbdoc(
+        .. currentmodule:: twinning_cpp
+
+        .. autosummary::
+           :toctree: _generate
+
+           max_threads_cpp
+           simd_cpp
+           twin_cpp
+           twin_collapsed_cpp
+           twin_stratified_cpp
+           twin_batch_cpp
+           compress_cpp
+           pyramid_cpp
+           multiplet_stratified_cpp
+           group_labels_cpp
+           multiplet_S3_cpp
+           TwinningIndex_cpp
+           TwinningPartition_cpp
+           TwinningWindow_cpp
+           energy_cpp
+           cross_distance_sum_cpp
+           pairwise_distance_sum_cpp
+           energy_tree_cpp
+           energy_sliced_cpp
+           energy_test_cpp
+           energy_many_cpp
+           EnergyTracker_cpp
+    )pbdoc";
+
+    if(simd_limit() < 0)
+    {
+        std::string message = std::string("TWINNING_SIMD=") + std::getenv("TWINNING_SIMD") + " is not one of scalar, sse2, avx2, or avx512f, and is ignored";
+        if(PyErr_WarnEx(PyExc_RuntimeWarning, message.c_str(), 1) < 0)
+            throw py::error_already_set();
+    }
+
+    if(index_bits() < 0)
+    {
+        std::string message = std::string("TWINNING_INDEX_BITS=") + std::getenv("TWINNING_INDEX_BITS") + " is not one of 32 or 64, and is ignored";
+        if(PyErr_WarnEx(PyExc_RuntimeWarning, message.c_str(), 1) < 0)
+            throw py::error_already_set();
+    }
+
+    m.def("max_threads_cpp", &max_threads_cpp, R"pbdoc(
+        Default number of OpenMP threads (C++ extension).
+    )pbdoc");
+
+    m.def("simd_cpp", &simd_cpp, R"pbdoc(
+        Instruction set of the distance kernels (C++ extension).
+    )pbdoc");
+
+    m.def("twin_cpp", &twin_cpp, R"pbdoc(
+        Partition a dataset into statistically similar twin sets (C++ extension).
+    )pbdoc");
+
+    m.def("twin_collapsed_cpp", &twin_collapsed_cpp, R"pbdoc(
+        Twinning with collapsed duplicate rows (C++ extension).
+    )pbdoc");
+
+    m.def("twin_stratified_cpp", &twin_stratified_cpp, R"pbdoc(
+        Twinning within strata in parallel (C++ extension).
+    )pbdoc");
+
+    m.def("twin_batch_cpp", &twin_batch_cpp, R"pbdoc(
+        Twinning of a batch of datasets in parallel (C++ extension).
+    )pbdoc");
+
+    m.def("pyramid_cpp", &pyramid_cpp, R"pbdoc(
+        Repeated halving by twinning (C++ extension).
+    )pbdoc");
+
+    m.def("multiplet_stratified_cpp", &multiplet_stratified_cpp, R"pbdoc(
+        Multiplets within strata in parallel (C++ extension).
+    )pbdoc");
+
+    m.def("group_labels_cpp", &group_labels_cpp, R"pbdoc(
+        Indices of the rows grouped by their labels (C++ extension).
+    )pbdoc");
+
+    m.def("compress_cpp", &compress_cpp, R"pbdoc(
+        Twinning with a fractional ratio (C++ extension).
+    )pbdoc");
+
+    m.def("multiplet_S3_cpp", &multiplet_S3_cpp, R"pbdoc(
+        Generate multiplets using strategy 3 (C++ extension).
+    )pbdoc");
+
+    py::class_<TwinningIndex>(m, "TwinningIndex_cpp", R"pbdoc(
+        Reusable kd-tree over a dataset for repeated twinning (C++ extension).
+    )pbdoc")
+        .def(py::init<py::array_t<double>, std::size_t>())
+        .def(py::init<py::array_t<double>, std::size_t, const std::string&>())
+        .def("save_tree", &TwinningIndex::save_tree)
+        .def("twin", &TwinningIndex::twin)
+        .def("twin_rows", &TwinningIndex::twin_rows)
+        .def("get_sequence", &TwinningIndex::get_sequence);
+
+    py::class_<TwinningPartition>(m, "TwinningPartition_cpp", R"pbdoc(
+        Partition of a growing dataset with online assignment (C++ extension).
+    )pbdoc")
+        .def(py::init<py::array_t<double>, std::vector<std::size_t>, std::size_t, std::size_t, std::size_t, int>())
+        .def(py::init<py::array_t<double>, std::vector<std::size_t>, std::vector<double>, std::size_t, std::size_t, const std::string&, std::vector<double>>())
+        .def("assign", &TwinningPartition::assign)
+        .def("drift", &TwinningPartition::drift)
+        .def("size", &TwinningPartition::size)
+        .def("labels", &TwinningPartition::labels)
+        .def("targets", &TwinningPartition::targets)
+        .def("state", &TwinningPartition::state)
+        .def("data", &TwinningPartition::data)
+        .def("save_tree", &TwinningPartition::save_tree);
+
+    py::class_<TwinningWindow>(m, "TwinningWindow_cpp", R"pbdoc(
+        Twins of a sliding window of rows (C++ extension).
+    )pbdoc")
+        .def(py::init<py::array_t<double>, std::size_t, std::size_t, std::size_t, std::size_t>())
+        .def("insert", &TwinningWindow::insert)
+        .def("remove", &TwinningWindow::remove)
+        .def("selected", &TwinningWindow::selected)
+        .def("ids", &TwinningWindow::ids)
+        .def("size", &TwinningWindow::size);
+
+    m.def("energy_cpp", &energy_cpp, R"pbdoc(
+        Energy distance computation (C++ extension).
+    )pbdoc");
+
+    m.def("cross_distance_sum_cpp", &cross_distance_sum_cpp, R"pbdoc(
+        Sum of distances between the rows of a dataset and a set of points (C++ extension).
+    )pbdoc");
+
+    m.def("pairwise_distance_sum_cpp", &pairwise_distance_sum_cpp, R"pbdoc(
+        Sum of distances between all ordered pairs of points (C++ extension).
+    )pbdoc");
+
+    m.def("energy_tree_cpp", &energy_tree_cpp, R"pbdoc(
+        Approximate energy distance computation using a kd-tree code (C++ extension).
+    )pbdoc");
+
+    m.def("energy_sliced_cpp", &energy_sliced_cpp, R"pbdoc(
+        Energy distances between one dimensional projections of a dataset and a set of points (C++ extension).
+    )pbdoc");
+
+    m.def("energy_test_cpp", &energy_test_cpp, R"pbdoc(
+        Two-sample energy statistics under random permutations (C++ extension).
+    )pbdoc");
+
+    m.def("energy_many_cpp", &energy_many_cpp, R"pbdoc(
+        Energy distances between a dataset and several sets of its rows (C++ extension).
+    )pbdoc");
+
+    py::class_<EnergyTracker>(m, "EnergyTracker_cpp", R"pbdoc(
+        Incremental energy distance between a dataset and a changing set of points (C++ extension).
+    )pbdoc")
+        .def(py::init<py::array_t<double>, int>())
+        .def("add", &EnergyTracker::add)
+        .def("remove", &EnergyTracker::remove)
+        .def("energy", &EnergyTracker::energy)
+        .def("ids", &EnergyTracker::ids)
+        .def("contributions", &EnergyTracker::contributions)
+        .def("size", &EnergyTracker::size);
 
 #ifdef VERSION_INFO
     m.attr("__version__") = MACRO_STRINGIFY(VERSION_INFO);